@@ -0,0 +1,214 @@
+import os
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+GEOHASH_ALPHABET = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+# 聚合后每条流向累加的数值列（ton_km 仅在启用路线指标时存在）
+FLOW_SUM_COLUMNS = ['weight_kg', 'volume_m3', 'packages']
+FLOW_OPTIONAL_SUM_COLUMNS = ['ton_km']
+
+# 聚合需要读取的逐单数据列（从历史存储按列读取时使用）
+FLOW_INPUT_COLUMNS = [
+    'shipment_ts', 'warehouse', 'warehouse_zipcode', 'origin_lat', 'origin_lng',
+    'dest_zipcode', 'dest_city', 'dest_lat', 'dest_lng', 'distance_km',
+] + FLOW_SUM_COLUMNS + FLOW_OPTIONAL_SUM_COLUMNS
+
+
+def geohash_codes(lat, lng, precision=5):
+    """批量计算geohash的整数编码（precision*5位，经度/纬度位交错）"""
+    bits = precision * 5
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    lat_cells = np.clip(((np.asarray(lat, dtype='float64') + 90) / 180 * (1 << lat_bits)).astype('int64'), 0, (1 << lat_bits) - 1)
+    lng_cells = np.clip(((np.asarray(lng, dtype='float64') + 180) / 360 * (1 << lng_bits)).astype('int64'), 0, (1 << lng_bits) - 1)
+
+    codes = np.zeros(len(lat_cells), dtype='int64')
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (lng_cells >> (lng_bits - 1 - i // 2)) & 1
+        else:
+            bit = (lat_cells >> (lat_bits - 1 - i // 2)) & 1
+        codes = (codes << 1) | bit
+    return codes
+
+
+def geohash_strings(codes, precision=5):
+    """geohash整数编码 → base32字符串"""
+    codes = np.asarray(codes, dtype='int64')
+    chars = [GEOHASH_ALPHABET[(codes >> (5 * (precision - 1 - p))) & 31] for p in range(precision)]
+    return np.array([''.join(c) for c in zip(*chars)], dtype=object) if len(codes) else np.array([], dtype=object)
+
+
+def aggregate_flows(kepler_data, dest_key='zipcode', date_bucket='D', geohash_precision=5):
+    """把逐单数据聚合为 仓库 → 目的地（邮编或geohash网格）× 日期桶 的流向，附带件数和重量/体积/包裹数合计"""
+    data = kepler_data
+    sum_columns = FLOW_SUM_COLUMNS + [column for column in FLOW_OPTIONAL_SUM_COLUMNS if column in data.columns]
+    buckets = data['shipment_ts'].dt.to_period(date_bucket).dt.start_time
+
+    if dest_key == 'geohash':
+        cell_codes = geohash_codes(data['dest_lat'], data['dest_lng'], geohash_precision)
+        dest_column = 'dest_geohash'
+        keys = pd.DataFrame({
+            'warehouse': data['warehouse'].array,
+            'warehouse_zipcode': data['warehouse_zipcode'].array,
+            'dest_cell': cell_codes,
+            'bucket': buckets.to_numpy(),
+        })
+    else:
+        dest_column = 'dest_zipcode'
+        keys = pd.DataFrame({
+            'warehouse': data['warehouse'].array,
+            'warehouse_zipcode': data['warehouse_zipcode'].array,
+            'dest_cell': data['dest_zipcode'].array,
+            'bucket': buckets.to_numpy(),
+        })
+
+    # 组合键一次分组（sort=False避免对百万行排序；分类列按编码分组，不展开为字符串）
+    group_ids = keys.groupby(list(keys.columns), sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    values = pd.DataFrame({
+        'group': group_ids,
+        'origin_lat': data['origin_lat'].to_numpy(),
+        'origin_lng': data['origin_lng'].to_numpy(),
+        'dest_lat': data['dest_lat'].to_numpy(),
+        'dest_lng': data['dest_lng'].to_numpy(),
+        'distance_km': data['distance_km'].to_numpy(),
+        **{column: data[column].to_numpy() for column in sum_columns},
+    })
+    grouped = values.groupby('group', sort=True)
+
+    flows = grouped[['origin_lat', 'origin_lng', 'dest_lat', 'dest_lng', 'distance_km']].mean()
+    flows['shipment_count'] = grouped.size()
+    flows[sum_columns] = grouped[sum_columns].sum()
+
+    # 每组取第一行的分组键
+    _, first_rows = np.unique(group_ids, return_index=True)
+    group_keys = keys.iloc[first_rows].reset_index(drop=True)
+    flows = flows.reset_index(drop=True)
+
+    if dest_key == 'geohash':
+        dest_values = geohash_strings(group_keys['dest_cell'].to_numpy(), geohash_precision)
+        dest_city = None
+    else:
+        dest_values = group_keys['dest_cell'].array
+        dest_city = data['dest_city'].iloc[first_rows].array
+
+    bucket_ts = pd.Series(pd.to_datetime(group_keys['bucket'].to_numpy()))
+    result = pd.DataFrame({
+        'shipment_ts': bucket_ts,
+        'shipment_date': bucket_ts.dt.strftime('%Y-%m-%d').astype('category'),
+        'warehouse': group_keys['warehouse'],
+        'warehouse_zipcode': group_keys['warehouse_zipcode'],
+        'origin_lat': flows['origin_lat'],
+        'origin_lng': flows['origin_lng'],
+        dest_column: dest_values,
+        'dest_lat': flows['dest_lat'],
+        'dest_lng': flows['dest_lng'],
+        'shipment_count': flows['shipment_count'],
+        **{column: flows[column] for column in sum_columns},
+        'distance_km': flows['distance_km'],
+    })
+    if dest_city is not None:
+        result.insert(result.columns.get_loc('dest_lat'), 'dest_city', dest_city)
+    return result
+
+
+class FlowAggregation:
+    """流向聚合设置：auto模式下行数超过阈值时把地图数据从逐单切换为聚合流向"""
+
+    def __init__(self, mode='auto', threshold=200000, dest_key='zipcode', date_bucket='D', geohash_precision=5):
+        self.mode = mode
+        self.threshold = threshold
+        self.dest_key = dest_key
+        self.date_bucket = date_bucket
+        self.geohash_precision = geohash_precision
+
+    def should_aggregate(self, rows):
+        if self.mode == 'always':
+            return True
+        if self.mode == 'never':
+            return False
+        return rows > self.threshold
+
+    def aggregate(self, kepler_data):
+        return aggregate_flows(kepler_data, self.dest_key, self.date_bucket, self.geohash_precision)
+
+    def settings(self):
+        """影响地图数据的聚合设置（参与结果缓存键计算）"""
+        return {
+            'mode': self.mode,
+            'threshold': self.threshold,
+            'dest_key': self.dest_key,
+            'date_bucket': self.date_bucket,
+            'geohash_precision': self.geohash_precision,
+        }
+
+
+def load_flow_aggregation():
+    """按环境变量创建流向聚合设置"""
+    return FlowAggregation(
+        mode=os.environ.get('FLOW_AGGREGATION', 'auto'),
+        threshold=int(os.environ.get('FLOW_AGGREGATION_THRESHOLD', 200000)),
+        dest_key=os.environ.get('FLOW_DEST_KEY', 'zipcode'),
+        date_bucket=os.environ.get('FLOW_DATE_BUCKET', 'D'),
+        geohash_precision=int(os.environ.get('FLOW_GEOHASH_PRECISION', 5)),
+    )
+
+
+def flow_keys(flows):
+    """流向的分组键：日期桶、仓库、目的地（邮编或geohash）"""
+    dest_column = 'dest_geohash' if 'dest_geohash' in flows.columns else 'dest_zipcode'
+    return ['shipment_ts', 'warehouse', 'warehouse_zipcode', dest_column]
+
+
+def unify_categories(flows, delta):
+    """把两边的分类列统一为类别的并集：类别不同的分类列拼接后会退化为object，
+    按一边的类别转换时另一边独有的值（如 'Los Angeles' 与 'LOS ANGELES'）会变为NaN"""
+    flows = flows.copy(deep=False)
+    delta = delta.copy(deep=False)
+    for column in delta.columns:
+        if column not in flows.columns:
+            continue
+        if not (isinstance(flows[column].dtype, pd.CategoricalDtype) or isinstance(delta[column].dtype, pd.CategoricalDtype)):
+            continue
+        categories = union_categoricals([
+            pd.Categorical(flows[column]),
+            pd.Categorical(delta[column]),
+        ]).categories
+        dtype = pd.CategoricalDtype(categories)
+        flows[column] = flows[column].astype(dtype)
+        delta[column] = delta[column].astype(dtype)
+    return flows, delta
+
+
+def merge_flows(flows, delta):
+    """把新数据聚合出的流向合并进已有流向：只重算与新流向键相同的行（件数和合计相加，坐标和距离按件数加权平均），
+    返回 (合并后的流向, 本次新增或变化的流向)"""
+    keys = flow_keys(delta)
+    flows, delta = unify_categories(flows, delta)
+    touched = flows.merge(delta[keys].drop_duplicates(), on=keys, how='left', indicator=True)['_merge'].to_numpy() == 'both'
+
+    combined = pd.concat([flows[touched], delta], ignore_index=True)
+    sum_columns = ['shipment_count'] + [column for column in FLOW_SUM_COLUMNS + FLOW_OPTIONAL_SUM_COLUMNS if column in combined.columns]
+    mean_columns = ['origin_lat', 'origin_lng', 'dest_lat', 'dest_lng', 'distance_km']
+
+    weights = combined['shipment_count'].to_numpy(dtype='float64')
+    weighted = pd.DataFrame({column: combined[column].to_numpy(dtype='float64') * weights for column in mean_columns})
+    for column in keys + sum_columns:
+        weighted[column] = combined[column].to_numpy()
+    other_columns = [column for column in combined.columns if column not in keys + sum_columns + mean_columns]
+    for column in other_columns:
+        weighted[column] = combined[column].to_numpy()
+
+    grouped = weighted.groupby(keys, sort=False, dropna=False)
+    changed = grouped[sum_columns + mean_columns].sum()
+    for column in mean_columns:
+        changed[column] = (changed[column] / changed['shipment_count']).astype(flows[column].dtype)
+    if other_columns:
+        changed = changed.join(grouped[other_columns].first())
+    changed = changed.reset_index()[list(delta.columns)].astype(delta.dtypes.to_dict())
+
+    merged = pd.concat([flows[~touched], changed], ignore_index=True)
+    return merged, changed
@@ -2,350 +2,567 @@ from flask import Flask, request, jsonify, render_template
 import pandas as pd
 import numpy as np
 from keplergl import KeplerGl
-import requests
 import json
-from datetime import datetime
-import time
 import warnings
 import os
-import tempfile
 import io
+import shutil
+import tempfile
+import gzip
+import functools
+import hashlib
+from concurrent.futures import as_completed
+from urllib.parse import urlencode
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from geocoding import load_gazetteer, load_geocode_cache, load_geocoder
+from jobs import JobManager
+from cleaning import compact_prepared, concat_prepared, normalize_zipcodes, parse_timestamps, prepare_chunk, resolve_warehouse_zipcodes
+from aggregation import FLOW_INPUT_COLUMNS, flow_keys, load_flow_aggregation, merge_flows
+from datasets import load_dataset_store
+from metrics import PipelineTimer, create_registry
+from query import INDEXED_COLUMNS, IndexCache, ShipmentIndex
+from frames import FRAME_BUCKETS, AnimationFrames
+from parallel import combine_shards, csv_byte_ranges, load_shard_pool, prepare_csv_shard, receive_shard
+from result_cache import HashingReader, content_key, load_result_cache
+from shipment_store import load_shipment_store
+from warehouses import load_warehouse_registry
 warnings.filterwarnings('ignore')
 
 app = Flask(__name__)
 
-class WarehouseFixedVisualizer:
-    def __init__(self):
-        self.coordinate_cache = {}
-        self.zipcode_api_base = "http://api.zippopotam.us/us/"
-        self.all_data = None
-        self.warehouse_mapping = None
-
-    def analyze_warehouse_ids(self, df_sample):
-        """分析文件中的warehouse ID并推测地理位置"""
-        print("🔍 分析warehouse ID并推测地理位置...")
-        
-        warehouse_counts = df_sample['warehouse_name'].value_counts()
-        print(f"📊 前{len(df_sample)}行中发现的warehouse:")
-        for warehouse, count in warehouse_counts.items():
-            print(f"   {warehouse}: {count} 次")
-
-        # 根据warehouse ID推测地理位置和邮编
-        warehouse_zipcode_mapping = {
-            # NJ系列 - 新泽西州 (Newark, Elizabeth等物流中心)
-            'NJ9': '07114',          # Newark, NJ - 主要物流中心
-            'NJ8': '07201',          # Elizabeth, NJ - 港口物流中心
-            'NJ7': '08817',          # Edison, NJ - 仓储区
-            'NJ-Main': '07306',      # Jersey City, NJ
-
-            # TX系列 - 德克萨斯州 (达拉斯-沃斯堡地区)
-            'TX8828': '75261',       # Dallas, TX - 主要物流枢纽
-            'TX8829': '76155',       # Fort Worth, TX
-            'TX-DFW': '75063',       # Irving, TX - DFW机场附近
-            'TX-Houston': '77032',   # Houston, TX - 船运中心
-
-            # WNT系列 - 推测为West Coast + NT (Northwest Terminal)
-            'WNT485': '90248',       # Gardena, CA - 洛杉矶地区物流中心
-            'WNT486': '91761',       # Ontario, CA - 内陆帝国物流区
-            'WNT487': '92408',       # San Bernardino, CA
-
-            # CA系列 - 加利福尼亚州
-            'CA-LA': '90058',        # Los Angeles, CA - 工业区
-            'CA-SF': '94080',        # South San Francisco, CA
-            'CA-OAK': '94621',       # Oakland, CA - 港口区
-
-            # IL系列 - 伊利诺伊州 (芝加哥地区)
-            'IL-CHI': '60638',       # Chicago, IL - 物流区
-            'IL9': '60106',          # Bensenville, IL - O'Hare附近
-
-            # GA系列 - 佐治亚州 (亚特兰大)
-            'GA-ATL': '30349',       # Atlanta, GA - 机场物流区
-
-            # FL系列 - 佛罗里达州 (迈阿密)
-            'FL-MIA': '33166',       # Miami, FL - 物流中心
-
-            # 通用/未知仓库 - 默认为主要物流中心
-            'Unknown': '07114',      # 默认新泽西Newark
-            'MAIN': '10001',         # 纽约主仓
-            'NYC-Main': '11378',     # Queens, NY - 物流区
+# 详细日志（逐仓库/逐日期统计等）默认关闭，VERBOSE_LOGGING=1 开启
+VERBOSE_LOGGING = os.environ.get('VERBOSE_LOGGING', '0') == '1'
+
+# 处理行数上限（默认处理全部行）和CSV分块大小
+MAX_ROWS = int(os.environ['MAX_ROWS']) if os.environ.get('MAX_ROWS') else None
+CSV_CHUNKSIZE = int(os.environ.get('CSV_CHUNKSIZE', 100000))
+
+# gzip压缩的请求体在内存中解压，解压后的上限（字节）：很小的压缩炸弹也可能展开为数GB
+MAX_DECOMPRESSED_BYTES = int(os.environ.get('MAX_DECOMPRESSED_BYTES', 512 * 1024 ** 2))
+
+# 必需列（可选列和清洗后保留的列见 cleaning.py）
+REQUIRED_COLUMNS = ['warehouse_name', 'created_time', 'shipto_postal_code']
+
+# 流式上传时只读取需要的列，并显式指定类型（避免pandas逐块推断）
+INGEST_DTYPES = {
+    'id': str,
+    'warehouse_name': str,
+    'created_time': str,
+    'shipto_postal_code': str,
+    'shipto_city': str,
+    'shipto_country_code': str,
+    'carrier': str,
+    'biz_type': str,
+    'gw': 'float64',
+    'vol': 'float64',
+    'pkg_num': 'float64',
+}
+
+# 后台任务的流水线阶段（与process_data的处理步骤对应）
+PIPELINE_STAGES = ['clean', 'geocode', 'coordinates', 'build_dataset', 'aggregate', 'persist', 'render_map', 'done']
+
+# 地图响应模式：html（内嵌完整地图HTML）或 shell（静态地图页 + 独立的数据接口），可用 ?mode= 覆盖
+MAP_RESPONSE_MODE = os.environ.get('MAP_RESPONSE_MODE', 'html')
+
+# Mapbox访问令牌（独立HTML地图和静态地图页共用）
+MAPBOX_TOKEN = os.environ.get('MAPBOX_TOKEN', 'pk.eyJ1IjoieXV4dWFsYW4iLCJhIjoiY21idG03YmZlMDR2bDJxcHVoZjRjY2l2ciJ9.7NP8FWPFIAWtr7rLkhlc1A')
+
+# 地图数据接口支持的格式
+MAP_DATA_MIMETYPES = {
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+# /api/shipments 单次查询返回的最多行数（聚合结果不受限制）
+QUERY_ROW_LIMIT = int(os.environ.get('QUERY_ROW_LIMIT', 100000))
+
+# 时间回放每次加载的帧数（当前帧起的窗口），可用 ?count= 覆盖
+ANIMATION_FRAME_WINDOW = int(os.environ.get('ANIMATION_FRAME_WINDOW', 7))
+
+# 流水线逻辑版本：修改处理逻辑导致结果变化时递增，使旧的结果缓存失效
+PIPELINE_VERSION = 3
+
+# 大圆距离计算精度（float32可减半内存，误差约为米级）和可选的路线指标（方位角、距离区间、吨公里）
+EARTH_RADIUS_KM = 6371.0088
+DISTANCE_DTYPE = os.environ.get('DISTANCE_DTYPE', 'float64')
+ROUTE_METRICS = os.environ.get('ROUTE_METRICS', '0') == '1'
+DISTANCE_BAND_EDGES_KM = [100, 300, 600, 1000, 2000, 3000]
+DISTANCE_BAND_LABELS = ['<100 km', '100-300 km', '300-600 km', '600-1000 km', '1000-2000 km', '2000-3000 km', '3000+ km']
+
+# 列式传输支持的Arrow IPC类型
+ARROW_MIMETYPES = ('application/vnd.apache.arrow.stream', 'application/x-arrow')
+
+def report_nothing(stage, **info):
+    """默认的进度回调（同步请求不需要进度）"""
+
+def log(*args, **kwargs):
+    """详细日志，仅在 VERBOSE_LOGGING 开启时输出"""
+    if VERBOSE_LOGGING:
+        print(*args, **kwargs)
+
+class ProcessingResult:
+    """单次请求的处理结果：Kepler数据集、聚合流向（可选）、邮编坐标、所用的仓库注册表和清洗统计，不在请求间共享"""
+
+    def __init__(self, kepler_data, warehouse_registry, report=None, flows=None, zip_coords=None):
+        self.kepler_data = kepler_data
+        self.warehouse_registry = warehouse_registry
+        self.report = report or {}
+        self.flows = flows
+        self.zip_coords = zip_coords
+
+    @property
+    def aggregated(self):
+        return self.flows is not None
+
+    @property
+    def map_data(self):
+        """地图实际渲染的数据：聚合后为流向，否则为逐单数据"""
+        return self.flows if self.flows is not None else self.kepler_data
+
+    def stats(self):
+        """前端展示用的统计信息（全部为可JSON序列化的类型）"""
+        data = self.kepler_data
+        min_date = data['shipment_ts'].min()
+        max_date = data['shipment_ts'].max()
+
+        if pd.isna(min_date) or pd.isna(max_date):
+            date_range = "Unknown date range"
+        else:
+            date_range = f"{min_date:%Y-%m-%d} → {max_date:%Y-%m-%d}"
+
+        return {
+            'total_records': int(len(data)),
+            'unique_warehouses': int(data['warehouse'].nunique()),
+            'unique_destinations': int(data['dest_city'].nunique()),
+            'date_range': date_range,
+            'unparseable_timestamps': int(self.report.get('timestamp_unparseable', 0)),
+            'aggregated': self.aggregated,
+            'map_rows': int(len(self.map_data)),
+            'memory_bytes': frame_memory(self.kepler_data) + (frame_memory(self.flows) if self.flows is not None else 0)
         }
 
-        print(f"\n📍 Warehouse邮编映射表:")
-        for warehouse, zipcode in warehouse_zipcode_mapping.items():
-            print(f"   {warehouse} → {zipcode}")
-
-        return warehouse_zipcode_mapping
-
-    def get_warehouse_zipcode(self, warehouse_name):
-        """根据warehouse名称获取对应邮编"""
-        if pd.isna(warehouse_name):
-            return self.warehouse_mapping['Unknown']
-
-        warehouse_name = str(warehouse_name).strip()
-
-        # 直接匹配
-        if warehouse_name in self.warehouse_mapping:
-            return self.warehouse_mapping[warehouse_name]
-
-        # 模糊匹配
-        warehouse_upper = warehouse_name.upper()
-
-        # NJ系列匹配
-        if warehouse_upper.startswith('NJ'):
-            return self.warehouse_mapping.get('NJ9', '07114')
-
-        # TX系列匹配
-        elif warehouse_upper.startswith('TX'):
-            return self.warehouse_mapping.get('TX8828', '75261')
-
-        # WNT系列匹配
-        elif warehouse_upper.startswith('WNT'):
-            return self.warehouse_mapping.get('WNT485', '90248')
-
-        # CA系列匹配
-        elif warehouse_upper.startswith('CA'):
-            return self.warehouse_mapping.get('CA-LA', '90058')
-
-        # IL系列匹配
-        elif warehouse_upper.startswith('IL'):
-            return self.warehouse_mapping.get('IL-CHI', '60638')
-
-        # 包含关键词匹配
-        elif 'NYC' in warehouse_upper or 'NEW YORK' in warehouse_upper:
-            return self.warehouse_mapping.get('NYC-Main', '11378')
-        elif 'DALLAS' in warehouse_upper or 'DFW' in warehouse_upper:
-            return self.warehouse_mapping.get('TX-DFW', '75063')
-        elif 'LA' in warehouse_upper or 'LOS ANGELES' in warehouse_upper:
-            return self.warehouse_mapping.get('CA-LA', '90058')
-        elif 'CHICAGO' in warehouse_upper:
-            return self.warehouse_mapping.get('IL-CHI', '60638')
-        elif 'ATLANTA' in warehouse_upper:
-            return self.warehouse_mapping.get('GA-ATL', '30349')
-        elif 'MIAMI' in warehouse_upper:
-            return self.warehouse_mapping.get('FL-MIA', '33166')
-
-        # 默认返回
-        return self.warehouse_mapping['Unknown']
-
-    def extract_zipcode(self, zipcode_str):
-        """提取5位数邮编"""
-        if pd.isna(zipcode_str):
-            return None
-        zipcode_str = str(zipcode_str).strip()
-        zipcode = ''.join(filter(str.isdigit, zipcode_str))[:5]
-        return zipcode if len(zipcode) == 5 else None
+class MissingColumnsError(ValueError):
+    """上传数据缺少必需列"""
+
+class PayloadTooLargeError(Exception):
+    """请求体解压后超过 MAX_DECOMPRESSED_BYTES（返回413）"""
+
+def format_datetimes(timestamps, fmt):
+    """按唯一时间格式化字符串，返回分类列（每行只存编码，字符串每个唯一值只存一份）"""
+    codes, uniques = pd.factorize(timestamps)
+    formatted = pd.DatetimeIndex(uniques).strftime(fmt)
+    # 不同时间可能格式化为相同字符串（如 %Y-%m-%d），分类取值需唯一
+    categories, remap = np.unique(formatted.to_numpy(dtype=object), return_inverse=True)
+    codes = np.where(codes >= 0, remap[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=timestamps.index)
+
+def compact_category(values, fill=None):
+    """低基数字符串列 → 分类列，缺失值用fill填充；已是分类列时（并行分片交接的字典编码列）
+    去掉未出现的类别并按值排序，与字符串列转换的结果一致"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.remove_unused_categories()
+        values = values.cat.reorder_categories(values.cat.categories.sort_values())
+    else:
+        values = values.astype('category')
+    if fill is not None and values.isna().any():
+        if fill not in values.cat.categories:
+            values = values.cat.add_categories([fill])
+        values = values.fillna(fill)
+    return values
+
+def frame_memory(df):
+    """DataFrame实际占用内存（字节，含字符串对象）"""
+    return int(df.memory_usage(deep=True).sum())
+
+def great_circle(origin_lat, origin_lng, dest_lat, dest_lng, dtype='float64', bearing=False):
+    """向量化haversine大圆距离（公里），bearing=True 时同时返回初始方位角（度）；中间结果原地计算，不产生额外的整列副本"""
+    lat1 = np.radians(np.asarray(origin_lat), dtype=dtype)
+    lat2 = np.radians(np.asarray(dest_lat), dtype=dtype)
+    dlng = np.radians(np.asarray(dest_lng), dtype=dtype)
+    dlng -= np.radians(np.asarray(origin_lng), dtype=dtype)
+
+    cos_lat1 = np.cos(lat1)
+    cos_lat2 = np.cos(lat2)
+
+    # a = sin²(Δφ/2) + cos φ1 · cos φ2 · sin²(Δλ/2)
+    a = np.subtract(lat2, lat1)
+    a *= 0.5
+    np.sin(a, out=a)
+    a *= a
+    h = np.multiply(dlng, 0.5)
+    np.sin(h, out=h)
+    h *= h
+    h *= cos_lat1
+    h *= cos_lat2
+    a += h
+    np.clip(a, 0, 1, out=a)
+
+    # d = 2R · asin(√a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * EARTH_RADIUS_KM
+    distance = a
+
+    if not bearing:
+        return distance, None
+
+    # θ = atan2(sin Δλ · cos φ2, cos φ1 · sin φ2 − sin φ1 · cos φ2 · cos Δλ)
+    y = np.sin(dlng)
+    y *= cos_lat2
+    x = np.cos(dlng, out=dlng)
+    x *= cos_lat2
+    x *= np.sin(lat1, out=lat1)
+    np.sin(lat2, out=lat2)
+    lat2 *= cos_lat1
+    np.subtract(lat2, x, out=x)
+    np.arctan2(y, x, out=y)
+    np.degrees(y, out=y)
+    y += 360
+    np.mod(y, 360, out=y)
+    return distance, y
+
+def distance_bands(distance_km):
+    """按 DISTANCE_BAND_EDGES_KM 把距离划入区间，返回分类列（只存区间编码）"""
+    codes = np.searchsorted(DISTANCE_BAND_EDGES_KM, distance_km, side='right')
+    return pd.Categorical.from_codes(codes, categories=DISTANCE_BAND_LABELS)
+
+class WarehouseFixedVisualizer:
+    def __init__(self):
+        self.geocode_cache = load_geocode_cache()
+        self.zipcode_api_base = os.environ.get('ZIPCODE_API_BASE', "http://api.zippopotam.us/us/")
+        self.geocoder = load_geocoder(self.zipcode_api_base, self.geocode_cache)
+        self.gazetteer = load_gazetteer()
+        self.warehouse_registry = load_warehouse_registry()
+        self.shard_pool = load_shard_pool()
+        self.use_api_fallback = os.environ.get('GEOCODE_API_FALLBACK', '1') != '0'
+        self.flow_aggregation = load_flow_aggregation()
+        self.distance_dtype = DISTANCE_DTYPE
+        self.route_metrics = ROUTE_METRICS
+
+    def resolve_warehouse_zipcodes(self, warehouse_names, warehouse_registry):
+        return resolve_warehouse_zipcodes(warehouse_names, warehouse_registry)
+
+    def normalize_zipcodes(self, zipcodes):
+        return normalize_zipcodes(zipcodes)
 
     def get_coordinates(self, zipcode):
         """获取邮编坐标"""
-        if not zipcode or zipcode in self.coordinate_cache:
-            return self.coordinate_cache.get(zipcode, (None, None))
-
-        try:
-            url = f"{self.zipcode_api_base}{zipcode}"
-            response = requests.get(url, timeout=5)
-
-            if response.status_code == 200:
-                data = response.json()
-                if 'places' in data and len(data['places']) > 0:
-                    place = data['places'][0]
-                    lat, lng = float(place['latitude']), float(place['longitude'])
-                    city = place['place name']
-                    state = place['state abbreviation']
-                    self.coordinate_cache[zipcode] = (lat, lng)
-                    print(f"   ✓ {zipcode}: {city}, {state}")
-                    return (lat, lng)
-
-            self.coordinate_cache[zipcode] = (None, None)
+        if not zipcode:
             return (None, None)
+        return self.geocoder.geocode(zipcode)
 
-        except Exception as e:
-            print(f"   ✗ {zipcode}: API请求失败")
-            self.coordinate_cache[zipcode] = (None, None)
-            return (None, None)
+    def parse_timestamps(self, timestamps):
+        return parse_timestamps(timestamps)
 
-    def process_timestamp(self, timestamp_str):
-        """处理时间戳为标准格式"""
-        if pd.isna(timestamp_str):
-            return None, None
+    def prepare_chunk(self, df, warehouse_registry, report=None):
+        """清洗单个数据块（步骤3-6，见 cleaning.prepare_chunk）"""
+        return prepare_chunk(df, warehouse_registry, report)
 
-        try:
-            if isinstance(timestamp_str, str) and '/' in timestamp_str:
-                dt = datetime.strptime(timestamp_str, '%m/%d/%y %H:%M')
-                return dt.strftime('%Y-%m-%d'), dt.strftime('%Y-%m-%d %H:%M:%S')
-            elif isinstance(timestamp_str, (int, float)):
-                if timestamp_str > 1e10:
-                    timestamp_str = timestamp_str / 1000
-                dt = datetime.fromtimestamp(timestamp_str)
-                return dt.strftime('%Y-%m-%d'), dt.strftime('%Y-%m-%d %H:%M:%S')
-        except:
-            pass
-        return None, None
+    def process_data(self, df, sample_size=None, progress=None, known_coords=None):
+        """处理所有数据，修复warehouse邮编 - 完整Colab版本逻辑；progress(stage, **info) 接收阶段进度"""
+        progress = progress or report_nothing
+        log(f"🔄 开始处理数据并修复warehouse邮编 (行数上限: {sample_size or '全部'})...")
 
-    def process_data(self, df, sample_size=500):
-        """处理所有数据，修复warehouse邮编 - 完整Colab版本逻辑"""
-        print(f"🔄 开始处理数据并修复warehouse邮编 (样本大小: {sample_size})...")
-
-        # 1. 分析并创建warehouse映射
-        df_sample = df.head(200)  # 先取200行分析warehouse
-        self.warehouse_mapping = self.analyze_warehouse_ids(df_sample)
+        # 1. 取当前仓库注册表快照（整个请求使用同一版本）
+        warehouse_registry = self.warehouse_registry.current()
 
         # 2. 读取数据
-        df = df.head(sample_size)
-        print(f"\n📂 原始数据: {len(df)} 行")
-
-        # 3. 修复warehouse邮编
-        print("🔧 修复warehouse邮编...")
-        df['fixed_warehouse_zipcode'] = df['warehouse_name'].apply(self.get_warehouse_zipcode)
-
-        # 显示修复结果
-        warehouse_fix_stats = df.groupby(['warehouse_name', 'fixed_warehouse_zipcode']).size().reset_index(name='count')
-        print("📋 Warehouse邮编修复结果:")
-        for _, row in warehouse_fix_stats.iterrows():
-            print(f"   {row['warehouse_name']} → {row['fixed_warehouse_zipcode']} ({row['count']} 条记录)")
-
-        # 4. 处理时间戳
-        print("\n⏰ 处理时间戳...")
-        timestamp_results = df['created_time'].apply(self.process_timestamp)
-        df['shipment_date'] = [r[0] for r in timestamp_results]
-        df['shipment_datetime'] = [r[1] for r in timestamp_results]
-
-        # 5. 清洗目的地邮编
-        print("📮 清洗目的地邮编...")
-        df['destination_zipcode'] = df['shipto_postal_code'].apply(self.extract_zipcode)
-
-        # 6. 过滤有效数据
-        valid_df = df[
-            (df['shipment_date'].notna()) &
-            (df['fixed_warehouse_zipcode'].notna()) &
-            (df['destination_zipcode'].notna())
-        ].copy()
-
-        print(f"✅ 有效数据: {len(valid_df)} 行")
-
-        if len(valid_df) == 0:
+        if sample_size:
+            df = df.head(sample_size)
+        log(f"\n📂 原始数据: {len(df)} 行")
+
+        report = {}
+        progress('clean', rows=len(df))
+        return self.finalize(self.prepare_chunk(df, warehouse_registry, report), warehouse_registry, report, progress, known_coords)
+
+    def process_csv(self, source, chunksize=None, max_rows=None, progress=None, known_coords=None, **read_csv_kwargs):
+        """分块流式读取CSV并逐块清洗：原始数据块逐块释放，只累积转为紧凑类型的有效行
+        （分类列 + float32，约为原始字符串行的几分之一），峰值内存 ≈ 一个原始块 + 累积的紧凑有效行"""
+        chunksize = chunksize or CSV_CHUNKSIZE
+        progress = progress or report_nothing
+        log(f"🔄 开始流式处理CSV (块大小: {chunksize}, 行数上限: {max_rows or '全部'})...")
+
+        prepared_chunks = []
+        total_rows = 0
+        report = {}
+
+        for chunk in pd.read_csv(source, chunksize=chunksize, **read_csv_kwargs):
+            if max_rows is not None:
+                chunk = chunk.head(max_rows - total_rows)
+
+            # 1. 用第一个数据块检查必需列，并取当前仓库注册表快照
+            if total_rows == 0:
+                missing_columns = [col for col in REQUIRED_COLUMNS if col not in chunk.columns]
+                if missing_columns:
+                    raise MissingColumnsError(
+                        f'Missing required columns: {missing_columns}. Available columns: {list(chunk.columns)}'
+                    )
+                warehouse_registry = self.warehouse_registry.current()
+
+            total_rows += len(chunk)
+            prepared_chunks.append(compact_prepared(self.prepare_chunk(chunk, warehouse_registry, report)))
+            log(f"   已处理 {total_rows} 行")
+            progress('clean', rows=total_rows)
+
+            if max_rows is not None and total_rows >= max_rows:
+                break
+
+        log(f"\n📂 原始数据: {total_rows} 行")
+
+        if not prepared_chunks:
             print("❌ 没有有效数据!")
             return None
 
-        # 显示日期分布
-        date_counts = valid_df['shipment_date'].value_counts().sort_index()
-        print(f"📅 日期分布 ({len(date_counts)} 天):")
-        for date, count in date_counts.items():
-            print(f"   {date}: {count} 笔")
-
-        # 7. 获取所有邮编的坐标
-        print(f"\n🌍 获取邮编坐标...")
-        all_zipcodes = list(set(
-            valid_df['fixed_warehouse_zipcode'].tolist() +
-            valid_df['destination_zipcode'].tolist()
-        ))
-
-        print(f"需要处理 {len(all_zipcodes)} 个唯一邮编")
-
-        successful_coords = 0
-        for i, zipcode in enumerate(all_zipcodes):
-            coord = self.get_coordinates(zipcode)
-            if coord != (None, None):
-                successful_coords += 1
-
-            if (i + 1) % 10 == 0:
-                print(f"   进度: {i + 1}/{len(all_zipcodes)} | 成功: {successful_coords}")
-            time.sleep(0.1)
-
-        success_rate = successful_coords / len(all_zipcodes) * 100
-        print(f"✅ 坐标获取成功率: {successful_coords}/{len(all_zipcodes)} ({success_rate:.1f}%)")
-
-        # 8. 添加坐标
-        print("📍 添加坐标信息...")
-
-        def get_lat(zipcode):
-            coord = self.coordinate_cache.get(zipcode, (None, None))
-            return coord[0] if coord and len(coord) == 2 else None
-
-        def get_lng(zipcode):
-            coord = self.coordinate_cache.get(zipcode, (None, None))
-            return coord[1] if coord and len(coord) == 2 else None
+        return self.finalize(concat_prepared(prepared_chunks), warehouse_registry, report, progress, known_coords)
+
+    def prepare_csv_parallel(self, path, progress=None, **read_csv_kwargs):
+        """多进程分片清洗未压缩的CSV文件：按字节范围切分，各工作进程自行读取分片并执行步骤3-6，
+        返回 (有效数据, 仓库注册表快照, 清洗统计)，没有数据时返回None"""
+        progress = progress or report_nothing
+        names = list(pd.read_csv(path, nrows=0).columns)
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in names]
+        if missing_columns:
+            raise MissingColumnsError(
+                f'Missing required columns: {missing_columns}. Available columns: {names}'
+            )
+
+        # 1. 整个文件使用同一个仓库注册表快照；列筛选函数不能跨进程传递，先展开为列名列表
+        warehouse_registry = self.warehouse_registry.current()
+        if callable(read_csv_kwargs.get('usecols')):
+            read_csv_kwargs['usecols'] = [col for col in names if read_csv_kwargs['usecols'](col)]
+
+        ranges = csv_byte_ranges(path, self.shard_pool.shard_bytes, self.shard_pool.workers)
+        log(f"🔄 并行清洗CSV: {len(ranges)} 个分片, {self.shard_pool.workers} 个进程")
+        if not ranges:
+            print("❌ 没有有效数据!")
+            return None
 
-        valid_df['warehouse_lat'] = valid_df['fixed_warehouse_zipcode'].apply(get_lat)
-        valid_df['warehouse_lng'] = valid_df['fixed_warehouse_zipcode'].apply(get_lng)
-        valid_df['destination_lat'] = valid_df['destination_zipcode'].apply(get_lat)
-        valid_df['destination_lng'] = valid_df['destination_zipcode'].apply(get_lng)
+        # 2-6. 各分片并行清洗，按完成顺序汇总进度和统计，按原顺序拼接
+        #    分片结果经共享内存中的Arrow文件交回（不经管道传递），以内存映射打开，全部到齐后拼接并只转换一次；
+        #    记录复制到主进程内存（管道 + 转换）和内存映射读取的字节数
+        #    工作进程只接收显式参数（清洗函数 + 注册表快照），不依赖本模块的全局状态
+        prepare = functools.partial(prepare_chunk, warehouse_registry=warehouse_registry)
+        executor = self.shard_pool.executor()
+        futures = {
+            executor.submit(
+                prepare_csv_shard, prepare, path, start, end, names, read_csv_kwargs,
+                self.shard_pool.handoff, self.shard_pool.handoff_dir
+            ): i
+            for i, (start, end) in enumerate(ranges)
+        }
+        shards = [None] * len(ranges)
+        report = {}
+        total_rows = 0
+        copied_bytes = 0
+        mapped_bytes = 0
+        for future in as_completed(futures):
+            handoff, rows, shard_report = future.result()
+            shards[futures[future]], copied, mapped = receive_shard(handoff)
+            total_rows += rows
+            copied_bytes += copied
+            mapped_bytes += mapped
+            for key, count in shard_report.items():
+                report[key] = report.get(key, 0) + count
+            progress('clean', rows=total_rows, copied_bytes=copied_bytes, mapped_bytes=mapped_bytes)
+
+        valid_df, copied = combine_shards(shards)
+        copied_bytes += copied
+        progress('clean', copied_bytes=copied_bytes)
+
+        log(f"\n📂 原始数据: {total_rows} 行")
+        log(f"📦 分片交接: 复制 {copied_bytes} 字节, 内存映射读取 {mapped_bytes} 字节 ({self.shard_pool.handoff})")
+        return valid_df, warehouse_registry, report
+
+    def process_csv_parallel(self, path, progress=None, known_coords=None, **read_csv_kwargs):
+        """并行清洗CSV文件后，对所有分片邮编的并集统一地理编码并生成数据集"""
+        progress = progress or report_nothing
+        prepared = self.prepare_csv_parallel(path, progress, **read_csv_kwargs)
+        if prepared is None:
+            return None
+        valid_df, warehouse_registry, report = prepared
+        return self.finalize(valid_df, warehouse_registry, report, progress, known_coords)
+
+    def finalize(self, valid_df, warehouse_registry, report=None, progress=None, known_coords=None):
+        """对清洗后的有效数据进行地理编码并生成Kepler数据集（步骤7-10），返回本次请求独有的ProcessingResult；
+        known_coords（以邮编为索引的 lat/lng）中已有的邮编不再地理编码"""
+        report = report or {}
+        progress = progress or report_nothing
+        if report.get('timestamp_unparseable') or report.get('timestamp_missing'):
+            print(f"⚠️ 时间戳: 无法解析 {report.get('timestamp_unparseable', 0)} 行, "
+                  f"缺失 {report.get('timestamp_missing', 0)} 行")
+        if report.get('zipcode_invalid'):
+            print(f"⚠️ 目的地邮编: 无效 {report['zipcode_invalid']} 行")
+
+        progress('clean', rows_out=len(valid_df))
+
+        # 显示修复结果和日期分布（仅详细日志，大数据量下分组统计本身也有开销）
+        if VERBOSE_LOGGING:
+            warehouse_fix_stats = valid_df.groupby(['warehouse_name', 'fixed_warehouse_zipcode'], dropna=False).size()
+            log("📋 Warehouse邮编修复结果:")
+            for (warehouse, zipcode), count in warehouse_fix_stats.items():
+                log(f"   {warehouse} → {zipcode} ({count} 条记录)")
+
+        log(f"✅ 有效数据: {len(valid_df)} 行")
 
-        # 9. 最终过滤（必须有坐标）
-        final_df = valid_df[
-            (valid_df['warehouse_lat'].notna()) &
-            (valid_df['destination_lat'].notna())
-        ].copy()
+        if len(valid_df) == 0:
+            print("❌ 没有有效数据!")
+            return None
 
-        print(f"🎯 最终数据（含坐标）: {len(final_df)} 行")
+        if VERBOSE_LOGGING:
+            date_counts = valid_df['shipment_ts'].dt.date.value_counts().sort_index()
+            log(f"📅 日期分布 ({len(date_counts)} 天):")
+            for date, count in date_counts.items():
+                log(f"   {date}: {count} 笔")
+
+        # 7. 获取所有邮编的坐标（本地邮编库批量解析，API仅用于未命中）
+        log(f"\n🌍 获取邮编坐标...")
+        all_zipcodes = pd.unique(pd.concat([
+            valid_df['fixed_warehouse_zipcode'],
+            valid_df['destination_zipcode']
+        ], ignore_index=True))
+
+        log(f"需要处理 {len(all_zipcodes)} 个唯一邮编")
+        progress('geocode', rows=len(all_zipcodes))
+
+        # 已知坐标直接复用：注册表中的仓库坐标，以及增量数据集中已解析过的邮编
+        registry_coords = warehouse_registry.coordinates()
+        if known_coords is None:
+            known_coords = registry_coords
+        else:
+            known_coords = pd.concat([registry_coords, known_coords[~known_coords.index.isin(registry_coords.index)]])
+        known = pd.Index(all_zipcodes).isin(known_coords.index)
+        zip_coords = self.gazetteer.lookup(all_zipcodes[~known]).set_index('zipcode')
+        misses = zip_coords.index[zip_coords['lat'].isna()].tolist()
+        log(f"📚 本地邮编库命中: {len(zip_coords) - len(misses)}/{len(zip_coords)}")
+        lookups = {'gazetteer': len(zip_coords) - len(misses)}
+        if known.any():
+            zip_coords = pd.concat([known_coords.loc[all_zipcodes[known], ['lat', 'lng']], zip_coords])
+            lookups['known'] = int(known.sum())
+            log(f"♻️ 已知邮编坐标: {int(known.sum())} 个")
+
+        if misses:
+            fetched = self.geocoder.geocode_many(misses, fetch=self.use_api_fallback).set_index('zipcode')
+            zip_coords.loc[fetched.index, ['lat', 'lng']] = fetched[['lat', 'lng']]
+            log(f"🌐 缓存/API补充解析: {int(fetched['lat'].notna().sum())}/{len(misses)}")
+            lookups.update(fetched['source'].value_counts().to_dict())
+
+        successful_coords = int(zip_coords['lat'].notna().sum())
+        success_rate = successful_coords / len(zip_coords) * 100
+        log(f"✅ 坐标获取成功率: {successful_coords}/{len(zip_coords)} ({success_rate:.1f}%)")
+        lookups['unresolved'] = len(zip_coords) - successful_coords
+        progress('geocode', rows_out=successful_coords, lookups={source: int(count) for source, count in lookups.items()})
+
+        # 8. 添加坐标（float32，约1米精度）
+        log("📍 添加坐标信息...")
+        progress('coordinates', rows=len(valid_df))
+
+        zip_lat = zip_coords['lat'].astype('float32')
+        zip_lng = zip_coords['lng'].astype('float32')
+        warehouse_lat = valid_df['fixed_warehouse_zipcode'].map(zip_lat).to_numpy(dtype='float32')
+        warehouse_lng = valid_df['fixed_warehouse_zipcode'].map(zip_lng).to_numpy(dtype='float32')
+        destination_lat = valid_df['destination_zipcode'].map(zip_lat).to_numpy(dtype='float32')
+        destination_lng = valid_df['destination_zipcode'].map(zip_lng).to_numpy(dtype='float32')
+
+        # 9. 最终过滤（必须有坐标）；布尔索引本身已生成新对象，不再额外复制
+        has_coords = ~np.isnan(warehouse_lat) & ~np.isnan(destination_lat)
+        final_df = valid_df[has_coords]
+
+        log(f"🎯 最终数据（含坐标）: {len(final_df)} 行")
+        progress('coordinates', rows_out=len(final_df))
 
         if len(final_df) == 0:
             print("❌ 没有数据包含有效坐标!")
             return None
 
         # 显示最终统计
-        print(f"\n📊 最终统计:")
-        final_warehouse_stats = final_df.groupby(['warehouse_name', 'fixed_warehouse_zipcode']).size().reset_index(name='count')
-        print("仓库分布:")
-        for _, row in final_warehouse_stats.iterrows():
-            warehouse_coord = self.coordinate_cache.get(row['fixed_warehouse_zipcode'], (None, None))
-            if warehouse_coord != (None, None):
-                print(f"   {row['warehouse_name']} ({row['fixed_warehouse_zipcode']}): {row['count']} 笔 → 坐标: {warehouse_coord}")
-
-        final_date_counts = final_df['shipment_date'].value_counts().sort_index()
-        print("日期分布:")
-        for date, count in final_date_counts.items():
-            print(f"   {date}: {count} 笔")
+        if VERBOSE_LOGGING:
+            log(f"\n📊 最终统计:")
+            final_warehouse_stats = final_df.groupby(['warehouse_name', 'fixed_warehouse_zipcode']).size()
+            log("仓库分布:")
+            for (warehouse, zipcode), count in final_warehouse_stats.items():
+                warehouse_coord = tuple(zip_coords.loc[zipcode, ['lat', 'lng']])
+                log(f"   {warehouse} ({zipcode}): {count} 笔 → 坐标: {warehouse_coord}")
+
+            final_date_counts = final_df['shipment_ts'].dt.date.value_counts().sort_index()
+            log("日期分布:")
+            for date, count in final_date_counts.items():
+                log(f"   {date}: {count} 笔")
 
         # 10. 创建Kepler数据集
-        print(f"\n📋 创建Kepler.gl数据集...")
+        log(f"\n📋 创建Kepler.gl数据集...")
+        progress('build_dataset', rows=len(final_df))
 
+        # 紧凑类型：低基数字符串用分类列，坐标和度量用float32，包裹数用整数，时间为datetime64
         kepler_data = pd.DataFrame({
             # 基本信息
             'shipment_id': final_df['id'],
-            'shipment_date': final_df['shipment_date'],
-            'shipment_datetime': final_df['shipment_datetime'],
-            'warehouse': final_df['warehouse_name'].fillna('Unknown'),
-            'warehouse_zipcode': final_df['fixed_warehouse_zipcode'],
+            'shipment_ts': final_df['shipment_ts'],
+            'shipment_date': format_datetimes(final_df['shipment_ts'], '%Y-%m-%d'),
+            'shipment_datetime': format_datetimes(final_df['shipment_ts'], '%Y-%m-%d %H:%M:%S'),
+            'warehouse': compact_category(final_df['warehouse_name'], 'Unknown'),
+            'warehouse_zipcode': compact_category(final_df['fixed_warehouse_zipcode']),
 
             # 坐标信息
-            'origin_lat': final_df['warehouse_lat'],
-            'origin_lng': final_df['warehouse_lng'],
-            'dest_lat': final_df['destination_lat'],
-            'dest_lng': final_df['destination_lng'],
+            'origin_lat': warehouse_lat[has_coords],
+            'origin_lng': warehouse_lng[has_coords],
+            'dest_lat': destination_lat[has_coords],
+            'dest_lng': destination_lng[has_coords],
 
             # 地址信息
-            'dest_zipcode': final_df['destination_zipcode'],
-            'dest_city': final_df['shipto_city'].fillna('Unknown'),
-            'dest_country': final_df['shipto_country_code'].fillna('US'),
+            'dest_zipcode': compact_category(final_df['destination_zipcode']),
+            'dest_city': compact_category(final_df['shipto_city'], 'Unknown'),
+            'dest_country': compact_category(final_df['shipto_country_code'], 'US'),
 
             # 业务信息
-            'carrier': final_df['carrier'].fillna('Unknown'),
-            'business_type': final_df.get('biz_type', pd.Series(['Standard'] * len(final_df))).fillna('Standard'),
-            'weight_kg': final_df.get('gw', pd.Series([1] * len(final_df))).fillna(1),
-            'volume_m3': final_df.get('vol', pd.Series([0.1] * len(final_df))).fillna(0.1),
-            'packages': final_df.get('pkg_num', pd.Series([1] * len(final_df))).fillna(1)
-        })
-
-        # 添加计算字段
-        kepler_data['distance_km'] = np.sqrt(
-            (kepler_data['dest_lat'] - kepler_data['origin_lat'])**2 +
-            (kepler_data['dest_lng'] - kepler_data['origin_lng'])**2
-        ) * 111
-
-        self.all_data = kepler_data
-
-        print(f"✅ Kepler数据集创建完成: {len(kepler_data)} 行")
-        print(f"📅 包含日期: {kepler_data['shipment_date'].nunique()} 天")
-        print(f"🏢 包含仓库: {kepler_data['warehouse'].nunique()} 个")
-        print(f"📍 包含目的地: {kepler_data['dest_city'].nunique()} 个")
-
-        return kepler_data
-
-        return kepler_data
-
-    def create_kepler_config_with_filters(self):
-        """创建包含过滤器的Kepler配置 - 完整Colab版本"""
-        return {
+            'carrier': compact_category(final_df['carrier'], 'Unknown'),
+            'business_type': compact_category(final_df['biz_type'], 'Standard'),
+            'weight_kg': final_df['gw'].fillna(1).astype('float32'),
+            'volume_m3': final_df['vol'].fillna(0.1).astype('float32'),
+            'packages': final_df['pkg_num'].fillna(1).round().astype('int32')
+        }, index=final_df.index)
+
+        # 添加计算字段（大圆距离；可选方位角、距离区间和吨公里）
+        distance, bearing = great_circle(
+            kepler_data['origin_lat'], kepler_data['origin_lng'],
+            kepler_data['dest_lat'], kepler_data['dest_lng'],
+            dtype=self.distance_dtype, bearing=self.route_metrics
+        )
+        kepler_data['distance_km'] = distance
+        if self.route_metrics:
+            kepler_data['bearing_deg'] = bearing
+            kepler_data['distance_band'] = distance_bands(distance)
+            ton_km = kepler_data['weight_kg'].to_numpy(dtype=self.distance_dtype, copy=True)
+            ton_km *= distance
+            ton_km /= 1000
+            kepler_data['ton_km'] = ton_km
+
+        dataset_bytes = frame_memory(kepler_data)
+        progress('build_dataset', rows_out=len(kepler_data), bytes=dataset_bytes)
+        log(f"✅ Kepler数据集创建完成: {len(kepler_data)} 行")
+        if VERBOSE_LOGGING:
+            log(f"📅 包含日期: {kepler_data['shipment_date'].nunique()} 天")
+            log(f"🏢 包含仓库: {kepler_data['warehouse'].nunique()} 个")
+            log(f"📍 包含目的地: {kepler_data['dest_city'].nunique()} 个")
+        log(f"💾 数据集内存: {dataset_bytes / 1024 ** 2:.1f} MB")
+
+        # 11. 数据量超过阈值时聚合为流向（仓库 → 目的地 × 日期桶），地图渲染流向而不是逐单弧线
+        flows = None
+        if self.flow_aggregation.should_aggregate(len(kepler_data)):
+            progress('aggregate', rows=len(kepler_data))
+            flows = self.flow_aggregation.aggregate(kepler_data)
+            progress('aggregate', rows_out=len(flows), bytes=frame_memory(flows))
+            log(f"🔀 流向聚合: {len(kepler_data)} 笔 → {len(flows)} 条流向 "
+                  f"(目的地: {self.flow_aggregation.dest_key}, 日期桶: {self.flow_aggregation.date_bucket})")
+
+        resolved_coords = zip_coords.loc[zip_coords['lat'].notna(), ['lat', 'lng']]
+        return ProcessingResult(kepler_data, warehouse_registry, report, flows, resolved_coords)
+
+    def create_kepler_config_with_filters(self, aggregated=False):
+        """创建包含过滤器的Kepler配置 - 完整Colab版本；aggregated=True 时弧线粗细按流向件数缩放"""
+        config = {
             'version': 'v1',
             'config': {
                 'mapState': {
@@ -441,45 +658,60 @@ class WarehouseFixedVisualizer:
             }
         }
 
-    def create_kepler_map(self):
+        if aggregated:
+            arc_layer = config['config']['visState']['layers'][0]
+            arc_layer['config']['label'] = 'Shipping Flows'
+            arc_layer['visualChannels'] = {
+                'sizeField': {'name': 'shipment_count', 'type': 'integer'},
+                'sizeScale': 'sqrt'
+            }
+
+        return config
+
+    def create_kepler_map(self, result):
         """创建包含所有数据的Kepler.gl地图 - 完整Colab版本"""
-        if self.all_data is None:
+        if result is None:
             return None
 
-        print(f"🗺️ 创建包含所有数据的Kepler.gl地图...")
-        print(f"📊 数据总量: {len(self.all_data)} 条运输记录")
+        log(f"🗺️ 创建包含所有数据的Kepler.gl地图...")
+        log(f"📊 数据总量: {len(result.kepler_data)} 条运输记录")
+        if result.aggregated:
+            log(f"🔀 地图使用聚合流向: {len(result.flows)} 条")
 
         # 显示warehouse分布
-        warehouse_stats = self.all_data.groupby(['warehouse', 'warehouse_zipcode']).size().reset_index(name='count')
-        print(f"\n🏢 仓库分布:")
-        for _, row in warehouse_stats.iterrows():
-            print(f"   {row['warehouse']} ({row['warehouse_zipcode']}): {row['count']} 笔")
+        if VERBOSE_LOGGING:
+            warehouse_stats = result.kepler_data.groupby(['warehouse', 'warehouse_zipcode'], observed=True).size()
+            log(f"\n🏢 仓库分布:")
+            for (warehouse, zipcode), count in warehouse_stats.items():
+                log(f"   {warehouse} ({zipcode}): {count} 笔")
 
         try:
             # 尝试使用标准方法创建地图
-            config = self.create_kepler_config_with_filters()
+            config = self.create_kepler_config_with_filters(aggregated=result.aggregated)
             map_instance = KeplerGl(height=700, width=1200, config=config)
-            map_instance.add_data(data=self.all_data, name='shipments')
+            map_instance.add_data(data=result.map_data, name='shipments')
 
-            print(f"\n✅ 地图创建完成!")
-            print(f"🎛️ 使用方法:")
-            print(f"   1. 地图显示所有仓库到目的地的运输路线")
-            print(f"   2. 绿色圆点 = 仓库位置（基于修复的邮编）")
-            print(f"   3. 蓝色圆点 = 目的地位置")
-            print(f"   4. 红色弧线 = 运输路线")
-            print(f"   5. 点击 'Filters' 添加日期、仓库、承运商等过滤器")
+            log(f"\n✅ 地图创建完成!")
+            log(f"🎛️ 使用方法:")
+            log(f"   1. 地图显示所有仓库到目的地的运输路线")
+            log(f"   2. 绿色圆点 = 仓库位置（基于修复的邮编）")
+            log(f"   3. 蓝色圆点 = 目的地位置")
+            log(f"   4. 红色弧线 = 运输路线")
+            log(f"   5. 点击 'Filters' 添加日期、仓库、承运商等过滤器")
 
             return map_instance
             
         except Exception as e:
             print(f"⚠️ 标准地图创建失败，使用备用方案: {e}")
             return "STANDALONE_HTML"  # 标记使用独立HTML
+
+    def create_standalone_kepler_html(self, result):
         """创建独立的Kepler.gl HTML（备用方案）"""
-        if self.all_data is None:
+        if result is None:
             return None
             
         # 将数据转换为JSON
-        data_json = self.all_data.to_json(orient='records')
+        data_json = result.map_data.to_json(orient='records')
         
         html_template = f"""
 <!DOCTYPE html>
@@ -592,7 +824,7 @@ class WarehouseFixedVisualizer:
                 id: 'map',
                 width: window.innerWidth,
                 height: window.innerHeight,
-                mapboxApiAccessToken: 'pk.eyJ1IjoieXV4dWFsYW4iLCJhIjoiY21idG03YmZlMDR2bDJxcHVoZjRjY2l2ciJ9.7NP8FWPFIAWtr7rLkhlc1A'
+                mapboxApiAccessToken: {json.dumps(MAPBOX_TOKEN)}
             }})
         );
         
@@ -617,9 +849,591 @@ class WarehouseFixedVisualizer:
         
         return html_template
 
-# 全局可视化器实例
+# 全局可视化器实例：不保存任何请求数据，只共享加锁的地理编码缓存和只读的邮编库
 visualizer = WarehouseFixedVisualizer()
 
+# 内容寻址的结果缓存（相同上传直接返回）
+result_cache = load_result_cache()
+
+# 后台任务队列
+job_manager = JobManager(
+    PIPELINE_STAGES,
+    max_workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_jobs=int(os.environ.get('JOB_MAX_STORED', 50)),
+    result_ttl=float(os.environ.get('JOB_RESULT_TTL', 3600))
+)
+
+# 进程内指标（/metrics）
+metrics = create_registry()
+
+# 可追加的地图数据集
+dataset_store = load_dataset_store()
+
+# 历史逐单数据（Parquet，按日期和仓库分区）；后台写入的结果（含失败）记入指标
+shipment_store = load_shipment_store(
+    on_write=lambda outcome, batches, rows: metrics.inc('shipment_store_batches_total', batches, outcome=outcome)
+)
+
+# /api/shipments 查询索引（按数据来源缓存）
+query_indexes = IndexCache(int(os.environ.get('QUERY_INDEX_CACHE_SIZE', 4)))
+
+# 时间回放的预计算动画帧（按数据来源和帧粒度缓存）
+animation_frames = IndexCache(int(os.environ.get('ANIMATION_FRAME_CACHE_SIZE', 4)))
+
+def open_upload_stream(stream, filename='', content_encoding=''):
+    """按Content-Encoding或文件后缀识别压缩格式，返回解压后的流"""
+    encoding = content_encoding.lower().strip()
+    name = filename.lower()
+
+    if not encoding:
+        if name.endswith('.gz'):
+            encoding = 'gzip'
+        elif name.endswith('.zst'):
+            encoding = 'zstd'
+
+    if encoding in ('', 'identity'):
+        return stream
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd uploads require the zstandard package on the server')
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise ValueError(f'Unsupported upload encoding: {encoding}')
+
+def spool_upload(stream, filename='', content_encoding=''):
+    """解压上传内容并写入临时文件，同时计算解压后内容的SHA-256；返回 (已回到开头的临时文件, 内容哈希)。
+    格式不支持时抛出ValueError，解压失败时抛出其他异常"""
+    hashing = HashingReader(open_upload_stream(stream, filename, content_encoding))
+    spool = tempfile.TemporaryFile(suffix='.csv')
+    try:
+        shutil.copyfileobj(hashing, spool, 1024 * 1024)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, hashing.hexdigest()
+
+def file_digest(path, filename='', content_encoding=''):
+    """已落盘上传文件解压后内容的SHA-256（与同步接口的缓存键和历史批次ID一致）"""
+    with open(path, 'rb') as raw:
+        hashing = HashingReader(open_upload_stream(raw, filename, content_encoding))
+        for _ in hashing:
+            pass
+    return hashing.hexdigest()
+
+def pipeline_settings():
+    """影响处理结果的流水线设置，参与结果缓存键的计算"""
+    return {
+        'pipeline_version': PIPELINE_VERSION,
+        'warehouse_registry': visualizer.warehouse_registry.current().version,
+        'max_rows': MAX_ROWS,
+        'flow_aggregation': visualizer.flow_aggregation.settings(),
+        'distance_dtype': visualizer.distance_dtype,
+        'route_metrics': visualizer.route_metrics,
+    }
+
+def request_cache_key(input_digest):
+    """输入内容哈希 → 结果缓存键（未启用结果缓存时返回None）"""
+    if result_cache is None or not input_digest:
+        return None
+    return content_key(input_digest, pipeline_settings())
+
+def wants_map_shell():
+    """本次请求是否使用分离模式（需要结果缓存保存数据集）"""
+    return request.args.get('mode', MAP_RESPONSE_MODE) == 'shell' and result_cache is not None
+
+def map_shell_payload(cache_key, stats, message):
+    """分离模式的响应：静态地图页地址 + 数据接口地址，不内嵌数据"""
+    return {
+        'map_url': f'/map-shell?key={cache_key}',
+        'data_url': f'/api/maps/{cache_key}/data',
+        'config_url': f'/api/maps/{cache_key}/config',
+        'stats': stats,
+        'message': message
+    }
+
+def wants_timings():
+    """请求是否要求在响应中附带分阶段耗时（?timings=1）"""
+    return request.args.get('timings') == '1'
+
+def observe_pipeline(timer, source):
+    """结束计时并记录到进程指标，返回各阶段记录"""
+    stages = timer.finish()
+    metrics.observe_pipeline(stages, source)
+    return stages
+
+def cached_visualization_response(cache_key, message):
+    """命中结果缓存时直接返回（If-None-Match匹配时返回304），未命中返回None"""
+    if cache_key is None:
+        return None
+    if not result_cache.contains(cache_key):
+        metrics.inc('result_cache_requests_total', outcome='miss')
+        return None
+    
+    if request.if_none_match.contains(cache_key):
+        metrics.inc('result_cache_requests_total', outcome='not_modified')
+        log(f"♻️ 结果未变化 (304): {cache_key[:12]}")
+        response = app.response_class(status=304)
+        response.set_etag(cache_key)
+        return response
+    
+    shell = wants_map_shell()
+    entry = result_cache.get(cache_key, load_data=False)
+    if entry is None:
+        return None
+    
+    if shell:
+        response_data = map_shell_payload(cache_key, entry['stats'], message)
+    else:
+        if entry['html'] is None:
+            # 该条目之前只以分离模式生成过，补渲染HTML
+            entry = result_cache.get(cache_key)
+            flows = entry['kepler_data'] if entry['stats'].get('aggregated') else None
+            result = ProcessingResult(entry['kepler_data'], None, flows=flows)
+            entry['html'] = render_map_html(result)
+            result_cache.put(cache_key, entry['kepler_data'], entry['html'], entry['stats'])
+        response_data = {
+            'html': entry['html'],
+            'stats': entry['stats'],
+            'message': message
+        }
+    
+    log(f"♻️ 结果缓存命中: {cache_key[:12]}")
+    metrics.inc('result_cache_requests_total', outcome='hit')
+    response_data['cached'] = True
+    response = jsonify(response_data)
+    response.set_etag(cache_key)
+    return response
+
+def read_request_body():
+    """解压后的请求体（gzip压缩时先解压）；结果缓存键按解压后的内容计算，与是否压缩及gzip头中的时间戳无关。
+    解压时最多读取 MAX_DECOMPRESSED_BYTES + 1 字节，超过上限抛出PayloadTooLargeError，不会先完整展开"""
+    body = request.get_data()
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as f:
+            body = f.read(MAX_DECOMPRESSED_BYTES + 1)
+        if len(body) > MAX_DECOMPRESSED_BYTES:
+            raise PayloadTooLargeError(f'Decompressed request body exceeds {MAX_DECOMPRESSED_BYTES} bytes')
+    return body
+
+def read_columnar_request(body=None):
+    """解析列式请求体（列式JSON或Arrow IPC，可gzip压缩；body为已解压的请求体），返回 (DataFrame, 文件名, 请求体字节数)"""
+    if body is None:
+        body = read_request_body()
+    if not body:
+        raise ValueError('No data received')
+    
+    if request.mimetype in ARROW_MIMETYPES:
+        import pyarrow as pa
+        filename = request.headers.get('X-Filename', 'unknown.arrow')
+        return pa.ipc.open_stream(body).read_pandas(), filename, len(body)
+    
+    payload = json.loads(body)
+    filename = payload.get('filename', 'unknown.csv')
+    return pd.DataFrame(payload.get('columns') or {}), filename, len(body)
+
+def serialize_map_data(kepler_data, fmt):
+    """把Kepler数据集序列化为CSV或Arrow IPC字节"""
+    if fmt == 'arrow':
+        import pyarrow as pa
+        table = pa.Table.from_pandas(kepler_data, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    return kepler_data.to_csv(index=False).encode('utf-8')
+
+def map_data_encoding():
+    """按Accept-Encoding选择地图数据的压缩方式：br（已安装brotli时）> gzip > identity（不压缩）"""
+    if brotli is not None and 'br' in request.accept_encodings:
+        return 'br'
+    if 'gzip' in request.accept_encodings:
+        return 'gzip'
+    return 'identity'
+
+def compress_map_data(raw, encoding):
+    if encoding == 'br':
+        return brotli.compress(raw, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(raw, compresslevel=6)
+    return raw
+
+def map_data_response(body, fmt, encoding):
+    """已按encoding压缩的地图数据响应：记录字节数指标，设置 Content-Encoding（identity时不设置）和 Vary"""
+    metrics.inc('map_data_bytes_total', len(body), format=fmt, encoding=encoding)
+    response = app.response_class(body, mimetype=MAP_DATA_MIMETYPES[fmt])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def compressed_map_data_response(raw, fmt):
+    """按客户端支持的压缩方式压缩序列化后的地图数据并返回响应"""
+    encoding = map_data_encoding()
+    return map_data_response(compress_map_data(raw, encoding), fmt, encoding)
+
+def render_map_html(result):
+    """为处理结果创建Kepler.gl地图并返回HTML字符串"""
+    map_instance = visualizer.create_kepler_map(result)
+    
+    if map_instance is None:
+        return None
+    
+    # 检查是否需要使用备用HTML
+    if map_instance == "STANDALONE_HTML":
+        log("📋 使用独立HTML方案...")
+        return visualizer.create_standalone_kepler_html(result)
+    
+    # 获取HTML并确保包含所有必要的依赖（keplergl返回UTF-8字节）
+    map_html = map_instance._repr_html_()
+    if isinstance(map_html, bytes):
+        map_html = map_html.decode('utf-8')
+    
+    # 检查并修复HTML，确保包含必要的样式和脚本
+    if '<head>' in map_html and 'kepler.gl' in map_html:
+        # 添加额外的样式确保地图正确显示
+        additional_styles = """
+        <style>
+            .kepler-gl .side-panel--container {
+                display: block !important;
+            }
+            .kepler-gl .map-container {
+                position: relative !important;
+            }
+            .kepler-gl {
+                height: 700px !important;
+                width: 100% !important;
+            }
+        </style>
+        """
+        map_html = map_html.replace('</head>', additional_styles + '</head>')
+    
+    return map_html
+
+def visualization_response(result, message, cache_key=None, timer=None):
+    """根据处理结果生成地图HTML和统计信息的JSON响应；给出cache_key时写入结果缓存并设置ETag，
+    给出timer时记录渲染阶段并写入进程指标（?timings=1 时在响应中附带分阶段耗时）"""
+    timer = timer or PipelineTimer()
+    
+    # 分离模式：不渲染HTML，数据集写入结果缓存后由 /api/maps/<key>/data 提供
+    if cache_key and wants_map_shell():
+        stats = result.stats()
+        result_cache.put(cache_key, result.map_data, None, stats)
+        log(f"🗺️ 分离模式: 地图页 /map-shell?key={cache_key[:12]}...")
+        response_data = map_shell_payload(cache_key, stats, message)
+        stages = observe_pipeline(timer, request.endpoint)
+        if wants_timings():
+            response_data['timings'] = {'stages': stages, 'total_seconds': timer.total_seconds()}
+        response = jsonify(response_data)
+        response.set_etag(cache_key)
+        return response
+    
+    # 创建Kepler地图
+    try:
+        log("🗺️ 创建Kepler.gl地图...")
+        timer('render_map', rows=len(result.map_data))
+        map_html = render_map_html(result)
+        
+        if map_html is None:
+            return jsonify({'error': 'Failed to create map visualization'}), 500
+        
+        timer('render_map', bytes=len(map_html.encode('utf-8')))
+        log("✅ 地图HTML生成成功")
+        log(f"📊 HTML大小: {len(map_html)} 字符")
+        
+    except Exception as e:
+        print(f"❌ 地图创建失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Map creation failed: {str(e)}'}), 500
+    
+    # 统计信息 - 确保所有值都是可序列化的
+    try:
+        stats = result.stats()
+        log(f"📊 统计信息: {stats}")
+        
+    except Exception as e:
+        print(f"❌ 统计信息生成失败: {e}")
+        stats = {
+            'total_records': int(len(result.kepler_data)),
+            'unique_warehouses': 0,
+            'unique_destinations': 0,
+            'date_range': 'Unknown'
+        }
+    
+    # 写入结果缓存（失败不影响本次响应）
+    if cache_key and result_cache is not None:
+        try:
+            result_cache.put(cache_key, result.map_data, str(map_html), stats)
+        except Exception as e:
+            print(f"⚠️ 结果缓存写入失败: {e}")
+    
+    # 最终返回JSON - 确保所有内容都可序列化
+    try:
+        response_data = {
+            'html': str(map_html),  # 确保HTML是字符串
+            'stats': stats,
+            'message': message
+        }
+        stages = observe_pipeline(timer, request.endpoint)
+        if wants_timings():
+            response_data['timings'] = {'stages': stages, 'total_seconds': timer.total_seconds()}
+        
+        log(f"✅ 准备返回响应，数据大小: {len(str(map_html))} 字符")
+        response = jsonify(response_data)
+        if cache_key:
+            response.set_etag(cache_key)
+        return response
+        
+    except Exception as e:
+        print(f"❌ JSON序列化失败: {e}")
+        return jsonify({
+            'error': f'Response serialization failed: {str(e)}',
+            'stats': {
+                'total_records': int(len(result.kepler_data)),
+                'unique_warehouses': 0,
+                'unique_destinations': 0,
+                'date_range': 'Unknown'
+            }
+        }), 500
+
+def run_visualization_job(df=None, path=None, filename='', content_encoding='', input_digest=None, progress=None):
+    """后台任务：处理数据并渲染地图，返回与同步接口相同的结果结构（附带分阶段耗时）；
+    input_digest 为输入内容的哈希（上传文件时在任务中计算）"""
+    timer = PipelineTimer(forward=progress)
+    if input_digest is None and path is not None:
+        input_digest = file_digest(path, filename, content_encoding)
+    if df is not None:
+        result = visualizer.process_data(df, sample_size=MAX_ROWS, progress=timer)
+    else:
+        with open(path, 'rb') as raw:
+            stream = open_upload_stream(raw, filename, content_encoding)
+            # 未压缩的大文件且不限行数时多进程分片清洗（压缩流无法按字节范围切分）
+            if stream is raw and MAX_ROWS is None and visualizer.shard_pool.should_use(path):
+                result = visualizer.process_csv_parallel(
+                    path,
+                    progress=timer,
+                    usecols=lambda col: col in INGEST_DTYPES,
+                    dtype=INGEST_DTYPES
+                )
+            else:
+                result = visualizer.process_csv(
+                    stream,
+                    max_rows=MAX_ROWS,
+                    progress=timer,
+                    usecols=lambda col: col in INGEST_DTYPES,
+                    dtype=INGEST_DTYPES
+                )
+    
+    if result is None:
+        raise ValueError('No valid data found after processing. Please check your CSV format.')
+    
+    persist_shipments(result, input_digest, timer)
+    timer('render_map', rows=len(result.map_data))
+    map_html = render_map_html(result)
+    if map_html is None:
+        raise ValueError('Failed to create map visualization')
+    timer('render_map', bytes=len(map_html.encode('utf-8')))
+    
+    stages = observe_pipeline(timer, 'job')
+    return {
+        'html': map_html,
+        'stats': result.stats(),
+        'message': 'Data processed successfully in background job',
+        'timings': {'stages': stages, 'total_seconds': timer.total_seconds()}
+    }
+
+def persist_shipments(result, batch_id, progress=report_nothing):
+    """把处理后的逐单数据放入历史存储的写入队列（后台线程攒批写入，不占用本次请求的时间）；
+    batch_id 为输入内容的哈希，相同内容重复提交时不会重复入库"""
+    if shipment_store is None:
+        return
+    progress('persist', rows=len(result.kepler_data))
+    shipment_store.submit(result.kepler_data, batch_id)
+    log(f"🗄️ 历史数据已加入写入队列: {len(result.kepler_data)} 行")
+
+def visualize_dataframe(df, message, cache_key=None, input_digest=None):
+    """处理DataFrame、生成Kepler地图HTML并返回JSON响应；input_digest（请求内容的哈希）作为历史数据的批次ID"""
+    # 处理数据（结果归本次请求所有，并发请求互不干扰）
+    timer = PipelineTimer()
+    try:
+        result = visualizer.process_data(df, sample_size=MAX_ROWS, progress=timer)
+    except Exception as e:
+        print(f"❌ 数据处理失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Data processing failed: {str(e)}'}), 500
+    
+    if result is None:
+        return jsonify({'error': 'No valid data found after processing. Please check your CSV format.'}), 400
+    
+    persist_shipments(result, input_digest, timer)
+    return visualization_response(result, message, cache_key, timer)
+
+def process_dataset_request(known_coords=None, progress=None):
+    """处理数据集请求体（列式JSON/Arrow或CSV上传），known_coords中已有的邮编不再地理编码；
+    返回 (处理结果, 输入内容的哈希)，无有效数据时处理结果为None"""
+    if request.mimetype == 'application/json' or request.mimetype in ARROW_MIMETYPES:
+        body = read_request_body()
+        df, filename, _ = read_columnar_request(body)
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+        if missing_columns:
+            raise MissingColumnsError(
+                f'Missing required columns: {missing_columns}. Available columns: {list(df.columns)}'
+            )
+        log(f"📂 数据集批次: {filename}, {len(df)} 行")
+        result = visualizer.process_data(df, sample_size=MAX_ROWS, progress=progress, known_coords=known_coords)
+        return result, hashlib.sha256(body).hexdigest()
+    
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            raise ValueError('No file uploaded')
+        file = request.files['file']
+        filename = file.filename or 'upload.csv'
+        stream = file.stream
+    else:
+        filename = request.headers.get('X-Filename', 'upload.csv')
+        stream = request.stream
+    
+    log(f"📂 数据集批次: {filename}")
+    spool, input_digest = spool_upload(stream, filename, request.headers.get('Content-Encoding', ''))
+    with spool:
+        result = visualizer.process_csv(
+            spool,
+            max_rows=MAX_ROWS,
+            progress=progress,
+            known_coords=known_coords,
+            usecols=lambda col: col in INGEST_DTYPES,
+            dtype=INGEST_DTYPES
+        )
+    return result, input_digest
+
+def dataset_summary(kepler_data, previous=None):
+    """数据集的累计统计（仓库/目的地城市集合、时间范围、记录数），追加时与已有统计合并，不需要重新读取全部数据"""
+    previous = previous or {'warehouses': [], 'dest_cities': [], 'min_ts': None, 'max_ts': None, 'total_records': 0}
+    timestamps = [ts for ts in (previous['min_ts'], previous['max_ts']) if ts is not None]
+    timestamps += [ts.isoformat() for ts in (kepler_data['shipment_ts'].min(), kepler_data['shipment_ts'].max()) if pd.notna(ts)]
+    return {
+        'warehouses': sorted(set(previous['warehouses']) | set(kepler_data['warehouse'].dropna().unique().tolist())),
+        'dest_cities': sorted(set(previous['dest_cities']) | set(kepler_data['dest_city'].dropna().unique().tolist())),
+        'min_ts': min(timestamps) if timestamps else None,
+        'max_ts': max(timestamps) if timestamps else None,
+        'total_records': previous['total_records'] + int(len(kepler_data)),
+    }
+
+def dataset_stats(meta, map_rows=None):
+    """数据集的前端统计信息（与 ProcessingResult.stats 字段一致）"""
+    summary = meta['summary']
+    if summary['min_ts'] is None:
+        date_range = "Unknown date range"
+    else:
+        date_range = f"{summary['min_ts'][:10]} → {summary['max_ts'][:10]}"
+    return {
+        'total_records': summary['total_records'],
+        'unique_warehouses': len(summary['warehouses']),
+        'unique_destinations': len(summary['dest_cities']),
+        'date_range': date_range,
+        'aggregated': summary['aggregated'],
+        'map_rows': summary['map_rows'] if map_rows is None else map_rows,
+        'parts': meta['parts']
+    }
+
+def kepler_rows(map_data):
+    """地图数据 → Kepler的 {fields, rows} 格式（时间为ISO字符串）"""
+    payload = json.loads(map_data.to_json(orient='split', index=False, date_format='iso'))
+    return {
+        'fields': [{'name': column} for column in payload['columns']],
+        'rows': payload['data']
+    }
+
+def dataset_payload(dataset_id, meta, **extra):
+    return {
+        'dataset_id': dataset_id,
+        'map_url': f'/map-shell?dataset={dataset_id}',
+        'data_url': f'/api/datasets/{dataset_id}/data',
+        'config_url': f'/api/datasets/{dataset_id}/config',
+        'append_url': f'/api/datasets/{dataset_id}/append',
+        'playback_url': f'/map-shell?dataset={dataset_id}&playback=day',
+        'stats': dataset_stats(meta),
+        **extra
+    }
+
+def parse_time_window():
+    """?from=&to= → [start, end)；只给日期时 to 包含当天"""
+    start = request.args.get('from') or None
+    end = request.args.get('to') or None
+    if start is not None:
+        start = pd.Timestamp(start)
+    if end is not None:
+        end_text = end
+        end = pd.Timestamp(end)
+        if len(end_text) <= 10:
+            end += pd.Timedelta(days=1)
+    return start, end
+
+def parse_bbox():
+    """?bbox=min_lng,min_lat,max_lng,max_lat（目的地坐标范围）"""
+    if not request.args.get('bbox'):
+        return None
+    bbox = [float(value) for value in request.args['bbox'].split(',')]
+    if len(bbox) != 4:
+        raise ValueError('bbox must be min_lng,min_lat,max_lng,max_lat')
+    return bbox
+
+def query_source(start, end, columns=None):
+    """查询的数据来源：?dataset=<id>（可追加数据集）、?key=<地图键>（结果缓存）或历史存储（按日期/仓库裁剪分区，
+    只读取columns列），返回 (来源ID, 读取函数)，来源不存在时返回 (None, 错误信息)"""
+    if request.args.get('dataset'):
+        dataset_id = request.args['dataset']
+        meta = dataset_store.meta(dataset_id)
+        if meta is None:
+            return None, 'Dataset not found'
+        return f'dataset:{dataset_id}:{meta["parts"]}', lambda: dataset_store.load_rows(dataset_id)
+    
+    if request.args.get('key'):
+        key = request.args['key']
+        if result_cache is None or not result_cache.contains(key):
+            return None, 'Map not found'
+        return f'map:{key}', lambda: result_cache.get(key)['kepler_data']
+    
+    if shipment_store is None:
+        return None, 'Shipment store is disabled'
+    warehouses = [pattern.strip() for pattern in request.args.get('warehouse', '').split(',') if pattern.strip()]
+    files = shipment_store.partitions(
+        start.strftime('%Y-%m-%d') if start is not None else None,
+        (end - pd.Timedelta(microseconds=1)).strftime('%Y-%m-%d') if end is not None else None,
+        warehouses
+    )
+    if not files:
+        return None, 'No stored shipments match the query'
+    fingerprint = hashlib.sha256(json.dumps(shipment_store.fingerprint(files)).encode('utf-8')).hexdigest()
+    return f'history:{fingerprint}', lambda: shipment_store.read(files, columns=columns)
+
+def request_animation_frames(timer):
+    """按请求参数取动画帧：来源与 /api/shipments 相同，?bucket=day|hour 为帧粒度；
+    返回 (帧, 来源ID)，来源不存在时返回 (None, 错误信息)"""
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in FRAME_BUCKETS:
+        raise ValueError(f'Unsupported frame bucket: {bucket}')
+    start, end = parse_time_window()
+    source_id, load = query_source(start, end, columns=FLOW_INPUT_COLUMNS)
+    if source_id is None:
+        return None, load
+    aggregation = visualizer.flow_aggregation
+    
+    def build_frames():
+        timer('build_frames')
+        frames = AnimationFrames(load(), bucket, aggregation.dest_key, aggregation.geohash_precision, aggregation.date_bucket)
+        timer('build_frames', rows_out=len(frames.flows), bytes=frames.nbytes)
+        log(f"🎞️ 动画帧已生成: {source_id[:40]} ({len(frames)} 帧, {len(frames.flows)} 条流向)")
+        return frames
+    
+    frames, _ = animation_frames.get(f'{source_id}:{bucket}', build_frames)
+    return frames, f'{source_id}:{bucket}'
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -628,8 +1442,24 @@ def index():
 def process_data():
     """处理前端发送的JSON数据"""
     try:
+        message = 'Data processed successfully using frontend CSV parsing + backend visualization'
+        try:
+            body = read_request_body()
+        except PayloadTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        except Exception as e:
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
+        input_digest = hashlib.sha256(body).hexdigest()
+        cache_key = request_cache_key(input_digest)
+        cached = cached_visualization_response(cache_key, message)
+        if cached is not None:
+            return cached
+        
         # 获取JSON数据
-        data = request.get_json()
+        try:
+            data = json.loads(body) if body else None
+        except ValueError as e:
+            return jsonify({'error': f'Invalid JSON: {str(e)}'}), 400
         
         if not data:
             return jsonify({'error': 'No data received'}), 400
@@ -638,9 +1468,9 @@ def process_data():
         headers = data.get('headers', [])
         csv_data = data.get('data', [])
         
-        print(f"📂 接收到数据处理请求: {filename}")
-        print(f"📊 数据: {len(csv_data)} 行, {len(headers)} 列")
-        print(f"📋 列名: {headers}")
+        log(f"📂 接收到数据处理请求: {filename}")
+        log(f"📊 数据: {len(csv_data)} 行, {len(headers)} 列")
+        log(f"📋 列名: {headers}")
         
         if not csv_data:
             return jsonify({'error': 'No data to process'}), 400
@@ -665,11 +1495,10 @@ def process_data():
                 cleaned_data.append(cleaned_row)
             
             df = pd.DataFrame(cleaned_data)
-            print(f"✅ DataFrame创建成功: {len(df)} 行")
+            log(f"✅ DataFrame创建成功: {len(df)} 行")
             
             # 检查必要的列
-            required_columns = ['warehouse_name', 'created_time', 'shipto_postal_code']
-            missing_columns = [col for col in required_columns if col not in df.columns]
+            missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
             
             if missing_columns:
                 return jsonify({
@@ -682,114 +1511,52 @@ def process_data():
             traceback.print_exc()
             return jsonify({'error': f'Failed to create DataFrame: {str(e)}'}), 400
         
-        # 处理数据
-        try:
-            processed_data = visualizer.process_data(df, sample_size=100)
-        except Exception as e:
-            print(f"❌ 数据处理失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'error': f'Data processing failed: {str(e)}'}), 500
-        
-        if processed_data is None:
-            return jsonify({'error': 'No valid data found after processing. Please check your CSV format.'}), 400
+        return visualize_dataframe(df, message, cache_key, input_digest)
         
-        # 创建Kepler地图
+    except Exception as e:
+        print(f"❌ 数据处理失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
+
+@app.route('/api/process-columns', methods=['POST'])
+def process_columns():
+    """按列接收数据（列式JSON或Arrow IPC，支持gzip请求体），直接构建DataFrame"""
+    try:
+        message = 'Data processed successfully using columnar transport + backend visualization'
         try:
-            print("🗺️ 创建Kepler.gl地图...")
-            map_instance = visualizer.create_kepler_map()
-            
-            if map_instance is None:
-                return jsonify({'error': 'Failed to create map visualization'}), 500
-            
-            # 检查是否需要使用备用HTML
-            if map_instance == "STANDALONE_HTML":
-                print("📋 使用独立HTML方案...")
-                map_html = visualizer.create_standalone_kepler_html()
-            else:
-                # 获取HTML并确保包含所有必要的依赖
-                map_html = map_instance._repr_html_()
-                
-                # 检查并修复HTML，确保包含必要的样式和脚本
-                if '<head>' in map_html and 'kepler.gl' in map_html:
-                    # 添加额外的样式确保地图正确显示
-                    additional_styles = """
-                    <style>
-                        .kepler-gl .side-panel--container {
-                            display: block !important;
-                        }
-                        .kepler-gl .map-container {
-                            position: relative !important;
-                        }
-                        .kepler-gl {
-                            height: 700px !important;
-                            width: 100% !important;
-                        }
-                    </style>
-                    """
-                    map_html = map_html.replace('</head>', additional_styles + '</head>')
-            
-            print("✅ 地图HTML生成成功")
-            print(f"📊 HTML大小: {len(map_html)} 字符")
-            
+            body = read_request_body()
+        except PayloadTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
         except Exception as e:
-            print(f"❌ 地图创建失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'error': f'Map creation failed: {str(e)}'}), 500
+            return jsonify({'error': f'Invalid request body: {str(e)}'}), 400
+        input_digest = hashlib.sha256(body).hexdigest()
+        cache_key = request_cache_key(input_digest)
+        cached = cached_visualization_response(cache_key, message)
+        if cached is not None:
+            return cached
         
-        # 统计信息 - 确保所有值都是可序列化的
         try:
-            # 安全地转换日期范围
-            min_date = processed_data['shipment_date'].min()
-            max_date = processed_data['shipment_date'].max()
-            
-            # 确保日期是字符串类型
-            if pd.isna(min_date) or pd.isna(max_date):
-                date_range = "Unknown date range"
-            else:
-                date_range = f"{str(min_date)} → {str(max_date)}"
-            
-            stats = {
-                'total_records': int(len(processed_data)),
-                'unique_warehouses': int(processed_data['warehouse'].nunique()),
-                'unique_destinations': int(processed_data['dest_city'].nunique()),
-                'date_range': date_range
-            }
-            
-            print(f"📊 统计信息: {stats}")
-            
+            df, filename, body_size = read_columnar_request(body)
+        except ImportError:
+            return jsonify({'error': 'Arrow payloads require pyarrow on the server'}), 415
         except Exception as e:
-            print(f"❌ 统计信息生成失败: {e}")
-            stats = {
-                'total_records': int(len(processed_data)) if processed_data is not None else 0,
-                'unique_warehouses': 0,
-                'unique_destinations': 0,
-                'date_range': 'Unknown'
-            }
+            print(f"❌ DataFrame创建失败: {e}")
+            return jsonify({'error': f'Failed to create DataFrame: {str(e)}'}), 400
         
-        # 最终返回JSON - 确保所有内容都可序列化
-        try:
-            response_data = {
-                'html': str(map_html),  # 确保HTML是字符串
-                'stats': stats,
-                'message': 'Data processed successfully using frontend CSV parsing + backend visualization'
-            }
-            
-            print(f"✅ 准备返回响应，数据大小: {len(str(map_html))} 字符")
-            return jsonify(response_data)
-            
-        except Exception as e:
-            print(f"❌ JSON序列化失败: {e}")
+        log(f"📂 接收到列式数据处理请求: {filename}")
+        log(f"📊 数据: {len(df)} 行, {len(df.columns)} 列 (请求体 {body_size} 字节)")
+        
+        if df.empty:
+            return jsonify({'error': 'No data to process'}), 400
+        
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+        if missing_columns:
             return jsonify({
-                'error': f'Response serialization failed: {str(e)}',
-                'stats': {
-                    'total_records': int(len(processed_data)) if processed_data is not None else 0,
-                    'unique_warehouses': 0,
-                    'unique_destinations': 0,
-                    'date_range': 'Unknown'
-                }
-            }), 500
+                'error': f'Missing required columns: {missing_columns}. Available columns: {list(df.columns)}'
+            }), 400
+        
+        return visualize_dataframe(df, message, cache_key, input_digest)
         
     except Exception as e:
         print(f"❌ 数据处理失败: {e}")
@@ -799,88 +1566,441 @@ def process_data():
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    """保留原有的文件上传功能作为备用"""
+    """流式上传CSV：multipart文件或原始请求体（支持gzip/zstd压缩），分块解析"""
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file uploaded'}), 400
+        if request.mimetype == 'multipart/form-data':
+            if 'file' not in request.files:
+                return jsonify({'error': 'No file uploaded'}), 400
+            
+            file = request.files['file']
+            if file.filename == '':
+                return jsonify({'error': 'No file selected'}), 400
+            
+            filename = file.filename
+            stream = file.stream
+        else:
+            # 原始请求体直接流入CSV解析器，不落盘
+            filename = request.headers.get('X-Filename', 'upload.csv')
+            stream = request.stream
         
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+        log(f"📂 接收到文件上传请求: {filename}")
+        message = 'Warehouse locations automatically fixed based on ID patterns'
         
-        print("📂 接收到文件上传请求（备用方式）")
+        # 客户端提供了内容哈希（解压后CSV的SHA-256）时，可在读取上传内容前命中缓存
+        cached = cached_visualization_response(request_cache_key(request.headers.get('X-Content-SHA256', '').lower()), message)
+        if cached is not None:
+            return cached
         
-        # 保存临时文件
-        with tempfile.NamedTemporaryFile(mode='w+b', suffix='.csv', delete=False) as tmp_file:
-            file.save(tmp_file.name)
-            print(f"📁 文件已保存到临时位置: {tmp_file.name}")
-            
-            # 读取CSV
-            try:
-                df = pd.read_csv(tmp_file.name)
-                print(f"📊 成功读取CSV: {len(df)} 行, {len(df.columns)} 列")
-                print(f"📋 列名: {list(df.columns)}")
-            except Exception as e:
-                return jsonify({'error': f'Failed to read CSV file: {str(e)}'}), 400
+        # 解压后的内容边计算哈希边写入临时文件：先按完整内容的哈希查缓存，命中时不再解析；
+        # 未命中时从临时文件分块解析（内存占用与直接流式解析相同）
+        try:
+            spool, input_digest = spool_upload(stream, filename, request.headers.get('Content-Encoding', ''))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 415
+        except Exception as e:
+            return jsonify({'error': f'Failed to read upload: {str(e)}'}), 400
+        
+        with spool:
+            cache_key = request_cache_key(input_digest)
+            cached = cached_visualization_response(cache_key, message)
+            if cached is not None:
+                return cached
+            spool.seek(0)
             
-            # 处理数据
+            # 分块处理数据
+            timer = PipelineTimer()
             try:
-                processed_data = visualizer.process_data(df, sample_size=200)
+                result = visualizer.process_csv(
+                    spool,
+                    max_rows=MAX_ROWS,
+                    progress=timer,
+                    usecols=lambda col: col in INGEST_DTYPES,
+                    dtype=INGEST_DTYPES
+                )
+            except MissingColumnsError as e:
+                return jsonify({'error': str(e)}), 400
+            except pd.errors.EmptyDataError:
+                # 空请求体/空文件（没有表头）是客户端错误
+                return jsonify({'error': 'Uploaded file is empty'}), 400
             except Exception as e:
                 print(f"❌ 数据处理失败: {e}")
                 import traceback
                 traceback.print_exc()
                 return jsonify({'error': f'Data processing failed: {str(e)}'}), 500
+        
+        if result is None:
+            return jsonify({'error': 'No valid data found after processing. Please check your CSV format.'}), 400
+        
+        persist_shipments(result, input_digest, timer)
+        return visualization_response(result, message, cache_key, timer)
             
-            if processed_data is None:
-                return jsonify({'error': 'No valid data found after processing. Please check your CSV format.'}), 400
-            
-            # 创建Kepler地图
+    except Exception as e:
+        print(f"❌ 上传处理失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Upload processing failed: {str(e)}'}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """提交后台可视化任务，立即返回任务ID（支持列式JSON/Arrow或CSV上传）"""
+    try:
+        if request.mimetype == 'application/json' or request.mimetype in ARROW_MIMETYPES:
             try:
-                print("🗺️ 创建Kepler.gl地图...")
-                map_instance = visualizer.create_kepler_map()
-                
-                if map_instance is None:
-                    return jsonify({'error': 'Failed to create map visualization'}), 500
-                
-                # 获取HTML
-                map_html = map_instance._repr_html_()
-                print("✅ 地图HTML生成成功")
-                
+                body = read_request_body()
+                df, filename, _ = read_columnar_request(body)
+            except PayloadTooLargeError as e:
+                return jsonify({'error': str(e)}), 413
+            except ImportError:
+                return jsonify({'error': 'Arrow payloads require pyarrow on the server'}), 415
             except Exception as e:
-                print(f"❌ 地图创建失败: {e}")
-                import traceback
-                traceback.print_exc()
-                return jsonify({'error': f'Map creation failed: {str(e)}'}), 500
+                return jsonify({'error': f'Failed to create DataFrame: {str(e)}'}), 400
             
-            # 统计信息
-            stats = {
-                'total_records': len(processed_data),
-                'unique_warehouses': processed_data['warehouse'].nunique(),
-                'unique_destinations': processed_data['dest_city'].nunique(),
-                'date_range': f"{processed_data['shipment_date'].min()} → {processed_data['shipment_date'].max()}"
-            }
+            missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+            if missing_columns:
+                return jsonify({
+                    'error': f'Missing required columns: {missing_columns}. Available columns: {list(df.columns)}'
+                }), 400
             
-            print(f"📊 统计信息: {stats}")
+            job = job_manager.submit(filename, run_visualization_job, df=df, input_digest=hashlib.sha256(body).hexdigest())
+        else:
+            if request.mimetype == 'multipart/form-data':
+                if 'file' not in request.files:
+                    return jsonify({'error': 'No file uploaded'}), 400
+                file = request.files['file']
+                filename = file.filename or 'upload.csv'
+                stream = file.stream
+            else:
+                filename = request.headers.get('X-Filename', 'upload.csv')
+                stream = request.stream
             
-            # 清理临时文件
-            try:
-                os.unlink(tmp_file.name)
-                print("🗑️ 临时文件已清理")
-            except:
-                pass
+            # 请求结束后流不可再读，先原样（保持压缩）写入临时文件，由任务线程分块解析
+            with tempfile.NamedTemporaryFile(mode='wb', suffix='.upload', delete=False) as tmp_file:
+                shutil.copyfileobj(stream, tmp_file)
             
-            return jsonify({
-                'html': map_html,
-                'stats': stats,
-                'message': 'Warehouse locations automatically fixed based on ID patterns'
-            })
+            job = job_manager.submit(
+                filename,
+                run_visualization_job,
+                path=tmp_file.name,
+                filename=filename,
+                content_encoding=request.headers.get('Content-Encoding', ''),
+                cleanup=lambda: os.unlink(tmp_file.name)
+            )
+        
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/api/jobs/{job.id}',
+            'result_url': f'/api/jobs/{job.id}/result'
+        }), 202
+        
+    except Exception as e:
+        print(f"❌ 任务提交失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Job submission failed: {str(e)}'}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查询任务状态和阶段进度"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """取消任务"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """获取任务结果（地图HTML和统计信息）"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job.status == 'done':
+        return jsonify(job.result)
+    if job.status == 'failed':
+        return jsonify({'error': job.error, 'status': job.status}), 500
+    if job.status == 'cancelled':
+        return jsonify({'error': 'Job was cancelled', 'status': job.status}), 409
+    return jsonify(job.to_dict()), 202
+
+@app.route('/map-shell')
+def map_shell():
+    """静态地图页（不含数据，可被浏览器长期缓存）"""
+    response = app.make_response(render_template('map_shell.html', mapbox_token=MAPBOX_TOKEN))
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@app.route('/api/maps/<key>/config')
+def map_config(key):
+    """地图的Kepler配置"""
+    entry = result_cache.get(key, load_data=False) if result_cache is not None else None
+    if entry is None:
+        return jsonify({'error': 'Map not found'}), 404
+    response = jsonify(visualizer.create_kepler_config_with_filters(aggregated=entry['stats'].get('aggregated', False)))
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/api/maps/<key>/data')
+def map_data(key):
+    """地图数据集（CSV或Arrow，brotli/gzip压缩）；内容按键寻址，可永久缓存"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in MAP_DATA_MIMETYPES:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    if result_cache is None or not result_cache.contains(key):
+        return jsonify({'error': 'Map not found'}), 404
+    
+    etag = f'{key}-{fmt}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    encoding = map_data_encoding()
+    blob_name = f'data.{fmt}.{encoding}'
+    body = result_cache.get_blob(key, blob_name)
+    
+    if body is None:
+        entry = result_cache.get(key)
+        if entry is None:
+            return jsonify({'error': 'Map not found'}), 404
+        raw = serialize_map_data(entry['kepler_data'], fmt)
+        body = compress_map_data(raw, encoding)
+        result_cache.put_blob(key, blob_name, body)
+        log(f"📦 地图数据序列化: {len(raw)} → {len(body)} 字节 ({fmt}, {encoding})")
+    
+    response = map_data_response(body, fmt, encoding)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/datasets', methods=['POST'])
+def create_dataset():
+    """创建可追加的地图数据集（列式JSON/Arrow或CSV上传），返回数据集ID和数据接口地址"""
+    timer = PipelineTimer()
+    try:
+        result, input_digest = process_dataset_request(progress=timer)
+    except PayloadTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except ImportError:
+        return jsonify({'error': 'Arrow payloads require pyarrow on the server'}), 415
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ 数据处理失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Data processing failed: {str(e)}'}), 500
+    
+    if result is None:
+        return jsonify({'error': 'No valid data found after processing. Please check your CSV format.'}), 400
+    
+    summary = dataset_summary(result.kepler_data)
+    summary['aggregated'] = result.aggregated
+    summary['map_rows'] = int(len(result.map_data))
+    dataset_id = dataset_store.create(result.kepler_data, result.flows, result.zip_coords, summary)
+    persist_shipments(result, input_digest, timer)
+    log(f"🗂️ 创建数据集 {dataset_id[:12]}: {summary['total_records']} 行")
+    
+    stages = observe_pipeline(timer, request.endpoint)
+    response_data = dataset_payload(dataset_id, dataset_store.meta(dataset_id))
+    if wants_timings():
+        response_data['timings'] = {'stages': stages, 'total_seconds': timer.total_seconds()}
+    return jsonify(response_data), 201
+
+@app.route('/api/datasets/<dataset_id>/append', methods=['POST'])
+def append_dataset(dataset_id):
+    """向数据集追加新批次：只地理编码此前未出现的邮编，聚合流向增量更新；
+    响应只包含新增的逐单行或新增/变化的流向（replace=true 时为切换到聚合后的完整流向）"""
+    try:
+        known_coords = dataset_store.load_zip_coords(dataset_id) if dataset_store.exists(dataset_id) else None
+    except FileNotFoundError:
+        known_coords = None
+    if known_coords is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    
+    # 解析、清洗和地理编码不持有数据集锁（耗时最长的部分），同一数据集的其他追加和删除不必等待；
+    # 期间其他追加新解析的邮编只会在本次重复地理编码（命中共享缓存）
+    timer = PipelineTimer()
+    try:
+        result, input_digest = process_dataset_request(known_coords=known_coords, progress=timer)
+    except PayloadTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except ImportError:
+        return jsonify({'error': 'Arrow payloads require pyarrow on the server'}), 415
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ 数据处理失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Data processing failed: {str(e)}'}), 500
+    
+    if result is None:
+        return jsonify({'error': 'No valid data found after processing. Please check your CSV format.'}), 400
+    
+    # 只在读取最新元数据、合并和写入时持有锁；数据集可能已在处理期间被删除
+    try:
+        with dataset_store.lock(dataset_id):
+            meta = dataset_store.meta(dataset_id)
+            if meta is None:
+                return jsonify({'error': 'Dataset not found'}), 404
+            known_coords = dataset_store.load_zip_coords(dataset_id)
+            summary = dataset_summary(result.kepler_data, meta['summary'])
+            new_coords = result.zip_coords[~result.zip_coords.index.isin(known_coords.index)]
+            zip_coords = pd.concat([known_coords, new_coords])
             
+            # 已聚合：新批次聚合后合并进已有流向；未聚合但累计行数超过阈值：对全部数据聚合一次，客户端整体替换
+            flows = dataset_store.load_flows(dataset_id)
+            replace = False
+            if flows is not None:
+                timer('aggregate', rows=len(result.kepler_data))
+                delta = result.flows if result.aggregated else visualizer.flow_aggregation.aggregate(result.kepler_data)
+                flows, delta_data = merge_flows(flows, delta)
+                timer('aggregate', rows_out=len(delta_data))
+            elif visualizer.flow_aggregation.should_aggregate(summary['total_records']):
+                timer('aggregate', rows=summary['total_records'])
+                flows = delta_data = visualizer.flow_aggregation.aggregate(dataset_store.load_rows(dataset_id, extra=result.kepler_data))
+                timer('aggregate', rows_out=len(flows))
+                replace = True
+            else:
+                delta_data = result.kepler_data
+            
+            summary['aggregated'] = flows is not None
+            summary['map_rows'] = int(len(flows)) if flows is not None else summary['total_records']
+            meta = dataset_store.append(dataset_id, result.kepler_data, flows, zip_coords, summary)
+    except FileNotFoundError:
+        # 等待锁期间数据集目录已被删除
+        return jsonify({'error': 'Dataset not found'}), 404
+    
+    persist_shipments(result, input_digest, timer)
+    log(f"🗂️ 数据集 {dataset_id[:12]} 追加 {len(result.kepler_data)} 行，"
+        f"新地理编码邮编 {len(new_coords)} 个，返回 {len(delta_data)} 行")
+    timer('render_map', rows=len(delta_data))
+    response_data = dataset_payload(
+        dataset_id, meta,
+        appended_rows=int(len(result.kepler_data)),
+        new_zipcodes=int(len(new_coords)),
+        replace=replace,
+        keys=flow_keys(delta_data) if summary['aggregated'] else None,
+        data=kepler_rows(delta_data)
+    )
+    stages = observe_pipeline(timer, request.endpoint)
+    if wants_timings():
+        response_data['timings'] = {'stages': stages, 'total_seconds': timer.total_seconds()}
+    return jsonify(response_data)
+
+@app.route('/api/datasets/<dataset_id>', methods=['GET'])
+def dataset_info(dataset_id):
+    """数据集元数据和统计信息"""
+    meta = dataset_store.meta(dataset_id)
+    if meta is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    return jsonify(dataset_payload(dataset_id, meta, created_at=meta['created_at'], updated_at=meta['updated_at']))
+
+@app.route('/api/datasets/<dataset_id>', methods=['DELETE'])
+def delete_dataset(dataset_id):
+    if not dataset_store.delete(dataset_id):
+        return jsonify({'error': 'Dataset not found'}), 404
+    return jsonify({'dataset_id': dataset_id, 'deleted': True})
+
+@app.route('/api/datasets/<dataset_id>/config')
+def dataset_config(dataset_id):
+    """数据集的Kepler配置（聚合状态会随追加变化，不做长期缓存）"""
+    meta = dataset_store.meta(dataset_id)
+    if meta is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    return jsonify(visualizer.create_kepler_config_with_filters(aggregated=meta['summary']['aggregated']))
+
+@app.route('/api/datasets/<dataset_id>/data')
+def dataset_data(dataset_id):
+    """数据集当前的完整地图数据（CSV或Arrow，brotli/gzip压缩）；ETag随追加批次变化"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in MAP_DATA_MIMETYPES:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    meta = dataset_store.meta(dataset_id)
+    if meta is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    
+    etag = f'{dataset_id}-{meta["parts"]}-{fmt}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    map_data = dataset_store.load_flows(dataset_id) if meta['summary']['aggregated'] else dataset_store.load_rows(dataset_id)
+    response = compressed_map_data_response(serialize_map_data(map_data, fmt), fmt)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/history')
+def history_summary():
+    """历史存储中已有的日期范围和仓库"""
+    if shipment_store is None:
+        return jsonify({'error': 'Shipment store is disabled'}), 503
+    return jsonify(shipment_store.summary())
+
+@app.route('/api/history/map')
+def history_map():
+    """从历史存储生成地图，只读取命中的分区：?from=&to=（YYYY-MM-DD，含两端）或 ?days=N（截至to或最新日期的N天），
+    ?warehouse=NJ*,TX8828（逗号分隔的通配符）；行数超过聚合阈值时只读取聚合需要的列"""
+    if shipment_store is None:
+        return jsonify({'error': 'Shipment store is disabled'}), 503
+    
+    try:
+        end = request.args.get('to') or None
+        start = request.args.get('from') or None
+        if request.args.get('days'):
+            end = end or shipment_store.summary()['last_date']
+            if end is not None:
+                start = (pd.Timestamp(end) - pd.Timedelta(days=int(request.args['days']) - 1)).strftime('%Y-%m-%d')
+        for value in (start, end):
+            if value is not None:
+                pd.Timestamp(value)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date range: {str(e)}'}), 400
+    warehouses = [pattern.strip() for pattern in request.args.get('warehouse', '').split(',') if pattern.strip()]
+    
+    files = shipment_store.partitions(start, end, warehouses)
+    if not files:
+        return jsonify({'error': 'No stored shipments match the query'}), 404
+    
+    message = f'Loaded {len(files)} stored partitions'
+    input_digest = hashlib.sha256(json.dumps(shipment_store.fingerprint(files)).encode('utf-8')).hexdigest()
+    cache_key = request_cache_key(input_digest)
+    cached = cached_visualization_response(cache_key, message)
+    if cached is not None:
+        return cached
+    
+    timer = PipelineTimer()
+    try:
+        rows = shipment_store.count_rows(files)
+        aggregate = visualizer.flow_aggregation.should_aggregate(rows)
+        timer('load_history', rows=rows)
+        kepler_data = shipment_store.read(files, columns=FLOW_INPUT_COLUMNS if aggregate else None)
+        timer('load_history', rows_out=len(kepler_data), bytes=frame_memory(kepler_data))
+        log(f"🗄️ 历史数据读取: {len(files)} 个分区文件, {len(kepler_data)} 行")
+        
+        flows = None
+        if aggregate:
+            timer('aggregate', rows=len(kepler_data))
+            flows = visualizer.flow_aggregation.aggregate(kepler_data)
+            timer('aggregate', rows_out=len(flows), bytes=frame_memory(flows))
     except Exception as e:
-        print(f"❌ 上传处理失败: {e}")
+        print(f"❌ 历史数据读取失败: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f'Upload processing failed: {str(e)}'}), 500
+        return jsonify({'error': f'History query failed: {str(e)}'}), 500
+    
+    return visualization_response(ProcessingResult(kepler_data, None, flows=flows), message, cache_key, timer)
 
 @app.route('/api/sample')
 def download_sample():
@@ -935,6 +2055,7 @@ def download_sample():
         }
         
         sample_df = pd.DataFrame(sample_data)
+        csv_content = sample_df.to_csv(index=False)
         
         # 创建响应
         response = app.response_class(
@@ -943,13 +2064,191 @@ def download_sample():
             headers={'Content-Disposition': 'attachment; filename=sample_express_parcel.csv'}
         )
         
-        print("📄 样本CSV文件生成成功")
+        log("📄 样本CSV文件生成成功")
         return response
         
     except Exception as e:
         print(f"❌ 样本文件生成失败: {e}")
         return jsonify({'error': f'Failed to generate sample file: {str(e)}'}), 500
 
+@app.route('/api/shipments')
+def query_shipments():
+    """服务端过滤的数据查询：?from=&to=（时间窗口）、?warehouse=NJ*,TX8828 / carrier= / business_type= / dest_zipcode=
+    等分类过滤（逗号分隔，支持通配符）、?bbox=min_lng,min_lat,max_lng,max_lat；只返回命中的行，
+    命中行数超过聚合阈值时返回聚合流向（?aggregate=1/0 强制），?format=json|csv|arrow"""
+    fmt = request.args.get('format', 'json')
+    if fmt != 'json' and fmt not in MAP_DATA_MIMETYPES:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    try:
+        start, end = parse_time_window()
+        bbox = parse_bbox()
+        limit = int(request.args.get('limit', QUERY_ROW_LIMIT))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+    filters = {
+        column: [value.strip() for value in request.args[column].split(',') if value.strip()]
+        for column in INDEXED_COLUMNS if request.args.get(column)
+    }
+    
+    source_id, load = query_source(start, end)
+    if source_id is None:
+        return jsonify({'error': load}), 404
+    
+    timer = PipelineTimer()
+    
+    def build_index():
+        timer('build_index')
+        index = ShipmentIndex(load())
+        timer('build_index', rows=len(index), bytes=index.nbytes)
+        log(f"🗂️ 查询索引已建立: {source_id[:40]} ({len(index)} 行)")
+        return index
+    
+    try:
+        index, _ = query_indexes.get(source_id, build_index)
+        timer('query', rows=len(index))
+        selected = index.select(start, end, filters, bbox)
+        timer('query', rows_out=len(selected))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ 查询失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Query failed: {str(e)}'}), 500
+    
+    # 数据来源本身是聚合流向时（结果缓存中的聚合地图）不再二次聚合
+    source_aggregated = 'shipment_count' in selected.columns
+    aggregate = request.args.get('aggregate', 'auto')
+    if aggregate == 'auto':
+        aggregate = visualizer.flow_aggregation.should_aggregate(len(selected))
+    else:
+        aggregate = aggregate == '1'
+    if aggregate and not source_aggregated:
+        timer('aggregate', rows=len(selected))
+        selected = visualizer.flow_aggregation.aggregate(selected)
+        timer('aggregate', rows_out=len(selected))
+    
+    matched = len(selected)
+    truncated = not (aggregate or source_aggregated) and matched > limit
+    if truncated:
+        selected = selected.iloc[:limit]
+    
+    timer('render_map', rows=len(selected))
+    if fmt == 'json':
+        response_data = {
+            'total': int(matched),
+            'returned': int(len(selected)),
+            'truncated': truncated,
+            'aggregated': bool(aggregate or source_aggregated),
+            'data': kepler_rows(selected)
+        }
+        stages = observe_pipeline(timer, request.endpoint)
+        if wants_timings():
+            response_data['timings'] = {'stages': stages, 'total_seconds': timer.total_seconds()}
+        return jsonify(response_data)
+    
+    response = compressed_map_data_response(serialize_map_data(selected, fmt), fmt)
+    timer('render_map', bytes=response.content_length)
+    observe_pipeline(timer, request.endpoint)
+    
+    response.headers['X-Total-Rows'] = str(matched)
+    response.headers['X-Truncated'] = '1' if truncated else '0'
+    return response
+
+@app.route('/api/frames')
+def frames_manifest():
+    """时间回放的帧列表：每帧的起始时间、流向数和件数（不含数据），?from=&to= 只列出该时间范围内的帧；
+    帧在首次请求时按来源一次聚合生成并缓存，数据通过 /api/frames/data 按窗口加载"""
+    timer = PipelineTimer()
+    try:
+        frames, source = request_animation_frames(timer)
+        if frames is None:
+            return jsonify({'error': source}), 404
+        start, end = parse_time_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ 动画帧生成失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Frame generation failed: {str(e)}'}), 500
+    
+    lo, hi = frames.frame_range(start, end)
+    params = request.args.to_dict()
+    params.pop('timings', None)
+    response_data = {
+        'bucket': frames.bucket,
+        'total_frames': len(frames),
+        'window': ANIMATION_FRAME_WINDOW,
+        'frames': frames.manifest(lo, hi),
+        'data_url': f'/api/frames/data?{urlencode(params)}',
+        'config': visualizer.create_kepler_config_with_filters(aggregated=True),
+    }
+    stages = observe_pipeline(timer, request.endpoint)
+    if wants_timings():
+        response_data['timings'] = {'stages': stages, 'total_seconds': timer.total_seconds()}
+    return jsonify(response_data)
+
+@app.route('/api/frames/data')
+def frames_data():
+    """一个窗口的帧数据：?first=<帧序号>&count=<帧数>（默认 ANIMATION_FRAME_WINDOW），?format=json|csv|arrow；
+    帧按来源内容寻址，ETag随来源（数据集批次、历史分区文件）变化"""
+    fmt = request.args.get('format', 'json')
+    if fmt != 'json' and fmt not in MAP_DATA_MIMETYPES:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    
+    timer = PipelineTimer()
+    try:
+        first = int(request.args.get('first', 0))
+        count = int(request.args.get('count', ANIMATION_FRAME_WINDOW))
+        frames, source = request_animation_frames(timer)
+        if frames is None:
+            return jsonify({'error': source}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ 动画帧生成失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'Frame generation failed: {str(e)}'}), 500
+    
+    etag = hashlib.sha256(f'{source}:{first}:{count}:{fmt}'.encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    window = frames.window(first, count)
+    timer('render_map', rows=len(window))
+    if fmt == 'json':
+        response = jsonify({
+            'first': first,
+            'frames': frames.manifest(*frames.window_range(first, count)),
+            'data': kepler_rows(window)
+        })
+        observe_pipeline(timer, request.endpoint)
+    else:
+        response = compressed_map_data_response(serialize_map_data(window, fmt), fmt)
+        timer('render_map', bytes=response.content_length)
+        observe_pipeline(timer, request.endpoint)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/warehouses')
+def list_warehouses():
+    """当前仓库注册表（版本、加载时间和全部仓库），可选 ?resolve=<仓库名> 查看名称解析结果"""
+    registry = visualizer.warehouse_registry.current()
+    response_data = registry.describe()
+    if request.args.get('resolve'):
+        response_data['resolved'] = registry.resolve(request.args['resolve'])
+    return jsonify(response_data)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus格式的进程指标：各阶段耗时、行数、产出字节数、地理编码来源、结果缓存命中"""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health')
 def health_check():
     """健康检查端点"""
@@ -0,0 +1,429 @@
+"""ingest → geocode → render 流水线基准测试
+
+生成 /api/sample 格式的合成快递CSV（默认 10k / 100k / 1M / 10M 行），每个规模在独立子进程中运行，
+分阶段计时（JSON/CSV读取、warehouse映射、时间戳解析、邮编清洗、可选的多进程分片清洗、地理编码、聚合、HTML渲染），
+记录峰值RSS，结果保存为JSON，可与之前的结果对比：
+
+    python benchmarks/pipeline_benchmark.py --sizes 10000 100000
+    python benchmarks/pipeline_benchmark.py --sizes 1000000 --workers 8
+    python benchmarks/pipeline_benchmark.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import contextlib
+import datetime
+import hashlib
+import importlib.metadata
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SIZES = [10000, 100000, 1000000, 10000000]
+DEFAULT_DATA_DIR = os.path.join(ROOT, 'benchmarks', 'data')
+DEFAULT_RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# 合成数据的取值：已知warehouse键 + 需要模糊匹配的名称
+WAREHOUSE_NAMES = [
+    'NJ9', 'NJ8', 'NJ7', 'NJ-Main', 'TX8828', 'TX8829', 'TX-DFW', 'TX-Houston',
+    'WNT485', 'WNT486', 'WNT487', 'CA-LA', 'CA-SF', 'CA-OAK', 'IL-CHI', 'IL9',
+    'GA-ATL', 'FL-MIA', 'MAIN', 'NYC-Main',
+    'NJ-12', 'TX-North', 'WNT-500', 'Dallas hub', 'LA DC', 'Chicago 2', 'Miami Port', 'XYZ-1',
+]
+CITY_NAMES = [
+    'New York', 'Beverly Hills', 'Chicago', 'Miami', 'Seattle', 'Atlanta', 'Boston', 'Philadelphia',
+    'Denver', 'Phoenix', 'Las Vegas', 'Nashville', 'Charlotte', 'Richmond', 'Indianapolis',
+    'Minneapolis', 'Milwaukee', 'Louisville', 'New Orleans', 'Salt Lake City',
+]
+CARRIERS = ['FedEx', 'UPS', 'DHL', 'USPS', 'Amazon']
+BIZ_TYPES = ['Express', 'Standard', 'Economy']
+
+
+def size_label(rows):
+    if rows >= 1000000 and rows % 1000000 == 0:
+        return f'{rows // 1000000}m'
+    if rows >= 1000 and rows % 1000 == 0:
+        return f'{rows // 1000}k'
+    return str(rows)
+
+
+def zip_pool(size, seed):
+    """合成的目的地邮编池（5位字符串，含前导零）"""
+    rng = np.random.default_rng(seed)
+    codes = rng.choice(np.arange(501, 99951), size=size, replace=False)
+    return np.char.zfill(codes.astype(str), 5).astype(object)
+
+
+def write_gazetteer(path, zips, coverage, seed):
+    """写入本地邮编库：覆盖 coverage 比例的邮编，其余（包括未覆盖的仓库邮编）留给地理编码桩服务"""
+    rng = np.random.default_rng(seed)
+    covered = zips[: int(len(zips) * coverage)]
+    pd.DataFrame({
+        'zipcode': covered,
+        'lat': rng.uniform(25, 49, len(covered)).round(5),
+        'lng': rng.uniform(-124, -67, len(covered)).round(5),
+        'city': 'Synthetic',
+        'state': 'NA',
+    }).to_csv(path, index=False)
+
+
+def generate_csv(path, rows, zips, seed, chunk_rows=500000):
+    """分块生成合成快递CSV（/api/sample 的列），包含少量epoch时间戳、空时间、ZIP+4和无效邮编"""
+    rng = np.random.default_rng(seed)
+    start_time = pd.Timestamp('2024-01-01')
+    tmp_path = f'{path}.tmp'
+
+    for start in range(0, rows, chunk_rows):
+        n = min(chunk_rows, rows - start)
+
+        # 时间戳：按唯一分钟格式化后广播
+        minutes = rng.integers(0, 30 * 1440, n)
+        codes, uniques = pd.factorize(minutes)
+        moments = start_time + pd.to_timedelta(uniques, unit='min')
+        created_time = moments.strftime('%m/%d/%y %H:%M').to_numpy(dtype=object)[codes]
+        kind = rng.random(n)
+        epoch_rows = kind < 0.03
+        created_time[epoch_rows] = (moments.asi8[codes[epoch_rows]] // 10 ** 9).astype(str)
+        created_time[(kind >= 0.03) & (kind < 0.04)] = ''
+
+        postal = zips[rng.integers(0, len(zips), n)]
+        kind = rng.random(n)
+        plus4 = kind < 0.02
+        postal[plus4] = postal[plus4] + '-1234'
+        postal[(kind >= 0.02) & (kind < 0.03)] = 'N/A'
+
+        chunk = pd.DataFrame({
+            'id': np.arange(start + 1, start + n + 1),
+            'warehouse_name': np.array(WAREHOUSE_NAMES, dtype=object)[rng.integers(0, len(WAREHOUSE_NAMES), n)],
+            'created_time': created_time,
+            'shipto_postal_code': postal,
+            'shipto_city': np.array(CITY_NAMES, dtype=object)[rng.integers(0, len(CITY_NAMES), n)],
+            'shipto_country_code': 'US',
+            'carrier': np.array(CARRIERS, dtype=object)[rng.integers(0, len(CARRIERS), n)],
+            'biz_type': np.array(BIZ_TYPES, dtype=object)[rng.integers(0, len(BIZ_TYPES), n)],
+            'gw': rng.gamma(2.0, 1.2, n).round(2),
+            'vol': rng.gamma(2.0, 0.06, n).round(3),
+            'pkg_num': rng.integers(1, 6, n),
+        })
+        chunk.to_csv(tmp_path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+    os.replace(tmp_path, path)
+
+
+def ensure_dataset(data_dir, rows, zips, seed):
+    """数据文件已存在则复用（大规模数据生成较慢）"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'parcels_{size_label(rows)}_seed{seed}.csv')
+    if not os.path.exists(path):
+        print(f'🧪 生成 {rows} 行合成数据: {path}')
+        started = time.perf_counter()
+        generate_csv(path, rows, zips, seed)
+        print(f'   完成 ({time.perf_counter() - started:.1f}s)')
+    return path
+
+
+class StubGeocodeHandler(BaseHTTPRequestHandler):
+    """本地地理编码桩服务（zippopotam.us 响应格式），坐标由邮编哈希确定"""
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        zipcode = self.path.rstrip('/').rsplit('/', 1)[-1]
+        digest = int(hashlib.md5(zipcode.encode('utf-8')).hexdigest()[:8], 16)
+        body = json.dumps({'places': [{
+            'latitude': str(25 + digest % 2400 / 100),
+            'longitude': str(-124 + digest // 2400 % 5700 / 100),
+            'place name': 'Stub',
+            'state abbreviation': 'NA',
+        }]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_stub_server(latency_ms):
+    StubGeocodeHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGeocodeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def peak_rss_mb():
+    """进程启动以来的峰值RSS（Linux为KB，macOS为字节）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+class StageTimer:
+    """记录每个阶段的耗时和阶段结束时的峰值RSS；也可作为 finalize 的 progress 回调。
+    同一阶段多次计时时累加（finalize 开头的 'clean' 报告会再次进入 clean 阶段，不能覆盖之前测得的清洗耗时）"""
+
+    def __init__(self):
+        self.stages = {}
+        self._current = None
+        self._started = None
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        started = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        previous = self.stages.get(name, {}).get('seconds', 0)
+        self.stages[name] = {'seconds': round(previous + seconds, 4), 'peak_rss_mb': peak_rss_mb()}
+
+    def __call__(self, stage, **info):
+        now = time.perf_counter()
+        if self._current is not None and stage != self._current:
+            self.record(self._current, now - self._started)
+        if stage != self._current:
+            self._current, self._started = stage, now
+
+    def close(self):
+        if self._current is not None:
+            self.record(self._current, time.perf_counter() - self._started)
+            self._current = None
+
+
+def run_worker(args):
+    """子进程：在隔离的环境变量下导入app，分阶段运行流水线，把结果写入 args.output"""
+    stub = start_stub_server(args.stub_latency_ms)
+    os.environ.update({
+        'ZIP_GAZETTEER_PATH': args.gazetteer,
+        'GEOCODE_CACHE_PATH': os.path.join(args.workdir, f'geocode_cache_{os.getpid()}.sqlite3'),
+        'ZIPCODE_API_BASE': f'http://127.0.0.1:{stub.server_address[1]}/us/',
+        'GEOCODE_API_FALLBACK': '1',
+        'GEOCODE_RATE': str(args.geocode_rate),
+        'GEOCODE_BURST': str(args.geocode_rate),
+        'RESULT_CACHE_MAX_BYTES': '0',
+        'PARALLEL_WORKERS': str(args.workers),
+    })
+
+    import app
+    visualizer = app.visualizer
+    timer = StageTimer()
+    result = {'rows': args.rows, 'baseline_rss_mb': peak_rss_mb()}
+
+    # 读取：CSV（与 /api/upload 相同的列和类型）
+    with timer.measure('csv_ingest'):
+        df = pd.read_csv(args.csv, usecols=lambda col: col in app.INGEST_DTYPES, dtype=app.INGEST_DTYPES)
+
+    # 读取：列式JSON（与 /api/process-columns 相同的解析），构造请求体不计时
+    if args.rows <= args.json_max_rows:
+        body = json.dumps({'filename': 'bench.csv', 'columns': {
+            col: df[col].astype(object).where(df[col].notna(), None).tolist() for col in df.columns
+        }}).encode('utf-8')
+        with timer.measure('json_ingest'):
+            payload = json.loads(body)
+            pd.DataFrame(payload['columns'])
+        result['json_body_bytes'] = len(body)
+        del body, payload
+
+    # 清洗各步骤单独计时（不修改df）
+    with timer.measure('warehouse_mapping'):
+        warehouse_registry = visualizer.warehouse_registry.current()
+        visualizer.resolve_warehouse_zipcodes(df['warehouse_name'], warehouse_registry)
+    with timer.measure('timestamp_parsing'):
+        visualizer.parse_timestamps(df['created_time'])
+    with timer.measure('zip_cleaning'):
+        visualizer.normalize_zipcodes(df['shipto_postal_code'])
+
+    # 多进程分片清洗（与后台任务处理大文件的方式相同），只计时不参与后续阶段
+    #    分别计时两种分片交接方式，记录复制到主进程内存和内存映射读取的字节数
+    if args.workers > 1:
+        result['parallel_handoff'] = {}
+        for handoff in ('pickle', 'arrow'):
+            handoff_info = {}
+            visualizer.shard_pool.handoff = handoff
+            with timer.measure(f'clean_parallel_{handoff}'):
+                visualizer.prepare_csv_parallel(
+                    args.csv,
+                    progress=lambda stage, **info: handoff_info.update(info),
+                    usecols=lambda col: col in app.INGEST_DTYPES,
+                    dtype=app.INGEST_DTYPES
+                )
+            result['parallel_handoff'][handoff] = {
+                'copied_bytes': handoff_info.get('copied_bytes', 0),
+                'mapped_bytes': handoff_info.get('mapped_bytes', 0),
+            }
+        visualizer.shard_pool.shutdown()
+
+    # 完整清洗 + finalize（地理编码、坐标、数据集、聚合阶段由progress回调计时）
+    report = {}
+    with timer.measure('clean'):
+        valid_df = visualizer.prepare_chunk(df, warehouse_registry, report)
+    del df
+    processed = visualizer.finalize(valid_df, warehouse_registry, report, progress=timer)
+    timer.close()
+
+    if processed is None:
+        raise SystemExit('pipeline produced no rows')
+
+    result['valid_rows'] = int(len(processed.kepler_data))
+    result['map_rows'] = int(len(processed.map_data))
+    result['aggregated'] = processed.aggregated
+    result['dataset_memory_bytes'] = app.frame_memory(processed.kepler_data)
+
+    if result['map_rows'] <= args.render_max_rows:
+        with timer.measure('render_html'):
+            html = app.render_map_html(processed)
+        result['html_bytes'] = len(html.encode('utf-8'))
+    else:
+        result['render_skipped'] = f"map rows {result['map_rows']} > --render-max-rows {args.render_max_rows}"
+
+    result['stages'] = timer.stages
+    result['peak_rss_mb'] = peak_rss_mb()
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+    stub.shutdown()
+
+
+def package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    """主进程：生成数据和邮编库，每个规模启动一个子进程（峰值RSS互不影响），汇总结果"""
+    zips = zip_pool(args.zip_pool, args.seed)
+    workdir = tempfile.mkdtemp(prefix='pipeline_bench_')
+    gazetteer = os.path.join(workdir, 'zip_centroids.csv')
+    write_gazetteer(gazetteer, zips, args.gazetteer_coverage, args.seed)
+
+    report = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'versions': {name: package_version(name) for name in ('pandas', 'numpy', 'pyarrow', 'keplergl', 'flask')},
+        'settings': {key: getattr(args, key) for key in (
+            'seed', 'zip_pool', 'gazetteer_coverage', 'stub_latency_ms', 'geocode_rate',
+            'json_max_rows', 'render_max_rows', 'workers')},
+        'runs': [],
+    }
+
+    for rows in args.sizes:
+        csv_path = ensure_dataset(args.data_dir, rows, zips, args.seed)
+        output = os.path.join(workdir, f'result_{rows}.json')
+        command = [
+            sys.executable, os.path.abspath(__file__), '--worker',
+            '--rows', str(rows), '--csv', csv_path, '--gazetteer', gazetteer,
+            '--workdir', workdir, '--output', output,
+            '--stub-latency-ms', str(args.stub_latency_ms), '--geocode-rate', str(args.geocode_rate),
+            '--json-max-rows', str(args.json_max_rows), '--render-max-rows', str(args.render_max_rows),
+            '--workers', str(args.workers),
+        ]
+        print(f'⏱️ 运行 {size_label(rows)} 行...')
+        started = time.perf_counter()
+        completed = subprocess.run(command, cwd=ROOT, stdout=None if args.verbose else subprocess.DEVNULL)
+        if completed.returncode != 0 or not os.path.exists(output):
+            print(f'❌ {size_label(rows)} 失败 (退出码 {completed.returncode})')
+            report['runs'].append({'rows': rows, 'error': f'exit code {completed.returncode}'})
+            continue
+
+        with open(output, encoding='utf-8') as f:
+            run = json.load(f)
+        run['wall_seconds'] = round(time.perf_counter() - started, 2)
+        report['runs'].append(run)
+        print_run(run)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = args.output or os.path.join(
+        args.results_dir, f"pipeline_{datetime.datetime.now():%Y%m%d_%H%M%S}_{report['git_revision'] or 'nogit'}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'💾 结果已保存: {path}')
+
+
+def print_run(run):
+    print(f"   {size_label(run['rows'])}: 有效 {run['valid_rows']} 行, 地图 {run['map_rows']} 行, "
+          f"峰值RSS {run['peak_rss_mb']} MB")
+    for name, stage in run['stages'].items():
+        print(f"   {name:<20} {stage['seconds']:>10.3f}s  {stage['peak_rss_mb']:>9.1f} MB")
+    for handoff, info in run.get('parallel_handoff', {}).items():
+        print(f"   交接 {handoff:<15} 复制 {info['copied_bytes'] / 1024 ** 2:>8.1f} MB  内存映射读取 {info['mapped_bytes'] / 1024 ** 2:>8.1f} MB")
+
+
+def compare(old_path, new_path):
+    """对比两次结果：每个规模、每个阶段的耗时变化和峰值RSS变化"""
+    with open(old_path, encoding='utf-8') as f:
+        old = {run['rows']: run for run in json.load(f)['runs'] if 'stages' in run}
+    with open(new_path, encoding='utf-8') as f:
+        new = {run['rows']: run for run in json.load(f)['runs'] if 'stages' in run}
+
+    for rows in sorted(set(old) & set(new)):
+        print(f"📊 {size_label(rows)} 行  峰值RSS {old[rows]['peak_rss_mb']} → {new[rows]['peak_rss_mb']} MB")
+        for name in new[rows]['stages']:
+            if name not in old[rows]['stages']:
+                continue
+            before = old[rows]['stages'][name]['seconds']
+            after = new[rows]['stages'][name]['seconds']
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"   {name:<20} {before:>10.3f}s → {after:>10.3f}s  ({change:+.1f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='ingest → geocode → render 流水线基准测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help='合成CSV的存放目录（按规模和种子复用）')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR)
+    parser.add_argument('--output', help='结果JSON路径（默认写入 --results-dir）')
+    parser.add_argument('--zip-pool', type=int, default=40000, help='目的地邮编池大小')
+    parser.add_argument('--gazetteer-coverage', type=float, default=0.95, help='本地邮编库覆盖的邮编比例，其余走桩服务')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0, help='桩服务每个请求的模拟延迟')
+    parser.add_argument('--geocode-rate', type=float, default=1000.0, help='对桩服务的请求速率上限')
+    parser.add_argument('--json-max-rows', type=int, default=1000000, help='超过该行数时跳过JSON读取阶段')
+    parser.add_argument('--render-max-rows', type=int, default=1000000, help='地图行数超过该值时跳过HTML渲染')
+    parser.add_argument('--workers', type=int, default=0, help='大于1时额外计时多进程分片清洗（pickle和arrow两种交接方式）')
+    parser.add_argument('--verbose', action='store_true', help='显示流水线日志')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='对比两次结果JSON')
+
+    # 子进程参数
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--rows', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--csv', help=argparse.SUPPRESS)
+    parser.add_argument('--gazetteer', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+    elif args.worker:
+        run_worker(args)
+    else:
+        run_suite(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from dateutil import tz
+
+
+# 可选列（缺失时补空，后续用默认值填充）和清洗后保留的列
+OPTIONAL_COLUMNS = ['id', 'shipto_city', 'shipto_country_code', 'carrier', 'biz_type', 'gw', 'vol', 'pkg_num']
+PREPARED_COLUMNS = [
+    'id', 'warehouse_name', 'fixed_warehouse_zipcode', 'shipment_ts',
+    'destination_zipcode', 'shipto_city', 'shipto_country_code', 'carrier', 'biz_type', 'gw', 'vol', 'pkg_num'
+]
+
+# 数值列（前端按字符串发送，统一转为数值）
+NUMERIC_COLUMNS = ['gw', 'vol', 'pkg_num']
+
+# 清洗后的低基数字符串列（流式累积时转为分类列）
+CATEGORY_COLUMNS = [
+    'warehouse_name', 'fixed_warehouse_zipcode', 'destination_zipcode',
+    'shipto_city', 'shipto_country_code', 'carrier', 'biz_type'
+]
+
+
+def resolve_warehouse_zipcodes(warehouse_names, warehouse_registry):
+    """按唯一值解析warehouse邮编并通过factorize编码广播回每一行"""
+    codes, uniques = pd.factorize(warehouse_names)
+    resolved = np.array(
+        [warehouse_registry.zipcode(name) for name in uniques] + [warehouse_registry.default_zipcode],
+        dtype=object
+    )
+    # 缺失值的编码为-1，正好取到末尾的默认仓库邮编
+    return pd.Series(resolved[codes], index=warehouse_names.index)
+
+
+def normalize_zipcodes(zipcodes):
+    """按唯一值批量规范化为5位邮编：支持ZIP+4、丢失前导零的整数（7114）和浮点格式（7114.0）"""
+    codes, uniques = pd.factorize(zipcodes)
+    text = pd.Series(uniques, dtype=object).astype(str).str.strip()
+
+    # 去掉浮点后缀和ZIP+4后缀，再只保留数字
+    text = text.str.replace(r'\.0+$', '', regex=True)
+    text = text.str.replace(r'^(\d{3,5})-\d{4}$', r'\1', regex=True)
+    digits = text.str.replace(r'\D', '', regex=True)
+
+    lengths = digits.str.len()
+    normalized = digits.str[:5].where(lengths >= 5)
+    normalized = normalized.fillna(digits.str.zfill(5).where(lengths.between(3, 4)))
+
+    resolved = np.append(normalized.to_numpy(dtype=object), None)
+    resolved[:-1][pd.isna(resolved[:-1])] = None
+    return pd.Series(resolved[codes], index=zipcodes.index)
+
+
+def parse_timestamps(timestamps):
+    """批量解析时间戳：'%m/%d/%y %H:%M' 字符串和秒/毫秒级epoch数值，返回datetime64列和解析统计"""
+    parsed = pd.Series(pd.NaT, index=timestamps.index, dtype='datetime64[ns]')
+
+    if pd.api.types.is_numeric_dtype(timestamps):
+        missing = timestamps.isna()
+        text_mask = pd.Series(False, index=timestamps.index)
+    else:
+        text = timestamps.astype(str).str.strip()
+        missing = timestamps.isna() | (text == '')
+        text_mask = text.str.contains('/', regex=False) & ~missing
+
+    # 字符串格式
+    if text_mask.any():
+        parsed[text_mask] = pd.to_datetime(timestamps[text_mask], format='%m/%d/%y %H:%M', errors='coerce')
+
+    # epoch数值（>1e10视为毫秒），按本地时区转换，与datetime.fromtimestamp一致
+    numeric_mask = ~text_mask & ~missing
+    if numeric_mask.any():
+        seconds = pd.to_numeric(timestamps[numeric_mask], errors='coerce')
+        seconds = seconds.where(seconds <= 1e10, seconds / 1000)
+        epoch = pd.to_datetime(seconds, unit='s', errors='coerce')
+        parsed[numeric_mask] = epoch.dt.tz_localize('UTC').dt.tz_convert(tz.tzlocal()).dt.tz_localize(None)
+
+    report = {
+        'parsed': int(parsed.notna().sum()),
+        'missing': int(missing.sum()),
+        'unparseable': int((parsed.isna() & ~missing).sum()),
+    }
+    return parsed, report
+
+
+def prepare_chunk(df, warehouse_registry, report=None):
+    """清洗单个数据块：修复warehouse邮编、处理时间戳、清洗目的地邮编、过滤有效数据（步骤3-6）"""
+    # 3. 修复warehouse邮编
+    df['fixed_warehouse_zipcode'] = resolve_warehouse_zipcodes(df['warehouse_name'], warehouse_registry)
+
+    # 4. 处理时间戳
+    df['shipment_ts'], timestamp_report = parse_timestamps(df['created_time'])
+    if report is not None:
+        for key, count in timestamp_report.items():
+            report[f'timestamp_{key}'] = report.get(f'timestamp_{key}', 0) + count
+
+    # 5. 清洗目的地邮编
+    df['destination_zipcode'] = normalize_zipcodes(df['shipto_postal_code'])
+    if report is not None:
+        invalid = int((df['destination_zipcode'].isna() & df['shipto_postal_code'].notna()).sum())
+        report['zipcode_invalid'] = report.get('zipcode_invalid', 0) + invalid
+
+    # 6. 过滤有效数据（只保留后续步骤需要的列，降低累积内存）
+    for col in OPTIONAL_COLUMNS:
+        if col not in df.columns:
+            df[col] = None
+    for col in NUMERIC_COLUMNS:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    valid_mask = (
+        (df['shipment_ts'].notna()) &
+        (df['fixed_warehouse_zipcode'].notna()) &
+        (df['destination_zipcode'].notna())
+    )
+    return df.loc[valid_mask, PREPARED_COLUMNS]
+
+
+def compact_prepared(df):
+    """清洗后的数据块转为紧凑类型再累积：低基数字符串列 → 分类列，数值列 → float32
+    （与Kepler数据集中的最终类型一致，不影响结果）"""
+    columns = {col: df[col].astype(object).astype('category') for col in CATEGORY_COLUMNS}
+    columns.update({col: df[col].astype('float32') for col in NUMERIC_COLUMNS})
+    return df.assign(**columns)
+
+
+def concat_prepared(chunks):
+    """拼接紧凑数据块：各块分类列的类别取并集后再拼接，避免类别不同时退化为object列"""
+    if len(chunks) > 1:
+        dtypes = {
+            col: pd.CategoricalDtype(pd.Index(
+                np.concatenate([chunk[col].cat.categories.to_numpy(dtype=object) for chunk in chunks]), dtype=object
+            ).unique())
+            for col in CATEGORY_COLUMNS
+        }
+        chunks = [chunk.astype(dtypes) for chunk in chunks]
+    return pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+import pandas as pd
+from locking import file_lock
+
+
+DATASET_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class DatasetStore:
+    """可追加的地图数据集：每个数据集一个目录，逐单数据按追加批次分片保存（part-00000.pkl ...），
+    另存聚合流向（如有）、已解析的邮编坐标和元数据"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _dataset_dir(self, dataset_id):
+        return os.path.join(self.directory, dataset_id)
+
+    def lock(self, dataset_id):
+        """数据集级别的锁（数据集目录中的文件锁）：同一数据集的追加和删除串行执行，多个工作进程之间同样互斥；
+        数据集目录已被删除时抛出 FileNotFoundError"""
+        return file_lock(os.path.join(self._dataset_dir(dataset_id), '.lock'))
+
+    def exists(self, dataset_id):
+        return bool(DATASET_ID_PATTERN.fullmatch(dataset_id)) and os.path.exists(os.path.join(self._dataset_dir(dataset_id), 'meta.json'))
+
+    def meta(self, dataset_id):
+        """读取元数据，不存在返回None"""
+        if not DATASET_ID_PATTERN.fullmatch(dataset_id):
+            return None
+        try:
+            with open(os.path.join(self._dataset_dir(dataset_id), 'meta.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _write(self, dataset_dir, name, write):
+        """先写临时文件再重命名"""
+        tmp_path = os.path.join(dataset_dir, f'.tmp-{name}-{uuid.uuid4().hex}')
+        write(tmp_path)
+        os.replace(tmp_path, os.path.join(dataset_dir, name))
+
+    def _write_meta(self, dataset_dir, meta):
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+        self._write(dataset_dir, 'meta.json', write)
+
+    def create(self, kepler_data, flows, zip_coords, summary):
+        """保存新数据集（summary为调用方维护的累计统计，随元数据保存），返回数据集ID"""
+        dataset_id = uuid.uuid4().hex
+        dataset_dir = self._dataset_dir(dataset_id)
+        os.makedirs(dataset_dir)
+
+        self._write(dataset_dir, 'part-00000.pkl', kepler_data.to_pickle)
+        if flows is not None:
+            self._write(dataset_dir, 'flows.pkl', flows.to_pickle)
+        self._write(dataset_dir, 'zip_coords.pkl', zip_coords.to_pickle)
+
+        now = time.time()
+        self._write_meta(dataset_dir, {
+            'id': dataset_id,
+            'created_at': now,
+            'updated_at': now,
+            'parts': 1,
+            'summary': summary,
+        })
+        return dataset_id
+
+    def load_rows(self, dataset_id, extra=None):
+        """合并所有分片的逐单数据，extra为尚未保存的新批次（各分片类别不同的分类列拼接后恢复为分类列）"""
+        meta = self.meta(dataset_id)
+        dataset_dir = self._dataset_dir(dataset_id)
+        parts = [pd.read_pickle(os.path.join(dataset_dir, f'part-{i:05d}.pkl')) for i in range(meta['parts'])]
+        if extra is not None:
+            parts.append(extra)
+        if len(parts) == 1:
+            return parts[0]
+
+        rows = pd.concat(parts, ignore_index=True)
+        categorical = [column for column in parts[0].columns if isinstance(parts[0][column].dtype, pd.CategoricalDtype)]
+        rows[categorical] = rows[categorical].astype('category')
+        return rows
+
+    def load_flows(self, dataset_id):
+        """聚合流向，数据集未聚合时返回None"""
+        try:
+            return pd.read_pickle(os.path.join(self._dataset_dir(dataset_id), 'flows.pkl'))
+        except FileNotFoundError:
+            return None
+
+    def load_zip_coords(self, dataset_id):
+        return pd.read_pickle(os.path.join(self._dataset_dir(dataset_id), 'zip_coords.pkl'))
+
+    def append(self, dataset_id, rows, flows, zip_coords, summary):
+        """追加一个批次：新增一个逐单数据分片，覆盖聚合流向（如有）和邮编坐标，最后更新元数据（调用方需持有数据集锁）；
+        各文件先写临时文件再重命名，元数据更新前失败时新分片不会被读取"""
+        meta = self.meta(dataset_id)
+        dataset_dir = self._dataset_dir(dataset_id)
+
+        self._write(dataset_dir, f'part-{meta["parts"]:05d}.pkl', rows.to_pickle)
+        if flows is not None:
+            self._write(dataset_dir, 'flows.pkl', flows.to_pickle)
+        self._write(dataset_dir, 'zip_coords.pkl', zip_coords.to_pickle)
+
+        meta['parts'] += 1
+        meta['updated_at'] = time.time()
+        meta['summary'] = summary
+        self._write_meta(dataset_dir, meta)
+        return meta
+
+    def delete(self, dataset_id):
+        """删除数据集：持有数据集锁，不会删掉正在追加的数据集；等待锁的追加请求取得锁后会发现数据集已不存在"""
+        if not self.exists(dataset_id):
+            return False
+        try:
+            with self.lock(dataset_id):
+                if not self.exists(dataset_id):
+                    return False
+                shutil.rmtree(self._dataset_dir(dataset_id), ignore_errors=True)
+        except FileNotFoundError:
+            # 等待锁期间已被另一个请求删除
+            return False
+        return True
+
+
+def load_dataset_store():
+    """按环境变量创建数据集存储"""
+    return DatasetStore(os.environ.get('DATASET_DIR', os.path.join('data', 'datasets')))
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+from aggregation import aggregate_flows
+
+
+# 动画帧粒度：参数值 → pandas周期代码
+FRAME_BUCKETS = {
+    'day': 'D',
+    'hour': 'h',
+}
+
+
+class AnimationFrames:
+    """时间回放用的预计算帧：一次分组把数据聚合为 仓库 → 目的地 × 时间桶 的流向，按时间排序后
+    记录每一帧（包括没有数据的空帧）在流向表中的起止位置，回放时只取当前窗口的帧"""
+
+    def __init__(self, kepler_data, bucket='day', dest_key='zipcode', geohash_precision=5, flows_bucket='D'):
+        if bucket not in FRAME_BUCKETS:
+            raise ValueError(f'Unsupported frame bucket: {bucket}')
+        self.bucket = bucket
+        freq = FRAME_BUCKETS[bucket]
+
+        if 'shipment_count' in kepler_data.columns:
+            # 数据来源已是聚合流向（flows_bucket为其时间桶）：粒度相同时直接作为帧，不能再拆分或合并
+            if to_offset(freq) != to_offset(flows_bucket):
+                raise ValueError(f'Aggregated map data cannot be split into {bucket} frames')
+            flows = kepler_data
+        else:
+            flows = aggregate_flows(kepler_data, dest_key, freq, geohash_precision)
+
+        order = np.argsort(flows['shipment_ts'].to_numpy(), kind='stable')
+        self.flows = flows.iloc[order].reset_index(drop=True)
+        timestamps = self.flows['shipment_ts'].to_numpy()
+
+        if len(timestamps):
+            self.starts = pd.date_range(timestamps[0], timestamps[-1], freq=freq)
+        else:
+            self.starts = pd.DatetimeIndex([])
+        bounds = np.searchsorted(timestamps, self.starts.to_numpy(), side='left')
+        self.offsets = np.append(bounds, len(timestamps))
+
+        counts = self.flows['shipment_count'].to_numpy()
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        self.shipments = cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def nbytes(self):
+        return int(self.flows.memory_usage(deep=True).sum())
+
+    def frame_range(self, start=None, end=None):
+        """[start, end) 时间范围覆盖的帧序号区间"""
+        lo = 0 if start is None else int(self.starts.searchsorted(pd.Timestamp(start), side='left'))
+        hi = len(self.starts) if end is None else int(self.starts.searchsorted(pd.Timestamp(end), side='left'))
+        return lo, max(lo, hi)
+
+    def manifest(self, lo=0, hi=None):
+        """帧列表：序号、起始时间、流向数和件数（不含数据）"""
+        hi = len(self) if hi is None else hi
+        return [
+            {
+                'frame': i,
+                'start': self.starts[i].isoformat(),
+                'flows': int(self.offsets[i + 1] - self.offsets[i]),
+                'shipments': int(self.shipments[i]),
+            }
+            for i in range(lo, hi)
+        ]
+
+    def window_range(self, first, count):
+        """从第first帧起连续count帧的帧序号区间（截断到已有的帧）"""
+        first = min(max(first, 0), len(self))
+        return first, min(first + max(count, 0), len(self))
+
+    def window(self, first, count):
+        """从第first帧起连续count帧的流向（按时间排序）"""
+        first, last = self.window_range(first, count)
+        return self.flows.iloc[self.offsets[first]:self.offsets[last]]
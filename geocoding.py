@@ -0,0 +1,448 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# GeoNames 邮编文件（US.txt）的列定义，zippopotam.us 的数据也来源于此
+GEONAMES_COLUMNS = [
+    'country_code', 'zipcode', 'city', 'state_name', 'state',
+    'county_name', 'county_code', 'community_name', 'community_code',
+    'lat', 'lng', 'accuracy'
+]
+
+# 常见列名别名 → 标准列名
+GAZETTEER_COLUMN_ALIASES = {
+    'zip': 'zipcode',
+    'zip_code': 'zipcode',
+    'postal_code': 'zipcode',
+    'latitude': 'lat',
+    'longitude': 'lng',
+    'lon': 'lng',
+    'place_name': 'city',
+    'state_abbreviation': 'state',
+    'state_code': 'state',
+}
+
+
+class ZipGazetteer:
+    """本地ZIP质心库：ZIP → (lat, lng, city, state)，批量向量化查询"""
+
+    def __init__(self, frame=None):
+        if frame is None or len(frame) == 0:
+            self.zip_keys = np.empty(0, dtype=np.int32)
+            self.lat = np.empty(0, dtype=np.float64)
+            self.lng = np.empty(0, dtype=np.float64)
+            self.city = np.empty(0, dtype=object)
+            self.state = np.empty(0, dtype=object)
+            return
+
+        frame = self._normalize_frame(frame)
+        self.zip_keys = frame['zip_key'].to_numpy(dtype=np.int32)
+        self.lat = frame['lat'].to_numpy(dtype=np.float64)
+        self.lng = frame['lng'].to_numpy(dtype=np.float64)
+        self.city = frame['city'].to_numpy(dtype=object)
+        self.state = frame['state'].to_numpy(dtype=object)
+
+    def __len__(self):
+        return len(self.zip_keys)
+
+    @staticmethod
+    def _normalize_frame(frame):
+        """统一列名，ZIP转为整数键并排序去重"""
+        frame = frame.rename(columns=lambda c: GAZETTEER_COLUMN_ALIASES.get(str(c).strip().lower(), str(c).strip().lower()))
+        missing = [col for col in ('zipcode', 'lat', 'lng') if col not in frame.columns]
+        if missing:
+            raise ValueError(f'Gazetteer missing columns: {missing}')
+
+        for col in ('city', 'state'):
+            if col not in frame.columns:
+                frame[col] = None
+
+        zip_digits = frame['zipcode'].astype(str).str.extract(r'^\s*(\d{1,5})', expand=False)
+        frame = frame.assign(
+            zip_key=pd.to_numeric(zip_digits, errors='coerce'),
+            lat=pd.to_numeric(frame['lat'], errors='coerce'),
+            lng=pd.to_numeric(frame['lng'], errors='coerce'),
+        )
+        frame = frame.dropna(subset=['zip_key', 'lat', 'lng'])
+        frame = frame.sort_values('zip_key').drop_duplicates('zip_key', keep='first')
+        return frame
+
+    @classmethod
+    def from_file(cls, path):
+        """从文件加载：CSV / Parquet / SQLite / GeoNames US.txt"""
+        ext = os.path.splitext(path)[1].lower()
+
+        if ext == '.parquet':
+            frame = pd.read_parquet(path)
+        elif ext in ('.sqlite', '.sqlite3', '.db'):
+            with sqlite3.connect(f'file:{path}?mode=ro', uri=True) as conn:
+                frame = pd.read_sql_query('SELECT * FROM zip_centroids', conn)
+        elif ext == '.txt':
+            frame = pd.read_csv(path, sep='\t', header=None, names=GEONAMES_COLUMNS,
+                                usecols=['zipcode', 'city', 'state', 'lat', 'lng'],
+                                dtype={'zipcode': str})
+        else:
+            frame = pd.read_csv(path, dtype=str)
+
+        return cls(frame)
+
+    def lookup(self, zipcodes):
+        """一次向量化join解析整批ZIP，未命中的行坐标为NaN"""
+        zipcodes = pd.Series(pd.unique(pd.Series(zipcodes, dtype=object).dropna()), dtype=object)
+        keys = pd.to_numeric(zipcodes, errors='coerce').to_numpy(dtype=np.float64)
+
+        result = pd.DataFrame({
+            'zipcode': zipcodes,
+            'lat': np.nan,
+            'lng': np.nan,
+            'city': None,
+            'state': None,
+        })
+        if len(self.zip_keys) == 0 or len(zipcodes) == 0:
+            return result
+
+        valid = ~np.isnan(keys)
+        positions = np.searchsorted(self.zip_keys, keys[valid].astype(np.int32))
+        positions = np.minimum(positions, len(self.zip_keys) - 1)
+        found = self.zip_keys[positions] == keys[valid].astype(np.int32)
+
+        hit_rows = np.flatnonzero(valid)[found]
+        hit_positions = positions[found]
+        result.loc[hit_rows, 'lat'] = self.lat[hit_positions]
+        result.loc[hit_rows, 'lng'] = self.lng[hit_positions]
+        result.loc[hit_rows, 'city'] = self.city[hit_positions]
+        result.loc[hit_rows, 'state'] = self.state[hit_positions]
+        return result
+
+
+def load_gazetteer(path=None):
+    """按环境变量 ZIP_GAZETTEER_PATH 加载本地质心库，不存在时返回空库"""
+    path = path or os.environ.get('ZIP_GAZETTEER_PATH', os.path.join('data', 'zip_centroids.csv'))
+
+    if not path or not os.path.exists(path):
+        print(f"⚠️ 未找到本地邮编库 ({path})，将全部使用API地理编码")
+        return ZipGazetteer()
+
+    try:
+        gazetteer = ZipGazetteer.from_file(path)
+        print(f"📚 本地邮编库已加载: {len(gazetteer)} 个ZIP ({path})")
+        return gazetteer
+    except Exception as e:
+        print(f"⚠️ 本地邮编库加载失败 ({path}): {e}")
+        return ZipGazetteer()
+
+
+class GeocodeCache:
+    """多进程共享的磁盘地理编码缓存（SQLite WAL），带LRU容量上限和正/负结果TTL"""
+
+    def __init__(self, path, max_entries=200000, ttl=30 * 24 * 3600, negative_ttl=24 * 3600,
+                 memory_entries=50000):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory_entries = memory_entries
+        self._local = threading.local()
+        self._memory = OrderedDict()  # zipcode → (lat, lng, expires_at)
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                zipcode TEXT PRIMARY KEY,
+                lat REAL,
+                lng REAL,
+                city TEXT,
+                state TEXT,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_geocode_last_used ON geocode_cache(last_used)')
+        conn.commit()
+
+    def _connection(self):
+        """每个线程一个连接，WAL模式允许多个worker进程并发读写"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, zipcode, lat, lng, expires_at):
+        with self._lock:
+            self._memory[zipcode] = (lat, lng, expires_at)
+            self._memory.move_to_end(zipcode)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def warm(self):
+        """启动预热：把未过期的条目（按最近使用排序）载入进程内存"""
+        now = time.time()
+        rows = self._connection().execute(
+            'SELECT zipcode, lat, lng, expires_at FROM geocode_cache '
+            'WHERE expires_at > ? ORDER BY last_used DESC LIMIT ?',
+            (now, self.memory_entries)
+        ).fetchall()
+        for zipcode, lat, lng, expires_at in reversed(rows):
+            self._remember(zipcode, lat, lng, expires_at)
+        print(f"🔥 地理编码缓存预热: {len(rows)} 个邮编")
+        return len(rows)
+
+    def get_many(self, zipcodes):
+        """批量查询，返回 {zipcode: (lat, lng)}；负缓存为 (None, None)，缺失或过期的不返回"""
+        now = time.time()
+        found = {}
+        pending = []
+
+        with self._lock:
+            for zipcode in zipcodes:
+                entry = self._memory.get(zipcode)
+                if entry is not None and entry[2] > now:
+                    found[zipcode] = (entry[0], entry[1])
+                    self._memory.move_to_end(zipcode)
+                else:
+                    pending.append(zipcode)
+
+        conn = self._connection()
+        for start in range(0, len(pending), 500):
+            batch = pending[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = conn.execute(
+                f'SELECT zipcode, lat, lng, expires_at FROM geocode_cache '
+                f'WHERE zipcode IN ({placeholders}) AND expires_at > ?',
+                (*batch, now)
+            ).fetchall()
+            for zipcode, lat, lng, expires_at in rows:
+                found[zipcode] = (lat, lng)
+                self._remember(zipcode, lat, lng, expires_at)
+
+        if found:
+            hits = list(found)
+            for start in range(0, len(hits), 500):
+                batch = hits[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                conn.execute(f'UPDATE geocode_cache SET last_used = ? WHERE zipcode IN ({placeholders})',
+                             (now, *batch))
+            conn.commit()
+
+        return found
+
+    def get(self, zipcode):
+        """单个查询，未缓存返回None"""
+        return self.get_many([zipcode]).get(zipcode)
+
+    def put_many(self, entries):
+        """批量写入 [(zipcode, lat, lng, city, state)]，lat为None视为负结果"""
+        now = time.time()
+        rows = []
+        for zipcode, lat, lng, city, state in entries:
+            expires_at = now + (self.negative_ttl if lat is None else self.ttl)
+            rows.append((zipcode, lat, lng, city, state, expires_at, now))
+            self._remember(zipcode, lat, lng, expires_at)
+
+        if not rows:
+            return
+
+        conn = self._connection()
+        conn.executemany(
+            'INSERT OR REPLACE INTO geocode_cache (zipcode, lat, lng, city, state, expires_at, last_used) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        conn.commit()
+
+        with self._lock:
+            self._writes_since_evict += len(rows)
+            should_evict = self._writes_since_evict >= 1000
+        if should_evict:
+            self.evict()
+
+    def put(self, zipcode, lat, lng, city=None, state=None):
+        self.put_many([(zipcode, lat, lng, city, state)])
+
+    def evict(self):
+        """删除过期条目，并按LRU裁剪到容量上限"""
+        with self._lock:
+            self._writes_since_evict = 0
+        conn = self._connection()
+        conn.execute('DELETE FROM geocode_cache WHERE expires_at <= ?', (time.time(),))
+        count = conn.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                'DELETE FROM geocode_cache WHERE zipcode IN ('
+                'SELECT zipcode FROM geocode_cache ORDER BY last_used ASC LIMIT ?)',
+                (count - self.max_entries,)
+            )
+        conn.commit()
+
+
+def load_geocode_cache():
+    """按环境变量创建共享地理编码缓存"""
+    cache = GeocodeCache(
+        os.environ.get('GEOCODE_CACHE_PATH', os.path.join('data', 'geocode_cache.sqlite3')),
+        max_entries=int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', 200000)),
+        ttl=float(os.environ.get('GEOCODE_CACHE_TTL', 30 * 24 * 3600)),
+        negative_ttl=float(os.environ.get('GEOCODE_CACHE_NEGATIVE_TTL', 24 * 3600)),
+    )
+    if os.environ.get('GEOCODE_CACHE_WARM', '0') == '1':
+        cache.warm()
+    return cache
+
+
+class TokenBucket:
+    """令牌桶限流：平均每秒 rate 个请求，允许 capacity 的突发（capacity 至少为1，否则永远攒不够一个令牌）"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity or rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ConcurrentGeocoder:
+    """并发地理编码：线程池 + 连接池Session + 令牌桶限流 + 抖动退避重试 + 同ZIP请求合并"""
+
+    def __init__(self, api_base, cache=None, max_workers=8, rate=10, burst=None,
+                 max_retries=3, backoff=0.5, timeout=5):
+        self.api_base = api_base
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate, burst)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='geocode')
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _fetch(self, zipcode):
+        """请求单个ZIP，返回 (lat, lng, city, state, definitive)；definitive为False表示临时失败不应缓存"""
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(f"{self.api_base}{zipcode}", timeout=self.timeout)
+
+                if response.status_code == 200:
+                    data = response.json()
+                    if 'places' in data and len(data['places']) > 0:
+                        place = data['places'][0]
+                        return (float(place['latitude']), float(place['longitude']),
+                                place['place name'], place['state abbreviation'], True)
+                    return (None, None, None, None, True)
+
+                if response.status_code == 404:
+                    return (None, None, None, None, True)
+
+                if response.status_code != 429 and response.status_code < 500:
+                    return (None, None, None, None, False)
+
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+        print(f"   ✗ {zipcode}: API请求失败（已重试{self.max_retries}次）")
+        return (None, None, None, None, False)
+
+    def _fetch_and_store(self, zipcode):
+        try:
+            lat, lng, city, state, definitive = self._fetch(zipcode)
+            if definitive and self.cache is not None:
+                self.cache.put(zipcode, lat, lng, city, state)
+            return (lat, lng, city, state)
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(zipcode, None)
+
+    def submit(self, zipcode):
+        """提交单个ZIP，同一ZIP正在请求中时复用同一个Future"""
+        with self._inflight_lock:
+            future = self._inflight.get(zipcode)
+            if future is None:
+                future = self.executor.submit(self._fetch_and_store, zipcode)
+                self._inflight[zipcode] = future
+            return future
+
+    def geocode(self, zipcode):
+        """单个ZIP地理编码，返回 (lat, lng)"""
+        frame = self.geocode_many([zipcode])
+        if frame.empty or pd.isna(frame.at[0, 'lat']):
+            return (None, None)
+        return (float(frame.at[0, 'lat']), float(frame.at[0, 'lng']))
+
+    def geocode_many(self, zipcodes, fetch=True):
+        """批量地理编码，先查缓存，未命中的并发请求API，返回 zipcode/lat/lng/city/state/source DataFrame
+        （source 为 cache / api，未解析为None）"""
+        zipcodes = [zipcode for zipcode in pd.unique(pd.Series(zipcodes, dtype=object).dropna()) if zipcode]
+        results = {}
+
+        if self.cache is not None:
+            for zipcode, (lat, lng) in self.cache.get_many(zipcodes).items():
+                results[zipcode] = (lat, lng, None, None)
+        cached = set(results)
+
+        misses = [zipcode for zipcode in zipcodes if zipcode not in results]
+        if misses and fetch:
+            print(f"🌐 并发请求 {len(misses)} 个邮编 (线程: {self.max_workers})...")
+            futures = {zipcode: self.submit(zipcode) for zipcode in misses}
+            for i, future in enumerate(as_completed(futures.values())):
+                if (i + 1) % 100 == 0:
+                    print(f"   进度: {i + 1}/{len(misses)}")
+            for zipcode, future in futures.items():
+                results[zipcode] = future.result()
+
+        rows = [(zipcode, *results.get(zipcode, (None, None, None, None))) for zipcode in zipcodes]
+        frame = pd.DataFrame(rows, columns=['zipcode', 'lat', 'lng', 'city', 'state'])
+        frame['lat'] = pd.to_numeric(frame['lat'])
+        frame['lng'] = pd.to_numeric(frame['lng'])
+        frame['source'] = np.where(frame['zipcode'].isin(cached), 'cache', 'api')
+        frame['source'] = frame['source'].where(frame['lat'].notna(), None)
+        return frame
+
+
+def load_geocoder(api_base, cache=None):
+    """按环境变量创建并发地理编码器"""
+    return ConcurrentGeocoder(
+        api_base,
+        cache=cache,
+        max_workers=int(os.environ.get('GEOCODE_WORKERS', 8)),
+        rate=float(os.environ.get('GEOCODE_RATE', 10)),
+        burst=float(os.environ.get('GEOCODE_BURST', 10)),
+        max_retries=int(os.environ.get('GEOCODE_MAX_RETRIES', 3)),
+        timeout=float(os.environ.get('GEOCODE_TIMEOUT', 5)),
+    )
@@ -0,0 +1,162 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """任务已被取消，在下一个阶段边界处中止流水线"""
+
+
+class Job:
+    """一个后台可视化任务：状态、阶段进度、结果或错误"""
+
+    def __init__(self, name, stages):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.stages = stages
+        self.status = 'queued'
+        self.stage = None
+        self.stage_history = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.future = None
+        self.cleanup = None
+        self._cancel_event = threading.Event()
+        # 保护 stage/stage_history：工作线程写入进度，请求线程同时读取任务状态
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def cancel(self):
+        """请求取消：排队中的任务直接取消，运行中的任务在下一个阶段边界中止"""
+        self._cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            self.status = 'cancelled'
+            self.finished_at = time.time()
+            if self.cleanup is not None:
+                self.cleanup()
+
+    def report(self, stage, **info):
+        """流水线进度回调：记录阶段，并检查是否已被取消"""
+        if self._cancel_event.is_set():
+            raise JobCancelled(self.id)
+        self._record(stage, info)
+
+    def _record(self, stage, info=None):
+        """记录阶段（不检查取消）"""
+        info = info or {}
+        now = time.time()
+        with self._lock:
+            if self.stage_history and self.stage_history[-1]['stage'] == stage:
+                # 同一阶段的重复报告（如逐块处理）只更新附加信息
+                self.stage_history[-1].update(info)
+                return
+
+            if self.stage_history:
+                self.stage_history[-1]['duration'] = round(now - self.stage_history[-1]['started_at'], 3)
+            self.stage = stage
+            self.stage_history.append({'stage': stage, 'started_at': now, **info})
+
+    def progress(self):
+        """按已到达阶段估算的完成百分比"""
+        if self.status == 'done':
+            return 100
+        if self.stage not in self.stages:
+            return 0
+        return int(self.stages.index(self.stage) / len(self.stages) * 100)
+
+    def to_dict(self):
+        # 在锁内复制阶段记录，序列化时不会遇到正在被修改的列表/字典
+        with self._lock:
+            stage = self.stage
+            progress = self.progress()
+            stage_history = [dict(entry) for entry in self.stage_history]
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'stage': stage,
+            'progress': progress,
+            'stages': stage_history,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """本地任务队列：固定数量的工作线程执行任务，结果保存在有上限和过期时间的存储中"""
+
+    def __init__(self, stages, max_workers=2, max_jobs=50, result_ttl=3600):
+        self.stages = stages
+        self.max_jobs = max_jobs
+        self.result_ttl = result_ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args, cleanup=None, **kwargs):
+        """提交任务，fn 以 progress=job.report 作为关键字参数被调用，返回值作为任务结果"""
+        job = Job(name, self.stages)
+        job.cleanup = cleanup
+
+        def run():
+            try:
+                if job._cancel_event.is_set():
+                    raise JobCancelled(job.id)
+                job.status = 'running'
+                job.started_at = time.time()
+                job.result = fn(*args, progress=job.report, **kwargs)
+                # fn 已返回时结果和副作用（结果缓存、历史入库）都已生效，此后到达的取消请求不再改变任务状态
+                job._record('done')
+                job.status = 'done'
+            except JobCancelled:
+                job.status = 'cancelled'
+                print(f"🛑 任务已取消: {job.id}")
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+                print(f"❌ 任务失败: {job.id}: {e}")
+                traceback.print_exc()
+            finally:
+                job.finished_at = time.time()
+                if cleanup is not None:
+                    cleanup()
+
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        job.future = self.executor.submit(run)
+        print(f"📥 任务已提交: {job.id} ({name})")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel()
+        return job
+
+    def _prune(self):
+        """删除过期的已完成任务；超过数量上限时从最早完成的任务开始删除"""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at and now - job.finished_at > self.result_ttl:
+                del self._jobs[job_id]
+
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        while len(self._jobs) > self.max_jobs and finished:
+            del self._jobs[finished.pop(0)]
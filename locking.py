@@ -0,0 +1,20 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """跨进程文件锁（fcntl.flock，多个gunicorn工作进程之间同样互斥）；shared=True 为共享锁（多个读者可同时持有）。
+    没有fcntl的平台（Windows）上只是打开锁文件，不加锁"""
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+
+class PipelineTimer:
+    """单次请求的阶段计时：作为流水线的progress回调使用，记录每个阶段的耗时和附加信息
+    （rows / rows_out / bytes / copied_bytes / mapped_bytes / lookups 等），可串联另一个progress回调（如后台任务的 job.report）"""
+
+    def __init__(self, forward=None):
+        self.forward = forward
+        self.stages = []
+        self._started = None
+
+    def __call__(self, stage, **info):
+        if self.forward is not None:
+            self.forward(stage, **info)
+
+        now = time.perf_counter()
+        if self.stages and self.stages[-1]['stage'] == stage:
+            # 同一阶段的重复报告只更新附加信息
+            self.stages[-1].update(info)
+            return
+
+        self._close(now)
+        self.stages.append({'stage': stage, **info})
+        self._started = now
+
+    def _close(self, now):
+        if self.stages and 'seconds' not in self.stages[-1]:
+            self.stages[-1]['seconds'] = round(now - self._started, 4)
+
+    def finish(self):
+        """结束当前阶段，返回各阶段记录"""
+        self._close(time.perf_counter())
+        return self.stages
+
+    def total_seconds(self):
+        return round(sum(stage.get('seconds', 0) for stage in self.stages), 4)
+
+
+class MetricsRegistry:
+    """进程内指标：带标签的计数器，以Prometheus文本格式导出"""
+
+    def __init__(self, namespace='kepler'):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._values = {}
+        self._meta = {}
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe_pipeline(self, stages, source):
+        """记录一次流水线运行：每个阶段的耗时、输入/输出行数、产出字节数、进程间交接的复制/映射字节数和地理编码来源"""
+        self.inc('pipeline_runs_total', source=source)
+        for stage in stages:
+            name = stage['stage']
+            if 'seconds' in stage:
+                self.inc('pipeline_stage_seconds_sum', stage['seconds'], stage=name)
+                self.inc('pipeline_stage_seconds_count', stage=name)
+            if 'rows' in stage:
+                self.inc('pipeline_stage_rows_in_total', stage['rows'], stage=name)
+            if 'rows_out' in stage:
+                self.inc('pipeline_stage_rows_out_total', stage['rows_out'], stage=name)
+            if 'bytes' in stage:
+                self.inc('pipeline_stage_bytes_total', stage['bytes'], stage=name)
+            if 'copied_bytes' in stage:
+                self.inc('pipeline_handoff_copied_bytes_total', stage['copied_bytes'], stage=name)
+            if 'mapped_bytes' in stage:
+                self.inc('pipeline_handoff_mapped_bytes_total', stage['mapped_bytes'], stage=name)
+            for lookup_source, count in stage.get('lookups', {}).items():
+                self.inc('geocode_lookups_total', count, source=lookup_source)
+
+    def render(self):
+        """Prometheus文本格式（同一指标的 _sum/_count 合并为一个summary）"""
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            family = name[:-len('_sum')] if name.endswith('_sum') else name[:-len('_count')] if name.endswith('_count') else name
+            if family not in described and family in self._meta:
+                kind, help_text = self._meta[family]
+                lines.append(f'# HELP {self.namespace}_{family} {help_text}')
+                lines.append(f'# TYPE {self.namespace}_{family} {kind}')
+                described.add(family)
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in labels)
+            sample = f'{self.namespace}_{name}{{{label_text}}}' if label_text else f'{self.namespace}_{name}'
+            lines.append(f'{sample} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def create_registry():
+    """创建指标注册表并登记各指标的类型和说明"""
+    registry = MetricsRegistry()
+    registry.describe('pipeline_runs_total', 'counter', 'Pipeline runs by entry point.')
+    registry.describe('pipeline_stage_seconds', 'summary', 'Time spent in each pipeline stage.')
+    registry.describe('pipeline_stage_rows_in_total', 'counter', 'Rows entering each pipeline stage.')
+    registry.describe('pipeline_stage_rows_out_total', 'counter', 'Rows produced by each pipeline stage.')
+    registry.describe('pipeline_stage_bytes_total', 'counter', 'Bytes produced by each pipeline stage.')
+    registry.describe('pipeline_handoff_copied_bytes_total', 'counter', 'Bytes copied into the web process when receiving worker results (pipe payload and DataFrame conversion).')
+    registry.describe('pipeline_handoff_mapped_bytes_total', 'counter', 'Bytes read from worker result files through a memory map instead of the pipe.')
+    registry.describe('geocode_lookups_total', 'counter', 'Unique ZIP lookups by resolution source.')
+    registry.describe('result_cache_requests_total', 'counter', 'Result cache lookups by outcome.')
+    registry.describe('map_data_bytes_total', 'counter', 'Map data bytes served, by format and content encoding.')
+    registry.describe('shipment_store_batches_total', 'counter', 'History store batches written or dropped by the background writer, by outcome.')
+    return registry
@@ -0,0 +1,229 @@
+import atexit
+import io
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+
+def csv_byte_ranges(path, shard_bytes, min_shards=1):
+    """把CSV文件（跳过表头）按字节切分为若干分片，分片边界对齐到换行符，返回 [(起始, 结束)]；
+    假设引号内的字段不包含换行（常见导出文件都满足）"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        header_end = f.tell()
+        body_size = size - header_end
+        if body_size <= 0:
+            return []
+
+        shards = max(min_shards, -(-body_size // shard_bytes))
+        step = -(-body_size // shards)
+        boundaries = [header_end]
+        for i in range(1, shards):
+            position = header_end + i * step
+            if position <= boundaries[-1]:
+                continue
+            f.seek(position)
+            f.readline()
+            boundary = min(f.tell(), size)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        if boundaries[-1] < size:
+            boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_csv_range(path, start, end, names, **read_csv_kwargs):
+    """读取文件中 [start, end) 字节范围内的CSV行（无表头，列名由names给出）"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return pd.read_csv(io.BytesIO(data), header=None, names=names, **read_csv_kwargs)
+
+
+def dictionary_encode_strings(table):
+    """低基数字符串列字典编码（唯一值不超过行数一半的列）：交接文件中每个唯一值只存一份，
+    主进程转换时只复制整数编码，不为每行创建字符串对象"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    for i, field in enumerate(table.schema):
+        if not (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)):
+            continue
+        encoded = pc.dictionary_encode(table.column(i))
+        if sum(len(chunk.dictionary) for chunk in encoded.chunks) <= table.num_rows // 2:
+            table = table.set_column(i, field.name, encoded)
+    return table
+
+
+def send_frame(frame, handoff='arrow', directory=None):
+    """工作进程把结果交回主进程：arrow 方式把字符串列字典编码后写入共享内存目录中的Arrow IPC文件，
+    只通过管道传递路径；pickle 方式（或该分片无法转为Arrow时）序列化后经管道整体传递"""
+    if handoff == 'arrow':
+        import pyarrow as pa
+        try:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            table = None
+        if table is not None:
+            table = dictionary_encode_strings(table)
+            path = os.path.join(directory or tempfile.gettempdir(), f'shard-{uuid.uuid4().hex}.arrow')
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            return ('arrow', path, os.path.getsize(path))
+    return ('pickle', pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def frame_nbytes(frame):
+    return int(frame.memory_usage(deep=True, index=False).sum())
+
+
+def receive_shard(handoff):
+    """主进程接收分片结果，返回 (分片, 经管道复制的字节数, 内存映射的字节数)：
+    arrow 方式返回以内存映射打开的Arrow表（不读入、不复制），pickle 方式返回反序列化后的DataFrame
+    （管道传递整个序列化结果，反序列化时再复制一次）"""
+    if handoff[0] == 'arrow':
+        import pyarrow as pa
+        _, path, size = handoff
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        finally:
+            # 映射已建立，删除文件名不影响读取；映射在最后一个引用它的数组释放后解除
+            os.unlink(path)
+        return table, 0, size
+    payload = handoff[1]
+    frame = pickle.loads(payload)
+    return frame, len(payload) + frame_nbytes(frame), 0
+
+
+def buffer_ranges(table):
+    """Arrow表各列缓冲区的地址范围（内存映射读取时即映射内存中的位置）"""
+    ranges = []
+    for column in table.columns:
+        for chunk in column.chunks:
+            ranges.extend((buffer.address, buffer.address + buffer.size) for buffer in chunk.buffers() if buffer is not None)
+    return ranges
+
+
+def copied_nbytes(frame, ranges):
+    """DataFrame中不直接引用给定内存范围（映射内存）的列的字节数，即转换时复制出的数据量"""
+    copied = 0
+    for name in frame.columns:
+        column = frame[name]
+        if column.dtype != object and not isinstance(column.dtype, pd.CategoricalDtype):
+            address = column.to_numpy().__array_interface__['data'][0]
+            if any(start <= address < end for start, end in ranges):
+                continue
+        copied += int(column.memory_usage(deep=True, index=False))
+    return copied
+
+
+def combine_shards(shards):
+    """按顺序拼接各分片，返回 (DataFrame, 转换和拼接时复制的字节数)。
+    全部为Arrow表时零拷贝拼接（每个分片成为列的一个块）后只转换一次：split_blocks 让各列单独成块，
+    self_destruct 转换后即释放Arrow缓冲区。只有一个块且无缺失值的数值列直接引用映射内存；
+    多个分片的列需要连接为连续数组，复制一次（逐片转换再拼接为两次）；字典编码列转换为分类列，只复制编码。
+    有分片回退为pickle时逐片转换后拼接"""
+    import pyarrow as pa
+
+    if all(isinstance(shard, pa.Table) for shard in shards):
+        table = pa.concat_tables(shards, promote_options='permissive')
+        shards.clear()
+        ranges = buffer_ranges(table)
+        frame = table.to_pandas(split_blocks=True, self_destruct=True)
+        del table
+        return frame, copied_nbytes(frame, ranges)
+
+    frames = []
+    copied = 0
+    for shard in shards:
+        if isinstance(shard, pa.Table):
+            shard = shard.to_pandas()
+            copied += frame_nbytes(shard)
+        frames.append(shard)
+    shards.clear()
+    frame = pd.concat(frames, ignore_index=True)
+    return frame, copied + frame_nbytes(frame)
+
+
+def prepare_csv_shard(prepare, path, start, end, names, read_csv_kwargs, handoff='pickle', handoff_dir=None):
+    """进程池任务：读取CSV文件的一个字节范围分片，用 prepare(数据块, report=统计) 清洗，
+    返回 (有效数据的交接句柄, 原始行数, 清洗统计)；所有依赖都通过参数传入，工作进程不导入Web应用"""
+    chunk = read_csv_range(path, start, end, names, **read_csv_kwargs)
+    report = {}
+    prepared = prepare(chunk, report=report)
+    return send_frame(prepared, handoff, handoff_dir), len(chunk), report
+
+
+def pool_context(start_method=None):
+    """进程池的启动方式：默认 forkserver（不可用时 spawn）。不使用 fork：进程池在请求/任务线程中按需创建，
+    此时地理编码线程池、任务线程和SQLite连接都在运行，fork 可能复制被其他线程持有的锁而死锁"""
+    if start_method is None:
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        # forkserver预先导入主模块（子进程由此继承，不再各自重新导入）和本模块及其依赖（pandas等），
+        # 工作进程从这个单线程的服务进程fork，不继承Web进程的线程和锁
+        context.set_forkserver_preload(['__main__', 'parallel'])
+    return context
+
+
+class ShardPool:
+    """按需创建的常驻进程池，供大文件分片并行清洗使用（workers<=1 时禁用）；
+    handoff 为分片结果交回主进程的方式（arrow / pickle），handoff_dir 为共享内存目录"""
+
+    def __init__(self, workers=0, min_bytes=64 * 1024 ** 2, shard_bytes=32 * 1024 ** 2, handoff='arrow', handoff_dir=None, start_method=None):
+        self.workers = workers
+        self.start_method = start_method
+        self.min_bytes = min_bytes
+        self.shard_bytes = shard_bytes
+        self.handoff = handoff
+        self.handoff_dir = handoff_dir
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.workers > 1
+
+    def should_use(self, path):
+        return self.enabled and os.path.getsize(path) >= self.min_bytes
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context(self.start_method))
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def load_shard_pool():
+    """按环境变量创建并行清洗进程池：PARALLEL_WORKERS（0或1为禁用）、PARALLEL_MIN_BYTES（小于此大小的文件串行处理）、
+    PARALLEL_SHARD_BYTES（每个分片的目标字节数）、PARALLEL_HANDOFF（arrow或pickle，未安装pyarrow时为pickle）、
+    PARALLEL_HANDOFF_DIR（默认 /dev/shm，不存在时为系统临时目录）、PARALLEL_START_METHOD（forkserver或spawn）"""
+    handoff = os.environ.get('PARALLEL_HANDOFF', 'arrow')
+    if handoff == 'arrow':
+        try:
+            import pyarrow
+        except ImportError:
+            handoff = 'pickle'
+    default_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return ShardPool(
+        workers=int(os.environ.get('PARALLEL_WORKERS', 0)),
+        min_bytes=int(os.environ.get('PARALLEL_MIN_BYTES', 64 * 1024 ** 2)),
+        shard_bytes=int(os.environ.get('PARALLEL_SHARD_BYTES', 32 * 1024 ** 2)),
+        handoff=handoff,
+        handoff_dir=os.environ.get('PARALLEL_HANDOFF_DIR', default_dir),
+        start_method=os.environ.get('PARALLEL_START_METHOD') or None,
+    )
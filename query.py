@@ -0,0 +1,115 @@
+import fnmatch
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+# 建立倒排索引的分类列（数据集中存在时）
+INDEXED_COLUMNS = ['warehouse', 'warehouse_zipcode', 'carrier', 'business_type', 'dest_zipcode', 'dest_city', 'distance_band']
+
+
+class ShipmentIndex:
+    """处理后数据集的查询索引：按 shipment_ts 排序一次，时间窗口用二分查找定位连续区间；
+    每个分类列保存行编码和倒排表（每个类别的行位置，已按时间有序），过滤时从命中行最少的条件出发"""
+
+    def __init__(self, frame):
+        order = np.argsort(frame['shipment_ts'].to_numpy(), kind='stable')
+        self.frame = frame.iloc[order].reset_index(drop=True)
+        self.timestamps = self.frame['shipment_ts'].to_numpy()
+        self.codes = {}
+        self.categories = {}
+        self.postings = {}
+
+        for column in INDEXED_COLUMNS:
+            if column not in self.frame.columns:
+                continue
+            values = self.frame[column]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            codes = values.cat.codes.to_numpy()
+            # 按编码稳定排序后切分，得到每个类别的行位置（组内保持时间顺序）
+            by_code = np.argsort(codes, kind='stable')
+            counts = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+            start = int((codes < 0).sum())
+            bounds = np.concatenate([[0], np.cumsum(counts)]) + start
+            self.codes[column] = codes
+            self.categories[column] = values.cat.categories
+            self.postings[column] = [by_code[bounds[i]:bounds[i + 1]] for i in range(len(counts))]
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def nbytes(self):
+        return int(self.frame.memory_usage(deep=True).sum())
+
+    def time_window(self, start=None, end=None):
+        """[start, end) 对应的行区间"""
+        lo = 0 if start is None else int(np.searchsorted(self.timestamps, np.datetime64(start), side='left'))
+        hi = len(self.timestamps) if end is None else int(np.searchsorted(self.timestamps, np.datetime64(end), side='left'))
+        return lo, max(lo, hi)
+
+    def matching_codes(self, column, patterns):
+        """类别值 → 编码，支持通配符（如 NJ*）"""
+        if column not in self.codes:
+            raise ValueError(f'Column cannot be filtered: {column}')
+        categories = self.categories[column].astype(str)
+        return np.flatnonzero([any(fnmatch.fnmatchcase(value, pattern) for pattern in patterns) for value in categories])
+
+    def select(self, start=None, end=None, filters=None, bbox=None):
+        """按时间窗口、分类过滤（{列: [值或通配符]}）和目的地范围 (min_lng, min_lat, max_lng, max_lat) 选出行，
+        返回按时间排序的DataFrame"""
+        lo, hi = self.time_window(start, end)
+        candidates = None
+
+        conditions = [(column, self.matching_codes(column, patterns)) for column, patterns in (filters or {}).items()]
+        if conditions:
+            # 从候选行最少的条件出发：只取该条件倒排表中落在时间区间内的部分
+            conditions.sort(key=lambda item: sum(len(self.postings[item[0]][code]) for code in item[1]))
+            column, codes = conditions[0]
+            parts = []
+            for code in codes:
+                positions = self.postings[column][code]
+                parts.append(positions[np.searchsorted(positions, lo):np.searchsorted(positions, hi)])
+            candidates = np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype='int64')
+
+            # 其余条件在候选行上按编码检查
+            for column, codes in conditions[1:]:
+                candidates = candidates[np.isin(self.codes[column][candidates], codes)]
+
+        if bbox is not None:
+            min_lng, min_lat, max_lng, max_lat = bbox
+            positions = candidates if candidates is not None else np.arange(lo, hi)
+            lat = self.frame['dest_lat'].to_numpy()[positions]
+            lng = self.frame['dest_lng'].to_numpy()[positions]
+            candidates = positions[(lat >= min_lat) & (lat <= max_lat) & (lng >= min_lng) & (lng <= max_lng)]
+
+        if candidates is None:
+            return self.frame.iloc[lo:hi]
+        return self.frame.iloc[candidates]
+
+
+class IndexCache:
+    """按数据来源缓存由数据构建的索引（查询索引、动画帧等；LRU，按条目数量限制）"""
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source_id, build):
+        """返回 (索引, 是否新建)；未命中时调用 build() 读取数据并建立索引"""
+        with self._lock:
+            index = self._entries.get(source_id)
+            if index is not None:
+                self._entries.move_to_end(source_id)
+                return index, False
+
+        index = build()
+        with self._lock:
+            self._entries[source_id] = index
+            self._entries.move_to_end(source_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index, True
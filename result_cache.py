@@ -0,0 +1,193 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+
+
+# 缓存键是SHA-256十六进制摘要；来自请求的键在访问文件系统前必须先校验
+CACHE_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# 数据集以Arrow IPC文件保存：缓存目录中的文件被替换时读取只会得到数据或报错，不会像pickle那样执行代码
+DATA_FILE = 'kepler_data.arrow'
+
+
+def write_frame(frame, path):
+    """DataFrame → Arrow IPC文件（分类列保存为字典编码，读取后恢复原有类型）"""
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def read_frame(path):
+    """以内存映射读取Arrow IPC文件并转换为DataFrame"""
+    import pyarrow as pa
+
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all().to_pandas()
+
+
+class HashingReader:
+    """包装可读流，边读边计算SHA-256，用于流式上传的内容寻址"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hasher.update(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b'')
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def content_key(input_digest, settings):
+    """输入内容哈希 + 流水线设置 → 结果缓存键"""
+    payload = json.dumps({'input': input_digest, 'settings': settings}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """内容寻址的处理结果磁盘缓存：每个键一个目录（数据集 + 地图HTML + 统计），按总大小LRU淘汰"""
+
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_dir(self, key):
+        if not CACHE_KEY_PATTERN.fullmatch(key):
+            raise ValueError(f'Invalid cache key: {key!r}')
+        return os.path.join(self.directory, key)
+
+    def contains(self, key):
+        if not CACHE_KEY_PATTERN.fullmatch(key):
+            return False
+        entry_dir = self._entry_dir(key)
+        return os.path.exists(os.path.join(entry_dir, 'stats.json')) and os.path.exists(os.path.join(entry_dir, DATA_FILE))
+
+    def get(self, key, load_data=True):
+        """读取缓存条目，返回 {'kepler_data', 'html', 'stats'}；不存在返回None。load_data=False 时不加载数据集，
+        html 在只以分离模式（map shell）生成过的条目中为None；键格式无效时同样返回None"""
+        if not CACHE_KEY_PATTERN.fullmatch(key):
+            return None
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, 'stats.json'), encoding='utf-8') as f:
+                stats = json.load(f)
+            kepler_data = read_frame(os.path.join(entry_dir, DATA_FILE)) if load_data else None
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        html = self.get_blob(key, 'map.html.gz')
+        if html is not None:
+            html = gzip.decompress(html).decode('utf-8')
+
+        # 更新访问时间，作为LRU依据
+        os.utime(entry_dir, None)
+        return {'kepler_data': kepler_data, 'html': html, 'stats': stats}
+
+    def get_blob(self, key, name):
+        """读取条目中的附加文件（如压缩后的地图HTML、序列化后的数据集），不存在返回None"""
+        if not CACHE_KEY_PATTERN.fullmatch(key):
+            return None
+        try:
+            with open(os.path.join(self._entry_dir(key), name), 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def put_blob(self, key, name, data):
+        """向已有条目写入附加文件（先写临时文件再重命名）"""
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return
+        tmp_path = os.path.join(entry_dir, f'.tmp-{name}-{uuid.uuid4().hex}')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(entry_dir, name))
+
+    def put(self, key, kepler_data, html, stats):
+        """写入缓存条目（先写临时目录再原子重命名，多进程并发写入安全）；html可为None，
+        数据集无法转换为Arrow（如混合类型的列）时不缓存"""
+        import pyarrow as pa
+
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            if html is not None and self.get_blob(key, 'map.html.gz') is None:
+                self.put_blob(key, 'map.html.gz', gzip.compress(html.encode('utf-8'), compresslevel=6))
+            os.utime(entry_dir, None)
+            return
+
+        tmp_dir = os.path.join(self.directory, f'.tmp-{key}-{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        try:
+            write_frame(kepler_data, os.path.join(tmp_dir, DATA_FILE))
+            if html is not None:
+                with gzip.open(os.path.join(tmp_dir, 'map.html.gz'), 'wt', encoding='utf-8', compresslevel=6) as f:
+                    f.write(html)
+            with open(os.path.join(tmp_dir, 'stats.json'), 'w', encoding='utf-8') as f:
+                json.dump(stats, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # 其他进程已写入同一个键
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            print(f"⚠️ 结果缓存写入跳过（数据集无法转换为Arrow）: {e}")
+            return
+
+        self.evict()
+
+    def _entry_size(self, entry_dir):
+        return sum(
+            os.path.getsize(os.path.join(entry_dir, name))
+            for name in os.listdir(entry_dir)
+        )
+
+    def evict(self):
+        """总大小超过上限时，从最久未访问的条目开始删除"""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                entry_dir = os.path.join(self.directory, name)
+                if name.startswith('.tmp-') or not os.path.isdir(entry_dir):
+                    continue
+                try:
+                    entries.append((os.path.getmtime(entry_dir), self._entry_size(entry_dir), entry_dir))
+                except FileNotFoundError:
+                    continue
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                print(f"🗑️ 结果缓存淘汰: {os.path.basename(entry_dir)}")
+
+
+def load_result_cache():
+    """按环境变量创建结果缓存，RESULT_CACHE_MAX_BYTES=0 或未安装pyarrow时禁用"""
+    max_bytes = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 ** 3))
+    if max_bytes <= 0:
+        return None
+    try:
+        import pyarrow
+    except ImportError:
+        print("⚠️ 未安装pyarrow，结果缓存已禁用")
+        return None
+    return ResultCache(os.environ.get('RESULT_CACHE_DIR', os.path.join('data', 'result_cache')), max_bytes)
@@ -0,0 +1,341 @@
+import atexit
+import fnmatch
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from urllib.parse import quote, unquote
+from locking import file_lock
+
+
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def unify_tables(tables):
+    """拼接多个Arrow表：不同批次的列可能不同（如是否启用路线指标），缺失的列补空；同名列类型不一致
+    （如透传的ID列在列式JSON中为整数、在CSV上传中为字符串）时统一为字符串"""
+    import pyarrow as pa
+
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types.setdefault(field.name, set()).add(field.type)
+    conflicting = {name for name, field_types in types.items() if len(field_types) > 1}
+    if conflicting:
+        tables = [
+            table.cast(pa.schema([
+                field.with_type(pa.string()) if field.name in conflicting else field
+                for field in table.schema
+            ]))
+            for table in tables
+        ]
+    return pa.concat_tables(tables, promote_options='permissive')
+
+
+class ShipmentStore:
+    """历史逐单数据的Parquet存储：按 shipment_date=YYYY-MM-DD/warehouse=<仓库>/ 分区。
+    请求只把批次放入队列，由后台写入线程攒批写入（每次写入每个分区一个文件），分区文件数超过
+    compact_files 时合并为一个文件，超过 retention_days 的日期分区被删除；
+    写入/合并持有存储目录的排他文件锁，读取持有共享锁（多进程部署同样安全）；
+    on_write(outcome, batches, rows) 在每次后台写入后被调用（outcome 为 written / failed），用于记录指标"""
+
+    def __init__(self, directory, flush_seconds=2.0, compact_files=8, retention_days=0, max_pending=64, on_write=None):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.compact_files = compact_files
+        self.retention_days = retention_days
+        self.on_write = on_write
+        self.failed_batches = 0
+        self.last_error = None
+        self._batches_dir = os.path.join(directory, '_batches')
+        self._staging_dir = os.path.join(directory, '_staging')
+        self._lock_path = os.path.join(directory, '.lock')
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        os.makedirs(self._batches_dir, exist_ok=True)
+
+    def submit(self, kepler_data, batch_id):
+        """把一个批次放入写入队列（不等待写入完成）；已入库的batch_id（相同输入内容）不会重复写入"""
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='shipment-writer', daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+        self._queue.put((kepler_data, batch_id))
+
+    def flush(self, timeout=None):
+        """等待队列中的批次全部写入（进程退出时调用，避免丢失尚未写入的批次）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            # 攒批：等待 flush_seconds 内到达的其他批次，一起写入
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                rows, files = self.write(pending)
+                if rows:
+                    print(f"🗄️ 历史数据入库: {len(pending)} 个批次, {rows} 行 → {files} 个分区文件")
+                self._report('written', len(pending), rows)
+            except Exception as e:
+                # 写入是整体生效的（见write），失败的批次没有留下任何文件，重新提交相同内容会完整写入
+                self.failed_batches += len(pending)
+                self.last_error = str(e)
+                print(f"⚠️ 历史数据写入失败（{len(pending)} 个批次已丢弃）: {e}")
+                self._report('failed', len(pending), sum(len(kepler_data) for kepler_data, _ in pending))
+            finally:
+                for _ in pending:
+                    self._queue.task_done()
+
+    def _report(self, outcome, batches, rows):
+        if self.on_write is not None:
+            try:
+                self.on_write(outcome, batches, rows)
+            except Exception as e:
+                print(f"⚠️ 历史数据写入指标记录失败: {e}")
+
+    def _batch_path(self, batch_id):
+        return os.path.join(self._batches_dir, f'{batch_id}.json')
+
+    def write(self, batches):
+        """同步写入一组批次 [(kepler_data, batch_id)]：跳过已入库的batch_id，按分区合并后每个分区写一个文件，
+        再合并文件过多的分区并按保留期清理。返回 (写入行数, 写入文件数)。
+        分区文件和批次记录先全部写入暂存目录，成功后才移入分区；中途失败时已移入的文件被撤回，
+        不会留下没有批次记录的部分数据（否则重新提交会重复写入已落盘的分区）"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        with file_lock(self._lock_path):
+            # 持有排他锁时存在的暂存目录都是此前写入中断留下的
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+
+            partitions = {}
+            written = {}
+            rows = 0
+            for kepler_data, batch_id in batches:
+                if batch_id in written or os.path.exists(self._batch_path(batch_id)):
+                    continue
+                rows += len(kepler_data)
+                table = pa.Table.from_pandas(kepler_data, preserve_index=False)
+                groups = kepler_data.groupby(['shipment_date', 'warehouse'], sort=False, dropna=False, observed=True).indices
+                dates = set()
+                for (date, warehouse), indices in groups.items():
+                    date_value = self._partition_value(date)
+                    if date_value != NULL_PARTITION:
+                        dates.add(unquote(date_value))
+                    partition = os.path.join(f'shipment_date={date_value}', f'warehouse={self._partition_value(warehouse)}')
+                    partitions.setdefault(partition, []).append(table.take(indices))
+                written[batch_id] = max(dates) if dates else None
+
+            staging = os.path.join(self._staging_dir, uuid.uuid4().hex)
+            moves = []
+            try:
+                for partition, tables in partitions.items():
+                    name = f'part-{uuid.uuid4().hex}.parquet'
+                    staged = os.path.join(staging, partition, name)
+                    os.makedirs(os.path.dirname(staged), exist_ok=True)
+                    pq.write_table(unify_tables(tables), staged, compression='zstd')
+                    moves.append((staged, os.path.join(self.directory, partition, name)))
+                for batch_id, last_date in written.items():
+                    staged = os.path.join(staging, '_batches', f'{batch_id}.json')
+                    os.makedirs(os.path.dirname(staged), exist_ok=True)
+                    with open(staged, 'w', encoding='utf-8') as f:
+                        json.dump({'batch_id': batch_id, 'written_at': time.time(), 'last_date': last_date}, f)
+                    moves.append((staged, self._batch_path(batch_id)))
+
+                moved = []
+                try:
+                    for staged, target in moves:
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        os.replace(staged, target)
+                        moved.append(target)
+                except Exception:
+                    for target in moved:
+                        os.unlink(target)
+                    raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+            for partition in partitions:
+                partition_dir = os.path.join(self.directory, partition)
+                if self.compact_files and len(self._files(partition_dir)) > self.compact_files:
+                    self._compact(partition_dir, pq)
+
+            if self.retention_days:
+                self._expire()
+        return rows, len(partitions)
+
+    def _write_file(self, partition_dir, prefix, table, pq):
+        name = f'{prefix}-{uuid.uuid4().hex}.parquet'
+        tmp_path = os.path.join(partition_dir, f'.tmp-{name}')
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, os.path.join(partition_dir, name))
+
+    def _compact(self, partition_dir, pq):
+        """把分区内的所有文件合并为一个（调用方持有排他锁）"""
+        files = self._files(partition_dir)
+        table = unify_tables([pq.read_table(path, memory_map=True) for path in files])
+        self._write_file(partition_dir, 'compact', table, pq)
+        for path in files:
+            os.unlink(path)
+
+    def _expire(self):
+        """删除比最新日期早 retention_days 天以上的日期分区和对应的批次记录（调用方持有排他锁）；
+        以已入库的最新日期而不是当前时间为基准，补录的历史数据不会在写入后立即被删除。
+        批次记录按同一截止日期过期（批次中最新的日期早于截止日期时，它的数据已全部被删除），
+        数据仍在时批次记录不会先消失，重新提交相同内容不会重复入库"""
+        dates = [date for date, _ in self._subdirs(self.directory, 'shipment_date') if date != NULL_PARTITION]
+        if not dates:
+            return
+        import pandas as pd
+        cutoff = (pd.Timestamp(max(dates)) - pd.Timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        for date, date_dir in self._subdirs(self.directory, 'shipment_date'):
+            if date != NULL_PARTITION and date < cutoff:
+                shutil.rmtree(date_dir, ignore_errors=True)
+                print(f"🗑️ 历史数据过期删除: {date}")
+
+        for name in os.listdir(self._batches_dir):
+            path = os.path.join(self._batches_dir, name)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    last_date = json.load(f).get('last_date')
+            except (OSError, ValueError):
+                continue
+            if last_date is not None and last_date < cutoff:
+                os.unlink(path)
+
+    def _partition_value(self, value):
+        if value is None or value != value:
+            return NULL_PARTITION
+        return quote(str(value), safe='')
+
+    def _subdirs(self, directory, prefix):
+        """列出 <prefix>=<值> 形式的子目录，返回 [(值, 路径)]"""
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return [
+            (unquote(name[len(prefix) + 1:]), os.path.join(directory, name))
+            for name in sorted(names)
+            if name.startswith(prefix + '=')
+        ]
+
+    def _files(self, partition_dir):
+        try:
+            names = os.listdir(partition_dir)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(partition_dir, name) for name in sorted(names) if name.endswith('.parquet')]
+
+    def partitions(self, start=None, end=None, warehouses=None):
+        """按日期范围（含两端，YYYY-MM-DD）和仓库通配符（如 NJ*）裁剪分区，返回 [(日期, 仓库, 文件路径)]"""
+        files = []
+        for date, date_dir in self._subdirs(self.directory, 'shipment_date'):
+            if date != NULL_PARTITION and ((start and date < start) or (end and date > end)):
+                continue
+            if date == NULL_PARTITION and (start or end):
+                continue
+            for warehouse, warehouse_dir in self._subdirs(date_dir, 'warehouse'):
+                if warehouses and not any(fnmatch.fnmatchcase(warehouse, pattern) for pattern in warehouses):
+                    continue
+                files.extend((date, warehouse, path) for path in self._files(warehouse_dir))
+        return files
+
+    def _current_files(self, files):
+        """命中分区当前的文件：列出分区后可能发生过合并，读取时按分区目录重新列出（调用方持有共享锁）"""
+        partition_dirs = list(dict.fromkeys(os.path.dirname(path) for _, _, path in files))
+        return [path for partition_dir in partition_dirs for path in self._files(partition_dir)]
+
+    def fingerprint(self, files):
+        """命中文件的路径、大小和修改时间，作为查询结果的缓存键输入"""
+        fingerprint = []
+        for _, _, path in files:
+            try:
+                fingerprint.append((os.path.relpath(path, self.directory), os.path.getsize(path), os.path.getmtime(path)))
+            except FileNotFoundError:
+                continue
+        return fingerprint
+
+    def count_rows(self, files):
+        """命中分区的总行数（只读Parquet文件尾的元数据）"""
+        import pyarrow.parquet as pq
+
+        with file_lock(self._lock_path, shared=True):
+            return sum(pq.ParquetFile(path).metadata.num_rows for path in self._current_files(files))
+
+    def read(self, files, columns=None):
+        """读取命中分区的文件（内存映射、只读需要的列），拼接为DataFrame；没有文件时返回None"""
+        import pyarrow.parquet as pq
+
+        with file_lock(self._lock_path, shared=True):
+            tables = []
+            for path in self._current_files(files):
+                parquet_file = pq.ParquetFile(path, memory_map=True)
+                names = parquet_file.schema_arrow.names
+                tables.append(parquet_file.read(columns=[column for column in columns if column in names] if columns else None))
+        if not tables:
+            return None
+        return unify_tables(tables).to_pandas()
+
+    def summary(self):
+        """已入库的日期和仓库（只读目录名，不打开文件）"""
+        dates = set()
+        warehouses = set()
+        files = 0
+        for date, date_dir in self._subdirs(self.directory, 'shipment_date'):
+            for warehouse, warehouse_dir in self._subdirs(date_dir, 'warehouse'):
+                count = len(self._files(warehouse_dir))
+                if count:
+                    dates.add(date)
+                    warehouses.add(warehouse)
+                    files += count
+        known_dates = sorted(date for date in dates if date != NULL_PARTITION)
+        return {
+            'first_date': known_dates[0] if known_dates else None,
+            'last_date': known_dates[-1] if known_dates else None,
+            'days': len(known_dates),
+            'warehouses': sorted(warehouses),
+            'files': files,
+            'pending_batches': self._queue.unfinished_tasks,
+            'failed_batches': self.failed_batches,
+            'last_error': self.last_error,
+        }
+
+
+def load_shipment_store(on_write=None):
+    """按环境变量创建历史数据存储，SHIPMENT_STORE_DIR 为空或未安装pyarrow时禁用；
+    SHIPMENT_STORE_FLUSH_SECONDS（攒批等待秒数）、SHIPMENT_STORE_COMPACT_FILES（分区文件数超过此值时合并，0为不合并）、
+    SHIPMENT_STORE_RETENTION_DAYS（保留最新日期之前的天数，默认0即永久保留，设置后才会删除历史数据）"""
+    directory = os.environ.get('SHIPMENT_STORE_DIR', os.path.join('data', 'shipments'))
+    if not directory:
+        return None
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        print("⚠️ 未安装pyarrow，历史数据存储已禁用")
+        return None
+    return ShipmentStore(
+        directory,
+        flush_seconds=float(os.environ.get('SHIPMENT_STORE_FLUSH_SECONDS', 2)),
+        compact_files=int(os.environ.get('SHIPMENT_STORE_COMPACT_FILES', 8)),
+        retention_days=int(os.environ.get('SHIPMENT_STORE_RETENTION_DAYS', 0)),
+        on_write=on_write,
+    )
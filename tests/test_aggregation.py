@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+from aggregation import aggregate_flows, flow_keys, merge_flows
+
+
+def make_shipments(n, seed=0, days=5):
+    """构造逐单地图数据（仓库、目的地邮编和坐标一一对应）"""
+    rng = np.random.default_rng(seed)
+    warehouses = np.array(['NJ-01', 'TX-02', 'CA-03'])
+    origins = {'NJ-01': (40.7, -74.2, '07001'), 'TX-02': (32.8, -96.8, '75001'), 'CA-03': (34.0, -118.2, '90001')}
+    zipcodes = np.array([f'{z:05d}' for z in rng.integers(1000, 99999, 40)])
+    dest_lat = dict(zip(zipcodes, rng.uniform(25, 48, len(zipcodes))))
+    dest_lng = dict(zip(zipcodes, rng.uniform(-120, -70, len(zipcodes))))
+
+    warehouse = warehouses[rng.integers(0, len(warehouses), n)]
+    dest = zipcodes[rng.integers(0, len(zipcodes), n)]
+    return pd.DataFrame({
+        'shipment_ts': pd.Timestamp('2024-03-01') + pd.to_timedelta(rng.integers(0, days * 24 * 60, n), unit='min'),
+        'warehouse': pd.Categorical(warehouse),
+        'warehouse_zipcode': pd.Categorical([origins[w][2] for w in warehouse]),
+        'origin_lat': [origins[w][0] for w in warehouse],
+        'origin_lng': [origins[w][1] for w in warehouse],
+        'dest_zipcode': dest,
+        'dest_city': [f'City {z}' for z in dest],
+        'dest_lat': [dest_lat[z] for z in dest],
+        'dest_lng': [dest_lng[z] for z in dest],
+        'distance_km': rng.uniform(10, 4000, n),
+        'weight_kg': rng.uniform(0, 30, n),
+        'volume_m3': rng.uniform(0, 0.5, n),
+        'packages': rng.integers(1, 5, n),
+    })
+
+
+def normalized(flows):
+    keys = flow_keys(flows)
+    frame = flows.sort_values(keys).reset_index(drop=True)
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype(str)
+    return frame
+
+
+@pytest.mark.parametrize('dest_key', ['zipcode', 'geohash'])
+def test_merge_equals_aggregating_everything(dest_key):
+    shipments = make_shipments(3000)
+    # 追加部分与已有部分的时间有重叠，部分流向需要合并
+    existing, appended = shipments.iloc[:2000], shipments.iloc[2000:]
+
+    merged, changed = merge_flows(
+        aggregate_flows(existing, dest_key),
+        aggregate_flows(appended, dest_key),
+    )
+    expected = aggregate_flows(shipments, dest_key)
+
+    pd.testing.assert_frame_equal(normalized(merged), normalized(expected), check_dtype=False)
+    assert merged['shipment_count'].sum() == len(shipments)
+
+    keys = flow_keys(changed)
+    appended_keys = aggregate_flows(appended, dest_key)[keys].astype(str).drop_duplicates()
+    assert len(changed) == len(appended_keys)
+    assert set(map(tuple, changed[keys].astype(str).to_numpy())) == set(map(tuple, appended_keys.to_numpy()))
+
+
+def test_merge_disjoint_days_appends_new_flows():
+    existing = make_shipments(500, seed=1, days=2)
+    appended = make_shipments(500, seed=2, days=2)
+    appended['shipment_ts'] += pd.Timedelta(days=10)
+
+    base = aggregate_flows(existing)
+    delta = aggregate_flows(appended)
+    merged, changed = merge_flows(base, delta)
+
+    assert len(merged) == len(base) + len(delta)
+    pd.testing.assert_frame_equal(normalized(changed), normalized(delta), check_dtype=False)
+    assert isinstance(merged['warehouse'].dtype, pd.CategoricalDtype)
+
+
+def test_merge_keeps_values_missing_from_delta_categories():
+    """已有流向的分类值不在新批次的类别中时，合并后不能变为NaN"""
+    existing = make_shipments(200, seed=3, days=1)
+    existing['dest_city'] = pd.Categorical(['Los Angeles'] * len(existing))
+    appended = existing.iloc[:20].copy()
+    appended['dest_city'] = pd.Categorical(['LOS ANGELES'] * len(appended))
+
+    base = aggregate_flows(existing)
+    base['dest_city'] = base['dest_city'].astype('category')
+    delta = aggregate_flows(appended)
+    delta['dest_city'] = delta['dest_city'].astype('category')
+    merged, changed = merge_flows(base, delta)
+
+    assert changed['dest_city'].notna().all()
+    assert merged['dest_city'].notna().all()
+    assert set(changed['dest_city']) == {'Los Angeles'}
+    assert isinstance(merged['dest_city'].dtype, pd.CategoricalDtype)
+    assert merged['shipment_count'].sum() == len(existing) + len(appended)
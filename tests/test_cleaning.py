@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from cleaning import CATEGORY_COLUMNS, PREPARED_COLUMNS, compact_prepared, concat_prepared, normalize_zipcodes, parse_timestamps
+
+
+def test_normalize_zipcodes_handles_plus4_lost_zeros_and_floats():
+    zipcodes = pd.Series(['07114-1234', 7114, 7114.0, ' 10001 ', '900', '12', 'ABCDE', None, '123456789'])
+
+    assert normalize_zipcodes(zipcodes).tolist() == [
+        '07114', '07114', '07114', '10001', '00900', None, None, None, '12345'
+    ]
+
+
+def test_normalize_zipcodes_keeps_index():
+    zipcodes = pd.Series(['10001', '7114'], index=[5, 9])
+    assert normalize_zipcodes(zipcodes).index.tolist() == [5, 9]
+
+
+def test_parse_timestamps_text_and_report():
+    parsed, report = parse_timestamps(pd.Series(['03/01/24 08:30', None, 'yesterday', '12/31/23 23:59']))
+
+    assert parsed.tolist()[0] == pd.Timestamp('2024-03-01 08:30')
+    assert parsed.tolist()[3] == pd.Timestamp('2023-12-31 23:59')
+    assert parsed.isna().tolist() == [False, True, True, False]
+    assert report == {'parsed': 2, 'missing': 1, 'unparseable': 1}
+
+
+def test_parse_timestamps_epoch_seconds_and_milliseconds_match():
+    seconds, _ = parse_timestamps(pd.Series([1709281800, np.nan]))
+    millis, report = parse_timestamps(pd.Series([1709281800000, np.nan]))
+
+    assert seconds[0] == millis[0]
+    assert seconds[0] == pd.Timestamp.fromtimestamp(1709281800)
+    assert report == {'parsed': 1, 'missing': 1, 'unparseable': 0}
+
+
+def make_prepared(warehouses, cities, seed=0):
+    """构造清洗后的数据块（PREPARED_COLUMNS），仓库和城市按给定取值循环"""
+    n = len(warehouses)
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'id': [f'S{seed}-{i}' for i in range(n)],
+        'warehouse_name': warehouses,
+        'fixed_warehouse_zipcode': ['07001' if w == 'NJ-01' else '75001' for w in warehouses],
+        'shipment_ts': pd.Timestamp('2024-03-01') + pd.to_timedelta(np.arange(n), unit='h'),
+        'destination_zipcode': [f'{z:05d}' for z in rng.integers(1000, 99999, n)],
+        'shipto_city': cities,
+        'shipto_country_code': ['US'] * n,
+        'carrier': [None] * n,
+        'biz_type': ['B2C'] * n,
+        'gw': rng.uniform(0, 30, n),
+        'vol': rng.uniform(0, 0.5, n),
+        'pkg_num': rng.integers(1, 5, n).astype(float),
+    })[PREPARED_COLUMNS]
+
+
+def test_compact_prepared_uses_categories_and_float32():
+    chunk = compact_prepared(make_prepared(['NJ-01', 'TX-02'] * 50, ['Newark', None] * 50))
+
+    for col in CATEGORY_COLUMNS:
+        assert isinstance(chunk[col].dtype, pd.CategoricalDtype)
+    assert (chunk[['gw', 'vol', 'pkg_num']].dtypes == 'float32').all()
+    assert chunk['shipto_city'].isna().sum() == 50
+    assert chunk['carrier'].isna().all()
+
+
+def test_concat_prepared_keeps_values_of_different_categories():
+    first = make_prepared(['NJ-01'] * 10, ['Newark'] * 10, seed=1)
+    second = make_prepared(['TX-02'] * 10, [None] * 10, seed=2)
+
+    combined = concat_prepared([compact_prepared(first), compact_prepared(second)])
+    expected = pd.concat([first, second], ignore_index=True)
+
+    for col in CATEGORY_COLUMNS:
+        assert isinstance(combined[col].dtype, pd.CategoricalDtype)
+        assert combined[col].astype(object).fillna('').tolist() == expected[col].fillna('').tolist()
+    np.testing.assert_allclose(combined['gw'], expected['gw'], rtol=1e-6)
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+from aggregation import aggregate_flows
+from frames import AnimationFrames
+from test_aggregation import make_shipments
+
+
+def test_frames_cover_every_bucket_including_empty_ones():
+    shipments = make_shipments(300, seed=3, days=2)
+    # 去掉第二天的数据，留下一个空帧
+    day = shipments['shipment_ts'].dt.floor('D')
+    first_day = day.min()
+    shipments = shipments[day != first_day + pd.Timedelta(days=1)]
+    shipments = pd.concat([shipments, make_shipments(50, seed=4, days=1).assign(
+        shipment_ts=lambda frame: frame['shipment_ts'] + pd.Timedelta(days=2)
+    )], ignore_index=True)
+
+    frames = AnimationFrames(shipments, bucket='day')
+
+    assert len(frames) == 3
+    assert list(frames.starts) == list(pd.date_range(first_day, periods=3, freq='D'))
+    manifest = frames.manifest()
+    assert manifest[1]['flows'] == 0 and manifest[1]['shipments'] == 0
+    assert sum(frame['shipments'] for frame in manifest) == len(shipments)
+    assert frames.offsets[0] == 0 and frames.offsets[-1] == len(frames.flows)
+    assert np.all(np.diff(frames.offsets) >= 0)
+
+
+def test_window_returns_flows_of_consecutive_frames():
+    shipments = make_shipments(400, seed=5, days=4)
+    frames = AnimationFrames(shipments, bucket='day')
+
+    window = frames.window(1, 2)
+    start, end = frames.starts[1], frames.starts[1] + pd.Timedelta(days=2)
+    assert window['shipment_ts'].between(start, end, inclusive='left').all()
+    assert window['shipment_count'].sum() == frames.shipments[1] + frames.shipments[2]
+    assert frames.window_range(3, 10) == (3, 4)
+    assert frames.window_range(-2, 1) == (0, 1)
+    assert frames.frame_range(start, end) == (1, 3)
+
+
+def test_hourly_frames_and_empty_data():
+    shipments = make_shipments(200, seed=6, days=1)
+    frames = AnimationFrames(shipments, bucket='hour')
+    assert frames.shipments.sum() == len(shipments)
+    assert len(frames) <= 24
+
+    empty = AnimationFrames(shipments.iloc[:0], bucket='day')
+    assert len(empty) == 0
+    assert empty.manifest() == []
+    assert len(empty.window(0, 5)) == 0
+
+
+def test_aggregated_map_data_requires_matching_bucket():
+    flows = aggregate_flows(make_shipments(200, seed=7), 'zipcode', 'D', 5)
+
+    frames = AnimationFrames(flows, bucket='day', flows_bucket='D')
+    assert frames.shipments.sum() == flows['shipment_count'].sum()
+    with pytest.raises(ValueError, match='cannot be split'):
+        AnimationFrames(flows, bucket='hour', flows_bucket='D')
+    with pytest.raises(ValueError, match='Unsupported frame bucket'):
+        AnimationFrames(flows, bucket='week')
@@ -0,0 +1,172 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from geocoding import ConcurrentGeocoder, TokenBucket
+
+
+class StubZipApi:
+    """模拟 zippopotam.us 的本地HTTP服务：按邮编返回预设的状态码序列（用完后返回最后一个），记录每次请求"""
+
+    def __init__(self, statuses=None, delay=0):
+        self.statuses = statuses or {}
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                zipcode = self.path.rstrip('/').rsplit('/', 1)[-1]
+                with stub._lock:
+                    attempt = sum(1 for requested, _ in stub.requests if requested == zipcode)
+                    stub.requests.append((zipcode, time.monotonic()))
+                if stub.delay:
+                    time.sleep(stub.delay)
+                sequence = stub.statuses.get(zipcode, [200])
+                status = sequence[min(attempt, len(sequence) - 1)]
+                body = b''
+                if status == 200:
+                    body = json.dumps({'places': [{
+                        'latitude': '40.5', 'longitude': '-74.25',
+                        'place name': f'City {zipcode}', 'state abbreviation': 'NJ',
+                    }]}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def api_base(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/us/'
+
+    def count(self, zipcode):
+        return sum(1 for requested, _ in self.requests if requested == zipcode)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_api():
+    apis = []
+
+    def start(**kwargs):
+        api = StubZipApi(**kwargs)
+        apis.append(api)
+        return api
+
+    yield start
+    for api in apis:
+        api.close()
+
+
+def make_geocoder(api, **kwargs):
+    options = {'max_workers': 4, 'rate': 1000, 'burst': 1000, 'max_retries': 3, 'backoff': 0, 'timeout': 2}
+    options.update(kwargs)
+    return ConcurrentGeocoder(api.api_base, **options)
+
+
+def test_geocode_many_resolves_each_zipcode(stub_api):
+    api = stub_api()
+    frame = make_geocoder(api).geocode_many(['07001', '08002'])
+
+    assert list(frame['zipcode']) == ['07001', '08002']
+    assert list(frame['lat']) == [40.5, 40.5]
+    assert list(frame['lng']) == [-74.25, -74.25]
+    assert list(frame['city']) == ['City 07001', 'City 08002']
+    assert list(frame['source']) == ['api', 'api']
+
+
+def test_geocode_many_dedupes_zipcodes(stub_api):
+    api = stub_api()
+    frame = make_geocoder(api).geocode_many(['07001', '07001', None, '', '08002', '07001'])
+
+    assert list(frame['zipcode']) == ['07001', '08002']
+    assert api.count('07001') == 1
+    assert api.count('08002') == 1
+
+
+def test_concurrent_callers_share_inflight_request(stub_api):
+    """同一邮编正在请求中时，其他调用方复用同一个请求"""
+    api = stub_api(delay=0.3)
+    geocoder = make_geocoder(api)
+    frames = []
+    callers = [threading.Thread(target=lambda: frames.append(geocoder.geocode_many(['07001']))) for _ in range(4)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join(timeout=10)
+
+    assert len(frames) == 4
+    assert all(frame.at[0, 'lat'] == 40.5 for frame in frames)
+    assert api.count('07001') == 1
+
+
+def test_retries_transient_errors(stub_api):
+    api = stub_api(statuses={'07001': [503, 429, 200]})
+    frame = make_geocoder(api).geocode_many(['07001'])
+
+    assert frame.at[0, 'lat'] == 40.5
+    assert api.count('07001') == 3
+
+
+def test_gives_up_after_max_retries(stub_api):
+    api = stub_api(statuses={'07001': [503]})
+    frame = make_geocoder(api, max_retries=2).geocode_many(['07001'])
+
+    assert frame['lat'].isna().all()
+    assert frame.at[0, 'source'] is None
+    assert api.count('07001') == 3
+
+
+def test_does_not_retry_not_found(stub_api):
+    api = stub_api(statuses={'00000': [404]})
+    frame = make_geocoder(api).geocode_many(['00000'])
+
+    assert frame['lat'].isna().all()
+    assert api.count('00000') == 1
+
+
+def test_rate_limit_spaces_requests(stub_api):
+    api = stub_api()
+    zipcodes = [f'{i:05d}' for i in range(1, 7)]
+    frame = make_geocoder(api, rate=20, burst=1).geocode_many(zipcodes)
+
+    assert frame['lat'].notna().all()
+    times = sorted(requested_at for _, requested_at in api.requests)
+    # 突发为1：第一个请求之后的5个请求每个至少间隔 1/20 秒
+    assert times[-1] - times[0] >= 5 / 20 * 0.9
+
+
+def test_token_bucket_burst_allows_immediate_requests():
+    bucket = TokenBucket(rate=1, capacity=5)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.5
+
+
+@pytest.mark.parametrize('rate, capacity', [(100, 0.5), (0.5, None), (0.5, 0)])
+def test_token_bucket_capacity_below_one_still_acquires(rate, capacity):
+    """容量小于1（如 GEOCODE_RATE=0.5 且未设突发）时也能取得令牌，不会永远等待"""
+    bucket = TokenBucket(rate=rate, capacity=capacity)
+    done = threading.Event()
+
+    def acquire():
+        bucket.acquire()
+        done.set()
+
+    threading.Thread(target=acquire, daemon=True).start()
+    assert done.wait(timeout=5)
@@ -0,0 +1,131 @@
+import threading
+import time
+import pytest
+from jobs import JobManager
+
+STAGES = ['read', 'clean', 'render_map', 'done']
+
+
+def wait_finished(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.finished
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(STAGES, max_workers=1, max_jobs=3, result_ttl=3600)
+    yield manager
+    manager.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def test_job_runs_to_done_with_stage_history(manager):
+    def work(progress):
+        progress('read', rows=10)
+        progress('read', rows_out=10)
+        progress('clean')
+        return {'rows': 10}
+
+    job = manager.submit('upload.csv', work)
+    wait_finished(job)
+
+    info = job.to_dict()
+    assert info['status'] == 'done'
+    assert info['progress'] == 100
+    assert job.result == {'rows': 10}
+    assert [stage['stage'] for stage in info['stages']] == ['read', 'clean', 'done']
+    assert info['stages'][0]['rows'] == 10 and info['stages'][0]['rows_out'] == 10
+    assert 'duration' in info['stages'][0]
+
+
+def test_failed_job_records_error(manager):
+    def work(progress):
+        raise ValueError('bad csv')
+
+    job = manager.submit('upload.csv', work)
+    wait_finished(job)
+
+    assert job.status == 'failed'
+    assert job.error == 'bad csv'
+
+
+def test_cancel_stops_running_job_at_next_stage(manager):
+    started = threading.Event()
+    release = threading.Event()
+    cleaned = []
+
+    def work(progress):
+        progress('read')
+        started.set()
+        release.wait(5)
+        progress('clean')
+        return 'never'
+
+    job = manager.submit('upload.csv', work, cleanup=lambda: cleaned.append(True))
+    assert started.wait(5)
+    manager.cancel(job.id)
+    release.set()
+    wait_finished(job)
+
+    assert job.status == 'cancelled'
+    assert job.result is None
+    assert cleaned == [True]
+
+
+def test_cancel_after_work_returned_keeps_result(manager):
+    """fn 已返回后到达的取消请求不能把已生效的结果标记为取消"""
+    release = threading.Event()
+
+    def work(progress):
+        progress('read')
+        release.wait(5)
+        return 'result'
+
+    job = manager.submit('upload.csv', work)
+    record = job._record
+
+    def cancel_before_done(stage, info=None):
+        if stage == 'done':
+            job.cancel()
+        return record(stage, info)
+
+    job._record = cancel_before_done
+    release.set()
+    wait_finished(job)
+
+    assert job.status == 'done'
+    assert job.result == 'result'
+
+
+def test_queued_job_can_be_cancelled(manager):
+    release = threading.Event()
+    blocker = manager.submit('first', lambda progress: release.wait(5))
+    queued = manager.submit('second', lambda progress: 'never')
+
+    manager.cancel(queued.id)
+    release.set()
+    wait_finished(blocker)
+    wait_finished(queued)
+
+    assert queued.status == 'cancelled'
+    assert queued.result is None
+
+
+def test_to_dict_copies_stage_history(manager):
+    job = manager.submit('upload.csv', lambda progress: progress('read', rows=1))
+    wait_finished(job)
+
+    info = job.to_dict()
+    info['stages'][0]['rows'] = 99
+    assert job.stage_history[0]['rows'] == 1
+
+
+def test_finished_jobs_are_pruned_over_limit(manager):
+    jobs = [manager.submit(f'job-{i}', lambda progress: None) for i in range(5)]
+    for job in jobs:
+        wait_finished(job)
+    manager.submit('last', lambda progress: None)
+
+    assert manager.get(jobs[0].id) is None
+    assert len(manager._jobs) <= 3
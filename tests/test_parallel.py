@@ -0,0 +1,113 @@
+import pandas as pd
+import pytest
+from parallel import combine_shards, csv_byte_ranges, read_csv_range, receive_shard, send_frame
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    frame = pd.DataFrame({
+        'id': range(1000),
+        'warehouse_name': [f'WH-{i % 7}' for i in range(1000)],
+        'shipto_postal_code': [f'{(i * 37) % 99999:05d}' for i in range(1000)],
+        'gw': [round(i * 0.1, 2) for i in range(1000)],
+    })
+    path = tmp_path / 'shipments.csv'
+    frame.to_csv(path, index=False)
+    return path, frame
+
+
+def read_ranges(path, ranges):
+    names = pd.read_csv(path, nrows=0).columns.tolist()
+    parts = [read_csv_range(str(path), start, end, names, dtype={'shipto_postal_code': str}) for start, end in ranges]
+    return pd.concat(parts, ignore_index=True)
+
+
+@pytest.mark.parametrize('shard_bytes, min_shards', [(1 << 20, 1), (1 << 20, 4), (1000, 1), (37, 1), (1, 1)])
+def test_ranges_cover_body_on_line_boundaries(csv_file, shard_bytes, min_shards):
+    path, _ = csv_file
+    data = path.read_bytes()
+    header_end = data.index(b'\n') + 1
+    ranges = csv_byte_ranges(str(path), shard_bytes, min_shards)
+
+    assert ranges[0][0] == header_end
+    assert ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+    for start, end in ranges:
+        assert start < end
+        assert data[end - 1:end] == b'\n'
+    assert len(ranges) >= min(min_shards, data.count(b'\n') - 1)
+
+
+@pytest.mark.parametrize('shard_bytes, min_shards', [(1 << 20, 3), (1000, 1), (37, 1)])
+def test_shards_read_back_every_row_once(csv_file, shard_bytes, min_shards):
+    path, frame = csv_file
+    ranges = csv_byte_ranges(str(path), shard_bytes, min_shards)
+    merged = read_ranges(path, ranges)
+
+    pd.testing.assert_frame_equal(merged, frame)
+
+
+def test_file_without_trailing_newline(tmp_path):
+    path = tmp_path / 'shipments.csv'
+    path.write_bytes(b'id,gw\n1,0.5\n2,1.5\n3,2.5')
+    ranges = csv_byte_ranges(str(path), 4)
+
+    assert ranges[-1][1] == path.stat().st_size
+    assert read_ranges(path, ranges)['id'].tolist() == [1, 2, 3]
+
+
+def test_header_only_file_has_no_ranges(tmp_path):
+    path = tmp_path / 'shipments.csv'
+    path.write_bytes(b'id,gw\n')
+
+    assert csv_byte_ranges(str(path), 1024) == []
+
+
+def make_prepared(n, offset=0):
+    return pd.DataFrame({
+        'id': [str(offset + i) for i in range(n)],
+        'warehouse_name': [f'WH-{i % 3}' for i in range(n)],
+        'shipment_ts': pd.Timestamp('2024-01-01') + pd.to_timedelta(range(n), unit='min'),
+        'gw': [float(i) for i in range(n)],
+    })
+
+
+def test_arrow_handoff_matches_pickle(tmp_path):
+    frames = [make_prepared(100), make_prepared(50, offset=100)]
+    arrow_shards = [receive_shard(send_frame(frame, 'arrow', str(tmp_path)))[0] for frame in frames]
+    pickle_shards = [receive_shard(send_frame(frame, 'pickle'))[0] for frame in frames]
+
+    from_arrow, _ = combine_shards(arrow_shards)
+    from_pickle, _ = combine_shards(pickle_shards)
+
+    # 低基数字符串列经字典编码交接为分类列，高基数列保持字符串
+    assert isinstance(from_arrow['warehouse_name'].dtype, pd.CategoricalDtype)
+    assert from_arrow['id'].dtype == object
+    pd.testing.assert_frame_equal(
+        from_arrow.astype({'warehouse_name': object}), from_pickle, check_dtype=False
+    )
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_single_arrow_shard_keeps_numeric_columns_mapped(tmp_path):
+    frame = make_prepared(1000)
+    shard, copied, mapped = receive_shard(send_frame(frame, 'arrow', str(tmp_path)))
+    assert copied == 0 and mapped > 0
+
+    combined, copied = combine_shards([shard])
+    numeric_bytes = int(combined[['gw', 'shipment_ts']].memory_usage(index=False).sum())
+    # 数值列直接引用映射内存，只有字符串/分类列被复制
+    assert copied == int(combined.memory_usage(deep=True, index=False).sum()) - numeric_bytes
+    assert combined['gw'].tolist() == frame['gw'].tolist()
+
+
+def test_mixed_handoffs_are_combined_in_order(tmp_path):
+    shards = [
+        receive_shard(send_frame(make_prepared(10), 'arrow', str(tmp_path)))[0],
+        receive_shard(send_frame(make_prepared(10, offset=10), 'pickle'))[0],
+    ]
+    combined, copied = combine_shards(shards)
+
+    assert combined['id'].tolist() == [str(i) for i in range(20)]
+    assert copied > 0
@@ -0,0 +1,90 @@
+import fnmatch
+import numpy as np
+import pandas as pd
+import pytest
+from query import ShipmentIndex
+
+
+@pytest.fixture(scope='module')
+def shipments():
+    rng = np.random.default_rng(7)
+    n = 5000
+    warehouses = np.array(['NJ-01', 'NJ-02', 'TX-01', 'CA-01', None], dtype=object)
+    return pd.DataFrame({
+        'shipment_ts': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 30 * 24 * 60, n), unit='min'),
+        'warehouse': pd.Categorical(warehouses[rng.integers(0, len(warehouses), n)]),
+        'carrier': rng.choice(['UPS', 'FedEx', 'USPS'], n),
+        'dest_zipcode': [f'{z:05d}' for z in rng.integers(1000, 1100, n)],
+        'dest_lat': rng.uniform(25, 48, n),
+        'dest_lng': rng.uniform(-120, -70, n),
+        'row_id': np.arange(n),
+    })
+
+
+@pytest.fixture(scope='module')
+def index(shipments):
+    return ShipmentIndex(shipments)
+
+
+def expected_rows(frame, start=None, end=None, filters=None, bbox=None):
+    """不用索引的参考实现：逐列布尔过滤"""
+    mask = np.ones(len(frame), dtype=bool)
+    if start is not None:
+        mask &= (frame['shipment_ts'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (frame['shipment_ts'] < pd.Timestamp(end)).to_numpy()
+    for column, patterns in (filters or {}).items():
+        values = frame[column].astype(object)
+        mask &= values.map(lambda value: value is not None and value == value and any(
+            fnmatch.fnmatchcase(str(value), pattern) for pattern in patterns)).to_numpy(dtype=bool)
+    if bbox is not None:
+        min_lng, min_lat, max_lng, max_lat = bbox
+        mask &= ((frame['dest_lat'] >= min_lat) & (frame['dest_lat'] <= max_lat)
+                 & (frame['dest_lng'] >= min_lng) & (frame['dest_lng'] <= max_lng)).to_numpy()
+    return set(frame.loc[mask, 'row_id'])
+
+
+def test_index_sorts_by_time(index, shipments):
+    assert len(index) == len(shipments)
+    assert index.frame['shipment_ts'].is_monotonic_increasing
+
+
+def test_postings_list_rows_of_each_category_in_time_order(index):
+    for column, postings in index.postings.items():
+        codes = index.codes[column]
+        for code, positions in enumerate(postings):
+            assert np.all(np.diff(positions) > 0)
+            assert np.all(codes[positions] == code)
+        assert sum(len(positions) for positions in postings) == int((codes >= 0).sum())
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'start': '2024-01-05', 'end': '2024-01-12'},
+    {'filters': {'warehouse': ['NJ*']}},
+    {'filters': {'warehouse': ['TX-01'], 'carrier': ['UPS', 'USPS']}},
+    {'start': '2024-01-10', 'filters': {'dest_zipcode': ['0105*'], 'carrier': ['FedEx']}},
+    {'filters': {'warehouse': ['nothing']}},
+    {'bbox': (-100, 30, -80, 40)},
+    {'start': '2024-01-03', 'end': '2024-01-20', 'filters': {'warehouse': ['CA-01']}, 'bbox': (-110, 28, -75, 45)},
+])
+def test_select_matches_full_scan(index, shipments, query):
+    selected = index.select(**query)
+
+    assert set(selected['row_id']) == expected_rows(shipments, **query)
+    assert len(selected) == len(set(selected['row_id']))
+    assert selected['shipment_ts'].is_monotonic_increasing
+
+
+def test_time_window_is_half_open(index):
+    timestamp = index.frame['shipment_ts'].iloc[100]
+    lo, hi = index.time_window(timestamp, timestamp)
+    assert lo == hi
+    lo, hi = index.time_window(timestamp, timestamp + pd.Timedelta(minutes=1))
+    assert (index.frame['shipment_ts'].iloc[lo:hi] == timestamp).all()
+    assert hi > lo
+
+
+def test_unindexed_column_is_rejected(index):
+    with pytest.raises(ValueError):
+        index.select(filters={'row_id': ['1']})
@@ -0,0 +1,109 @@
+import hashlib
+import io
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from result_cache import DATA_FILE, HashingReader, ResultCache, content_key
+
+KEY = 'a' * 64
+OTHER_KEY = 'b' * 64
+
+
+def make_kepler_data(n=50):
+    return pd.DataFrame({
+        'shipment_id': [str(i) for i in range(n)],
+        'shipment_ts': pd.Timestamp('2024-01-01') + pd.to_timedelta(range(n), unit='h'),
+        'warehouse': pd.Categorical(['NJ-01', 'TX-01'] * (n // 2)),
+        'origin_lat': np.linspace(30, 40, n, dtype='float32'),
+        'packages': np.arange(n, dtype='int32'),
+    }, index=range(100, 100 + n))
+
+
+def test_content_key_depends_on_input_and_settings():
+    key = content_key('digest', {'max_rows': None})
+
+    assert key == content_key('digest', {'max_rows': None})
+    assert key != content_key('other', {'max_rows': None})
+    assert key != content_key('digest', {'max_rows': 10})
+    assert len(key) == 64
+
+
+def test_hashing_reader_hashes_what_was_read():
+    reader = HashingReader(io.BytesIO(b'id,gw\n1,2\n'))
+    assert b''.join(reader) == b'id,gw\n1,2\n'
+    assert reader.hexdigest() == hashlib.sha256(b'id,gw\n1,2\n').hexdigest()
+
+
+def test_round_trip_keeps_values_and_compact_dtypes(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    kepler_data = make_kepler_data()
+    cache.put(KEY, kepler_data, '<html>map</html>', {'total_records': 50})
+
+    assert cache.contains(KEY)
+    entry = cache.get(KEY)
+    assert entry['html'] == '<html>map</html>'
+    assert entry['stats'] == {'total_records': 50}
+    pd.testing.assert_frame_equal(entry['kepler_data'], kepler_data.reset_index(drop=True))
+    assert cache.get(KEY, load_data=False)['kepler_data'] is None
+    assert not any(name.endswith('.pkl') for name in os.listdir(tmp_path / KEY))
+
+
+def test_html_is_added_to_an_entry_created_without_it(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put(KEY, make_kepler_data(), None, {})
+    assert cache.get(KEY, load_data=False)['html'] is None
+
+    cache.put(KEY, make_kepler_data(), '<html/>', {})
+    assert cache.get(KEY, load_data=False)['html'] == '<html/>'
+
+
+@pytest.mark.parametrize('key', ['..', '../' + 'a' * 61, 'A' * 64, 'a' * 63, 'a' * 64 + '\n', ''])
+def test_malformed_keys_never_touch_the_filesystem(tmp_path, key):
+    cache = ResultCache(str(tmp_path / 'cache'))
+
+    assert not cache.contains(key)
+    assert cache.get(key) is None
+    assert cache.get_blob(key, 'map.html.gz') is None
+    with pytest.raises(ValueError):
+        cache.put(key, make_kepler_data(), None, {})
+
+
+def test_pickle_files_in_the_cache_are_never_loaded(tmp_path):
+    """缓存目录中的pickle文件（旧格式或被植入的文件）不会被读取"""
+    cache = ResultCache(str(tmp_path))
+    entry_dir = tmp_path / KEY
+    entry_dir.mkdir()
+    (entry_dir / 'stats.json').write_text('{}')
+    (entry_dir / 'kepler_data.pkl').write_bytes(pickle.dumps(make_kepler_data()))
+
+    assert not cache.contains(KEY)
+    assert cache.get(KEY) is None
+
+
+def test_frame_that_arrow_cannot_store_is_not_cached(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put(KEY, pd.DataFrame({'mixed': [1, 'a', 2.5]}), None, {})
+
+    assert not cache.contains(KEY)
+    assert os.listdir(tmp_path) == []
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10 ** 9)
+    cache.put(KEY, make_kepler_data(), None, {})
+    cache.put(OTHER_KEY, make_kepler_data(), None, {})
+    past = time.time() - 60
+    os.utime(tmp_path / KEY, (past, past))
+    os.utime(tmp_path / OTHER_KEY, (past + 1, past + 1))
+
+    # 读取会更新访问时间
+    cache.get(KEY)
+    cache.max_bytes = cache._entry_size(str(tmp_path / KEY)) + 1
+    cache.evict()
+
+    assert cache.contains(KEY)
+    assert not cache.contains(OTHER_KEY)
+    assert os.path.exists(tmp_path / KEY / DATA_FILE)
@@ -0,0 +1,121 @@
+import json
+import os
+import pandas as pd
+import pytest
+from shipment_store import ShipmentStore
+
+
+def make_batch(dates, warehouses=('NJ-01', 'TX-01'), rows_per_partition=3):
+    records = []
+    for date in dates:
+        for warehouse in warehouses:
+            for i in range(rows_per_partition):
+                records.append({
+                    'shipment_ts': pd.Timestamp(date) + pd.Timedelta(hours=i),
+                    'shipment_date': date,
+                    'warehouse': warehouse,
+                    'dest_zipcode': f'{i:05d}',
+                    'weight_kg': float(i),
+                })
+    frame = pd.DataFrame(records)
+    frame['shipment_date'] = frame['shipment_date'].astype('category')
+    frame['warehouse'] = frame['warehouse'].astype('category')
+    return frame
+
+
+def stored_rows(store):
+    frame = store.read(store.partitions())
+    return 0 if frame is None else len(frame)
+
+
+def test_resubmitted_batch_is_written_once(tmp_path):
+    store = ShipmentStore(str(tmp_path))
+    batch = make_batch(['2024-01-01', '2024-01-02'])
+
+    assert store.write([(batch, 'a'), (batch, 'a')]) == (len(batch), 4)
+    assert store.write([(batch, 'a')]) == (0, 0)
+    assert stored_rows(store) == len(batch)
+
+
+def test_failed_write_leaves_nothing_behind(tmp_path, monkeypatch):
+    store = ShipmentStore(str(tmp_path))
+    batch = make_batch(['2024-01-01', '2024-01-02'])
+
+    real_replace = os.replace
+    calls = []
+
+    def failing_replace(src, dst):
+        calls.append(dst)
+        if len(calls) == 3:
+            raise OSError('disk full')
+        return real_replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    with pytest.raises(OSError):
+        store.write([(batch, 'a')])
+    monkeypatch.setattr(os, 'replace', real_replace)
+
+    assert store.partitions() == []
+    assert not os.path.exists(store._batch_path('a'))
+    assert not os.listdir(os.path.join(str(tmp_path), '_staging'))
+
+    # 重新提交时完整写入一次，没有重复
+    store.write([(batch, 'a')])
+    assert stored_rows(store) == len(batch)
+
+
+def test_background_failures_are_reported(tmp_path, monkeypatch):
+    outcomes = []
+    store = ShipmentStore(str(tmp_path), flush_seconds=0, on_write=lambda outcome, batches, rows: outcomes.append((outcome, batches, rows)))
+
+    def broken_write(batches):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(store, 'write', broken_write)
+    batch = make_batch(['2024-01-01'])
+    store.submit(batch, 'a')
+    assert store.flush(timeout=5)
+
+    assert outcomes == [('failed', 1, len(batch))]
+    assert store.summary()['failed_batches'] == 1
+    assert 'disk full' in store.summary()['last_error']
+
+
+def test_compaction_keeps_every_row(tmp_path):
+    store = ShipmentStore(str(tmp_path), compact_files=2)
+    for i in range(5):
+        store.write([(make_batch(['2024-01-01'], warehouses=('NJ-01',)), f'batch-{i}')])
+
+    files = store.partitions()
+    assert len(files) <= 2
+    assert stored_rows(store) == 5 * 3
+
+
+def test_retention_expires_partitions_and_batch_records_together(tmp_path):
+    store = ShipmentStore(str(tmp_path), retention_days=10)
+    old = make_batch(['2024-01-01'])
+    recent = make_batch(['2024-01-25', '2024-02-01'])
+    store.write([(old, 'old')])
+    store.write([(recent, 'recent')])
+
+    assert {date for date, _, _ in store.partitions()} == {'2024-01-25', '2024-02-01'}
+    assert not os.path.exists(store._batch_path('old'))
+    with open(store._batch_path('recent'), encoding='utf-8') as f:
+        assert json.load(f)['last_date'] == '2024-02-01'
+
+    # 批次记录与数据同时保留：重新提交不会重复入库（即使记录的文件时间很旧）
+    os.utime(store._batch_path('recent'), (0, 0))
+    store.write([(recent, 'recent')])
+    assert stored_rows(store) == len(recent)
+
+
+def test_retention_is_off_by_default(tmp_path, monkeypatch):
+    from shipment_store import load_shipment_store
+
+    monkeypatch.setenv('SHIPMENT_STORE_DIR', str(tmp_path))
+    monkeypatch.delenv('SHIPMENT_STORE_RETENTION_DAYS', raising=False)
+    store = load_shipment_store()
+    store.write([(make_batch(['2020-01-01']), 'old')])
+    store.write([(make_batch(['2024-01-01']), 'new')])
+
+    assert {date for date, _, _ in store.partitions()} == {'2020-01-01', '2024-01-01'}
@@ -0,0 +1,75 @@
+import os
+import pytest
+from warehouses import DEFAULT_WAREHOUSE_ID, PrefixTrie, ReloadingWarehouseRegistry, WarehouseRegistry
+
+
+REGISTRY_CSV = b"""id,zipcode,lat,lng,prefixes,keywords,description
+Unknown,07114,40.7058,-74.1700,,,Default
+NJ9,7114,,,NJ,,Newark
+NJ-EAST,07001,40.58,-74.27,NJE;NJ-E,,Avenel
+NYC-Main,11378,40.72,-73.91,,NYC|NEW YORK,Queens
+"""
+
+
+def test_prefix_trie_returns_longest_match():
+    trie = PrefixTrie()
+    trie.insert('NJ', 'short')
+    trie.insert('NJE', 'long')
+
+    assert trie.longest_match('NJE-17') == 'long'
+    assert trie.longest_match('NJ-17') == 'short'
+    assert trie.longest_match('N') is None
+    assert trie.longest_match('TX-01') is None
+
+
+def test_resolve_order_exact_prefix_keyword_default():
+    registry = WarehouseRegistry.from_csv(REGISTRY_CSV)
+
+    assert registry.resolve('NJ9')['id'] == 'NJ9'
+    assert registry.resolve(' nje-12 ')['id'] == 'NJ-EAST'
+    assert registry.resolve('nj-02')['id'] == 'NJ9'
+    assert registry.resolve('Brooklyn New York DC')['id'] == 'NYC-Main'
+    assert registry.resolve('TX-01')['id'] == DEFAULT_WAREHOUSE_ID
+    assert registry.resolve(None)['id'] == DEFAULT_WAREHOUSE_ID
+
+
+def test_from_csv_pads_zipcodes_and_keeps_missing_coordinates():
+    registry = WarehouseRegistry.from_csv(REGISTRY_CSV)
+
+    assert registry.zipcode('NJ9') == '07114'
+    assert registry.entries['NJ9']['lat'] is None
+    assert sorted(registry.coordinates().index) == ['07001', '07114', '11378']
+    assert registry.version == WarehouseRegistry.from_csv(REGISTRY_CSV).version
+
+
+@pytest.mark.parametrize('data, message', [
+    (b'id,zipcode\nUnknown,07114\nNJ9,07114\nNJ9,07001\n', 'Duplicate warehouse id'),
+    (b'id,zipcode\nUnknown,07114\nNJ9,7-114\n', 'Invalid warehouse zipcodes'),
+    (b'id,zipcode\nUnknown,07114\nNJ9,123456\n', 'Invalid warehouse zipcodes'),
+    (b'id,zipcode,keywords\nUnknown,07114,\nNJ9,07114,NJ(\n', 'Invalid keyword pattern'),
+    (b'id,lat\nUnknown,40.7\n', 'missing columns'),
+    (b'id,zipcode\nNJ9,07114\n', 'default warehouse'),
+])
+def test_from_csv_rejects_invalid_registry(data, message):
+    with pytest.raises(ValueError, match=message):
+        WarehouseRegistry.from_csv(data)
+
+
+def test_reloading_registry_picks_up_changes_and_keeps_last_good_version(tmp_path):
+    path = tmp_path / 'warehouses.csv'
+    path.write_bytes(REGISTRY_CSV)
+    registry = ReloadingWarehouseRegistry(str(path), check_interval=0)
+    first = registry.current()
+    assert first.zipcode('TX-01') == '07114'
+
+    path.write_bytes(REGISTRY_CSV + b'TX-01,75001,,,TX,,Dallas\n')
+    os.utime(path, (first.loaded_at + 10, first.loaded_at + 10))
+    second = registry.current()
+    assert second is not first
+    assert second.zipcode('TX-05') == '75001'
+    # 旧快照不受影响（一次请求内的解析结果保持一致）
+    assert first.zipcode('TX-05') == '07114'
+
+    path.write_bytes(b'id,zipcode\nNJ9,07114\n')
+    os.utime(path, (first.loaded_at + 20, first.loaded_at + 20))
+    assert registry.current() is second
@@ -0,0 +1,191 @@
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+import pandas as pd
+
+
+# 未匹配到任何规则时使用的仓库
+DEFAULT_WAREHOUSE_ID = 'Unknown'
+
+# 配置文件的列：id、邮编、坐标（可选）、前缀（;分隔，可选）、关键词正则（可选）、说明（可选）
+REGISTRY_COLUMNS = ['id', 'zipcode', 'lat', 'lng', 'prefixes', 'keywords', 'description']
+
+
+class PrefixTrie:
+    """前缀树：一次遍历找出名称的最长匹配前缀"""
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = value
+
+    def longest_match(self, text):
+        node = self.root
+        match = None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match = node[None]
+        return match
+
+
+class WarehouseRegistry:
+    """仓库注册表快照（不可变）：仓库ID → 邮编/坐标，前缀树 + 按顺序的关键词正则做模糊匹配，
+    名称的解析结果按快照缓存"""
+
+    def __init__(self, frame, version=None, path=None):
+        self.version = version
+        self.path = path
+        self.loaded_at = time.time()
+        self.entries = {}
+        self.prefixes = PrefixTrie()
+        self.keyword_rules = []
+        self._resolved = {}
+
+        for row in frame.itertuples(index=False):
+            warehouse_id = row.id
+            if warehouse_id in self.entries:
+                raise ValueError(f'Duplicate warehouse id: {warehouse_id}')
+            self.entries[warehouse_id] = {
+                'id': warehouse_id,
+                'zipcode': row.zipcode,
+                'lat': None if pd.isna(row.lat) else float(row.lat),
+                'lng': None if pd.isna(row.lng) else float(row.lng),
+                'description': row.description or '',
+            }
+            for prefix in filter(None, (p.strip().upper() for p in row.prefixes.split(';'))):
+                self.prefixes.insert(prefix, warehouse_id)
+            if row.keywords:
+                try:
+                    self.keyword_rules.append((re.compile(row.keywords.upper()), warehouse_id))
+                except re.error as e:
+                    raise ValueError(f'Invalid keyword pattern for {warehouse_id}: {e}')
+
+        if DEFAULT_WAREHOUSE_ID not in self.entries:
+            raise ValueError(f'Warehouse registry must define the default warehouse "{DEFAULT_WAREHOUSE_ID}"')
+
+    @classmethod
+    def from_csv(cls, data, path=None):
+        """从CSV字节解析注册表，版本号为内容的SHA-256"""
+        frame = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False)
+        frame.columns = [str(column).strip().lower() for column in frame.columns]
+        missing = [column for column in ('id', 'zipcode') if column not in frame.columns]
+        if missing:
+            raise ValueError(f'Warehouse registry missing columns: {missing}')
+        for column in REGISTRY_COLUMNS:
+            if column not in frame.columns:
+                frame[column] = ''
+
+        frame = frame[REGISTRY_COLUMNS].apply(lambda column: column.str.strip())
+        frame = frame[frame['id'] != '']
+        invalid = frame.loc[~frame['zipcode'].str.fullmatch(r'\d{3,5}'), 'id'].tolist()
+        if invalid:
+            raise ValueError(f'Invalid warehouse zipcodes: {invalid}')
+        frame['zipcode'] = frame['zipcode'].str.zfill(5)
+        for column in ('lat', 'lng'):
+            frame[column] = pd.to_numeric(frame[column].mask(frame[column] == ''), errors='raise')
+        return cls(frame, hashlib.sha256(data).hexdigest(), path)
+
+    def resolve(self, warehouse_name):
+        """仓库名称 → 注册表条目：精确匹配，其次最长前缀，再次按顺序的关键词，都未命中时为默认仓库"""
+        if pd.isna(warehouse_name):
+            return self.entries[DEFAULT_WAREHOUSE_ID]
+
+        warehouse_name = str(warehouse_name).strip()
+        warehouse_id = self._resolved.get(warehouse_name)
+        if warehouse_id is None:
+            warehouse_id = self._match(warehouse_name)
+            self._resolved[warehouse_name] = warehouse_id
+        return self.entries[warehouse_id]
+
+    def _match(self, warehouse_name):
+        if warehouse_name in self.entries:
+            return warehouse_name
+
+        warehouse_upper = warehouse_name.upper()
+        warehouse_id = self.prefixes.longest_match(warehouse_upper)
+        if warehouse_id is not None:
+            return warehouse_id
+
+        for pattern, warehouse_id in self.keyword_rules:
+            if pattern.search(warehouse_upper):
+                return warehouse_id
+
+        return DEFAULT_WAREHOUSE_ID
+
+    def zipcode(self, warehouse_name):
+        return self.resolve(warehouse_name)['zipcode']
+
+    @property
+    def default_zipcode(self):
+        return self.entries[DEFAULT_WAREHOUSE_ID]['zipcode']
+
+    def coordinates(self):
+        """注册表中已知坐标的仓库邮编（以邮编为索引的 lat/lng），这些邮编不需要地理编码"""
+        rows = [entry for entry in self.entries.values() if entry['lat'] is not None and entry['lng'] is not None]
+        coords = pd.DataFrame(rows, columns=['zipcode', 'lat', 'lng']).drop_duplicates('zipcode').set_index('zipcode')
+        return coords.astype('float64')
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'path': self.path,
+            'loaded_at': self.loaded_at,
+            'warehouses': list(self.entries.values()),
+        }
+
+
+class ReloadingWarehouseRegistry:
+    """按文件修改时间热加载的注册表：每次取用时最多每 check_interval 秒检查一次文件，
+    文件变化后重新解析；解析失败时保留上一个可用版本"""
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.path.getmtime(path)
+        self._checked_at = time.monotonic()
+        with open(path, 'rb') as f:
+            self._registry = WarehouseRegistry.from_csv(f.read(), path)
+
+    def current(self):
+        """当前注册表快照；一次请求内应只取一次，保证同一请求内的解析结果一致"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._registry
+
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self._registry
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+                if mtime != self._mtime:
+                    # 先记录修改时间：文件有误时只提示一次，直到文件再次修改
+                    self._mtime = mtime
+                    with open(self.path, 'rb') as f:
+                        registry = WarehouseRegistry.from_csv(f.read(), self.path)
+                    if registry.version != self._registry.version:
+                        self._registry = registry
+                        print(f"🔄 仓库注册表已重新加载: {len(registry.entries)} 个仓库 ({self.path})")
+            except (OSError, ValueError) as e:
+                print(f"⚠️ 仓库注册表重新加载失败，继续使用上一版本: {e}")
+        return self._registry
+
+
+def load_warehouse_registry(path=None):
+    """按环境变量 WAREHOUSE_REGISTRY_PATH 加载仓库注册表（默认 config/warehouses.csv），
+    WAREHOUSE_REGISTRY_CHECK_INTERVAL 为检查文件变化的间隔秒数"""
+    path = path or os.environ.get('WAREHOUSE_REGISTRY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'warehouses.csv'))
+    registry = ReloadingWarehouseRegistry(path, float(os.environ.get('WAREHOUSE_REGISTRY_CHECK_INTERVAL', 5)))
+    print(f"🏢 仓库注册表已加载: {len(registry.current().entries)} 个仓库 ({path})")
+    return registry